@@ -0,0 +1,367 @@
+"""Микробенчмарки обработчиков StarBot без сети.
+
+Обработчики вызываются на настоящих объектах Update/Message, но Bot API,
+CryptoBot и Fragment заменены заглушками в памяти, поэтому замеряется только
+процессорная стоимость обработки. Для каждого сценария печатается число
+операций в секунду, пиковый объем выделенной памяти и прирост памяти на операцию.
+
+Пример:
+    python bench_handlers.py --save bench_baseline.json
+    python bench_handlers.py --compare bench_baseline.json --threshold 0.15
+"""
+import os
+import sys
+import tempfile
+
+# Модуль бота проверяет обязательные переменные при импорте
+_workdir = tempfile.mkdtemp(prefix="starbot-bench-")
+for _key, _value in {
+    "API_KEY": "bench",
+    "TELEGRAM_TOKEN": "123456:BENCH",
+    "CRYPTOBOT_TOKEN": "bench",
+    "PHONE_NUMBER": "+70000000000",
+    "MNEMONICS": "bench words only",
+    "ADMIN_CHAT_ID": "1",
+    "LOG_FILE": os.path.join(_workdir, "bench.log"),
+    # Лимиты пользователей отключены: иначе замерялся бы отказ, а не обработка
+    "THROTTLE_NAV_RATE": "0",
+    "THROTTLE_EXPENSIVE_RATE": "0",
+    # Без планировщика отправки: лимит чата растянул бы повторы в одном чате
+    "SEND_GLOBAL_RATE": "0",
+}.items():
+    os.environ.setdefault(_key, _value)
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import statistics
+import time
+import tracemalloc
+from typing import Optional, Dict, Any, Callable, List, Awaitable
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest, RequestData
+
+import deepseek_python_20250614_73c3e7 as starbot
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+USER_ID = 1000
+CALLBACKS = ["main_menu", "buy_stars", "buy_self", "buy_friend", "currency_ton", "currency_usdt",
+             "profile", "support", "promo", "instructions"]
+MESSAGES = [
+    ("ENTERING_PROMO", "welcome10"),
+    ("ENTERING_PROMO", "NOSUCHCODE"),
+    ("ENTERING_FRIEND_USERNAME", "@friend_user"),
+    ("ENTERING_FRIEND_USERNAME", "abc"),
+    ("ENTERING_AMOUNT", "not a number"),
+    ("ENTERING_AMOUNT", "10"),
+    (None, "привет"),
+]
+
+
+class InMemoryRequest(BaseRequest):
+    """Транспорт Bot API без сети: каждый вызов сразу успешен"""
+    def __init__(self):
+        self.message_ids = itertools.count(1000)
+        self.calls = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendPhoto", "sendMessage", "editMessageCaption", "editMessageText"):
+            result = {
+                "message_id": params.get("message_id") or next(self.message_ids),
+                "date": 0,
+                "chat": {"id": int(params["chat_id"]), "type": "private"}
+            }
+            if api_method in ("sendPhoto", "editMessageCaption"):
+                result["photo"] = [{"file_id": "bench-file", "file_unique_id": "bench", "width": 1, "height": 1}]
+                result["caption"] = params.get("caption", "")
+            else:
+                result["text"] = params.get("text", "")
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeResponse:
+    def __init__(self, payload: Dict[str, Any], status_code: int = 200):
+        self.status_code = status_code
+        self.payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self) -> Dict[str, Any]:
+        return self.payload
+
+    def raise_for_status(self):
+        pass
+
+
+class InMemorySession:
+    """Заглушка requests.Session клиента Fragment/CryptoBot"""
+    def __init__(self):
+        self.headers: Dict[str, str] = {}
+        self.invoice_ids = itertools.count(1)
+        self.invoice_status = "active"
+
+    def post(self, url: str, **kwargs) -> FakeResponse:
+        payload = kwargs.get("json") or {}
+        if url.endswith("/createInvoice"):
+            return FakeResponse({"ok": True, "result": {
+                "invoice_id": next(self.invoice_ids),
+                "status": "active",
+                "amount": payload["amount"],
+                "pay_url": "https://pay.crypt.bot/invoice/bench"
+            }})
+        if url.endswith("/order/stars/"):
+            return FakeResponse({"id": 1, "username": payload["username"], "quantity": payload["quantity"]})
+        if url.endswith("/auth/authenticate/"):
+            return FakeResponse({"token": "bench"})
+        return FakeResponse({"ok": True, "result": True})
+
+    def close(self):
+        pass
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, **kwargs) -> FakeResponse:
+        if "/misc/user/" in url:
+            return FakeResponse({"username": url.rstrip("/").rsplit("/", 1)[-1]})
+        invoice_id = int((params or {}).get("invoice_ids", 0))
+        return FakeResponse({"ok": True, "result": {"items": [{
+            "invoice_id": invoice_id,
+            "status": self.invoice_status,
+            "paid_at": "2025-06-14T12:00:00Z"
+        }]}})
+
+
+class BenchContext:
+    """Минимальный ContextTypes.DEFAULT_TYPE: обработчикам нужны только bot и user_data"""
+    def __init__(self, bot: Bot, user_data: Optional[Dict[str, Any]] = None):
+        self.bot = bot
+        self.user_data = user_data if user_data is not None else {}
+
+
+def _user() -> Dict[str, Any]:
+    return {"id": USER_ID, "is_bot": False, "first_name": "Bench", "username": "bench_user"}
+
+
+def message_update(bot: Bot, text: str) -> Update:
+    return Update.de_json({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "chat": {"id": USER_ID, "type": "private"}, "from": _user(), "text": text
+    }}, bot)
+
+
+def callback_update(bot: Bot, data: str) -> Update:
+    return Update.de_json({"update_id": 1, "callback_query": {
+        "id": "1", "from": _user(), "chat_instance": "1", "data": data,
+        "message": {
+            "message_id": 1, "date": 0, "chat": {"id": USER_ID, "type": "private"},
+            "photo": [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}]
+        }
+    }}, bot)
+
+
+def history(size: int) -> Dict[str, Any]:
+    return {
+        "total_stars": 100 * size,
+        "transactions": [
+            {"stars": 100, "date": "2025-06-14 12:00", "promo": "промокод STARS20 (20%)" if i % 3 else "без скидки",
+             **({"recipient": f"friend{i}"} if i % 2 else {})}
+            for i in range(size)
+        ]
+    }
+
+
+def pending_payment(amount: int = 100) -> Dict[str, Any]:
+    return {
+        "user_id": USER_ID, "sender_username": "bench_user", "recipient": None, "stars_amount": amount,
+        "currency": "TON", "amount_rub": amount * 1.45, "amount_crypto": amount * 1.45 / 200,
+        "discount_percent": 0, "promo_code": None, "processed": False
+    }
+
+
+Op = Callable[[int], Awaitable[Any]]
+
+
+def build_benchmarks(bot: "starbot.StarBot", tg_bot: Bot) -> Dict[str, Op]:
+    session = bot.fragment_client.cryptobot.session
+    callbacks = [callback_update(tg_bot, data) for data in CALLBACKS]
+    messages = [(state, message_update(tg_bot, text)) for state, text in MESSAGES]
+    profile_update = callback_update(tg_bot, "profile")
+    check_update = callback_update(tg_bot, "check_1")
+    buy_message = message_update(tg_bot, "100").message
+
+    async def handle_callback(i: int):
+        await bot.handle_callback(callbacks[i % len(callbacks)], BenchContext(tg_bot))
+
+    async def handle_message(i: int):
+        state, update = messages[i % len(messages)]
+        await bot.handle_message(update, BenchContext(tg_bot, {"state": state} if state else {}))
+
+    def show_profile(size: int) -> Op:
+        record = history(size)
+
+        async def op(i: int):
+            bot.user_data_store[USER_ID] = record
+            await bot.show_profile(profile_update, BenchContext(tg_bot, {"promo_code": "STARS20", "discount_percent": 20}))
+        return op
+
+    async def buy_quote(i: int):
+        bot.invoice_cache.clear()
+        bot.pending_payments.clear()
+        await bot.process_buy_stars(buy_message, 50 + i % 1000, ("TON", "USDT")[i % 2], None, (0, 10, 50)[i % 3])
+
+    async def buy_cached(i: int):
+        await bot.process_buy_stars(buy_message, 100, "TON")
+
+    def check_payment(status: str) -> Op:
+        async def op(i: int):
+            payment_id = str(i)
+            session.invoice_status = status
+            bot.pending_payments[payment_id] = pending_payment()
+            bot.user_data_store.pop(USER_ID, None)
+            await bot.check_payment(check_update, BenchContext(tg_bot), payment_id)
+            bot.pending_payments.pop(payment_id, None)
+        return op
+
+    async def check_payment_busy(i: int):
+        bot.processing_payments.add("busy")
+        await bot.check_payment(check_update, BenchContext(tg_bot), "busy")
+        bot.processing_payments.discard("busy")
+
+    return {
+        "handle_callback": handle_callback,
+        "handle_message": handle_message,
+        "show_profile_small": show_profile(10),
+        "show_profile_large": show_profile(10000),
+        "process_buy_stars_quote": buy_quote,
+        "process_buy_stars_cached": buy_cached,
+        "check_payment_active": check_payment("active"),
+        "check_payment_expired": check_payment("expired"),
+        "check_payment_paid": check_payment("paid"),
+        "check_payment_busy": check_payment_busy,
+    }
+
+
+async def measure(op: Op, iterations: int, rounds: int, alloc_iterations: int) -> Dict[str, float]:
+    for i in range(min(iterations, 100)):
+        await op(i)
+
+    rates = []
+    for _ in range(rounds):
+        gc.collect()
+        started = time.perf_counter()
+        for i in range(iterations):
+            await op(i)
+        rates.append(iterations / (time.perf_counter() - started))
+
+    # Память замеряется отдельным прогоном: tracemalloc замедляет выполнение в разы
+    gc.collect()
+    tracemalloc.start()
+    peaks = []
+    start_current, _ = tracemalloc.get_traced_memory()
+    for i in range(alloc_iterations):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await op(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    gc.collect()
+    end_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "ops_per_sec": round(statistics.median(rates), 1),
+        "us_per_op": round(1e6 / statistics.median(rates), 2),
+        "peak_alloc_kb": round(statistics.median(peaks) / 1024, 2),
+        "retained_bytes_per_op": round((end_current - start_current) / alloc_iterations, 1)
+    }
+
+
+async def run_benchmarks(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    tg_bot = Bot(starbot.TELEGRAM_TOKEN, request=InMemoryRequest(), get_updates_request=InMemoryRequest())
+    await tg_bot.initialize()
+
+    bot = starbot.StarBot(starbot.API_KEY, starbot.TELEGRAM_TOKEN, starbot.CRYPTOBOT_TOKEN)
+    bot.fragment_client.use_session(InMemorySession())
+    bot.fragment_client.auth_token = "bench"
+    bot.fragment_client.last_rate_update = time.time()
+    for event in bot.readiness.values():
+        event.set()
+
+    results = {}
+    for name, op in build_benchmarks(bot, tg_bot).items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = await measure(op, args.iterations, args.rounds, args.alloc_iterations)
+        print(f"{name:<28}{results[name]['ops_per_sec']:>12}{results[name]['us_per_op']:>12}"
+              f"{results[name]['peak_alloc_kb']:>12}{results[name]['retained_bytes_per_op']:>12}")
+    await tg_bot.shutdown()
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    """Сравнение с сохраненным прогоном; возвращает список регрессий"""
+    regressions = []
+    print(f"\n{'сценарий':<28}{'ops/s, %':>12}{'память, %':>12}")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            print(f"{name:<28}{'нет базы':>12}")
+            continue
+        speed = current["ops_per_sec"] / before["ops_per_sec"] - 1
+        memory = current["peak_alloc_kb"] / before["peak_alloc_kb"] - 1 if before["peak_alloc_kb"] else 0.0
+        print(f"{name:<28}{speed * 100:>+12.1f}{memory * 100:>+12.1f}")
+        if speed < -threshold:
+            regressions.append(f"{name}: скорость {speed * 100:+.1f}%")
+        if memory > threshold:
+            regressions.append(f"{name}: память {memory * 100:+.1f}%")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000, help="операций в одном раунде")
+    parser.add_argument("--rounds", type=int, default=5, help="раундов, берется медиана")
+    parser.add_argument("--alloc-iterations", type=int, default=200, help="операций в прогоне с tracemalloc")
+    parser.add_argument("--filter", help="запускать только сценарии с этой подстрокой")
+    parser.add_argument("--save", help="сохранить результат как базовый")
+    parser.add_argument("--compare", help="сравнить с базовым результатом")
+    parser.add_argument("--threshold", type=float, default=0.10, help="допустимое ухудшение, доля")
+    parser.add_argument("--with-logging", action="store_true", help="не отключать INFO-логи бота")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if not args.with_logging:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'сценарий':<28}{'ops/s':>12}{'мкс/оп':>12}{'пик, КБ':>12}{'удерж., Б':>12}")
+    results = asyncio.run(run_benchmarks(args))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "benchmarks": results}, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nРегрессии:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,168 @@
-import subprocess
 import sys
 import os
 import math
+import json
+import html
+import socket
+import hashlib
+import uuid
+import hmac
+import contextvars
+import sqlite3
+import threading
+import functools
+import traceback
+import tracemalloc
+import cProfile
+import itertools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from collections.abc import MutableMapping
 
 try:
     import requests
-    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
-    from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-except ImportError:
-    print("Установка необходимых зависимостей...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
-    print("Зависимости установлены. Перезапустите бот.")
+    from aiohttp import web
+    from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
+    from telegram.error import BadRequest, Forbidden, RetryAfter
+    from telegram.request import BaseRequest
+    from telegram.ext import (
+        Application, BasePersistence, BaseRateLimiter, CommandHandler, CallbackQueryHandler, MessageHandler,
+        PersistenceInput, TypeHandler, filters, ContextTypes
+    )
+except ImportError as e:
+    print(f"Не установлены зависимости ({e}). Выполните: pip install -r requirements.txt")
     sys.exit(1)
 
+from trace_summary import summarize as summarize_traces
+
 import requests
 import logging
+import logging.handlers
+import queue
+import random
+import re
+import atexit
 import time
 import asyncio
-from typing import Optional, Dict, Any
+import signal
+from collections import deque, OrderedDict
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Tuple
 
 # Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Максимальная длина сообщения в логе, длинные ответы API обрезаются
+LOG_MAX_MESSAGE = int(os.getenv("LOG_MAX_MESSAGE", "1000"))
+# Доля сохраняемых записей с телами запросов и ответов (extra={"payload": True})
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+class RedactingFilter(logging.Filter):
+    """Скрывает мнемонику, JWT и токены, обрезает слишком длинные сообщения"""
+    PATTERNS = [
+        (re.compile(r"""(['"]mnemonics['"]\s*:\s*)\[[^\]]*\]"""), r"\1[REDACTED]"),
+        (re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]+"), "[JWT]"),
+        (re.compile(r"(JWT|Bearer)\s+[\w.-]+"), r"\1 [REDACTED]"),
+        (re.compile(r"""(['"](?:token|api_key|Crypto-Pay-API-Token|Authorization)['"]\s*:\s*['"])[^'"]+"""), r"\1[REDACTED]"),
+        (re.compile(r"/bot\d+:[\w-]+"), "/bot[REDACTED]"),
     ]
-)
+
+    def __init__(self, max_length: int = LOG_MAX_MESSAGE):
+        super().__init__()
+        self.max_length = max_length
+        self.secrets = [
+            value for value in (
+                os.getenv("API_KEY"),
+                os.getenv("TELEGRAM_TOKEN"),
+                os.getenv("CRYPTOBOT_TOKEN"),
+                os.getenv("PHONE_NUMBER"),
+                os.getenv("MNEMONICS", "").strip()
+            ) if value and len(value) >= 6
+        ]
+
+    def redact(self, text: str) -> str:
+        for secret in self.secrets:
+            text = text.replace(secret, "[REDACTED]")
+        for pattern, replacement in self.PATTERNS:
+            text = pattern.sub(replacement, text)
+        return text
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        text = self.redact(record.getMessage())
+        # Трейсбеки ошибок не обрезаем
+        if len(text) > self.max_length and record.levelno < logging.ERROR:
+            text = f"{text[:self.max_length]}... [обрезано {len(text) - self.max_length} симв.]"
+        record.msg = text
+        record.args = None
+        return True
+
+
+class PayloadSamplingFilter(logging.Filter):
+    """Пропускает только часть записей с телами запросов; ошибки проходят всегда"""
+    def __init__(self, rate: float = LOG_PAYLOAD_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "payload", False) or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "msg": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging(log_file: str = LOG_FILE):
+    """Логи пишутся через очередь в отдельном потоке: файл с ротацией в JSON и консоль"""
+    global _log_listener
+    if _log_listener:
+        _log_listener.stop()
+
+    redactor = RedactingFilter()
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    file_handler.addFilter(redactor)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    console_handler.addFilter(redactor)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(PayloadSamplingFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.INFO)
+    # httpx пишет строку на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _log_listener.start()
+
+def _stop_logging():
+    if _log_listener:
+        _log_listener.stop()
+
+setup_logging()
+atexit.register(_stop_logging)
 logger = logging.getLogger(__name__)
 
 # Конфигурация из переменных окружения
@@ -51,306 +186,3675 @@ if not all([API_KEY, TELEGRAM_TOKEN, CRYPTOBOT_TOKEN, PHONE_NUMBER, MNEMONICS, A
     logger.error(f"Отсутствующие переменные: {', '.join(missing)}")
     sys.exit(1)
 
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# Адреса внешних API (переопределяются для локальных заглушек в нагрузочных тестах)
+FRAGMENT_API_URL = os.getenv("FRAGMENT_API_URL", "https://api.fragment-api.com/v1")
+CRYPTOBOT_API_URL = os.getenv("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+# Пулы соединений внешних API: имя -> (соединений и потоков, таймаут чтения, предел запроса), секунды
+UPSTREAM_POOLS = {
+    "fragment": (int(os.getenv("FRAGMENT_POOL_SIZE", "8")), 60, 90),
+    "cryptobot": (int(os.getenv("CRYPTOBOT_POOL_SIZE", "8")), 30, 45),
+    "coingecko": (2, 10, 15),
+    "telegram": (2, 30, 45),
+}
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+# Срок ответа на действие пользователя: запросы к API внутри обработчика укладываются в него
+USER_REQUEST_DEADLINE = float(os.getenv("USER_REQUEST_DEADLINE", "25"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Максимум одновременно обрабатываемых обновлений (разные пользователи)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Несколько процессов-воркеров с общим состоянием в SQLite
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+SHARED_STORE_PATH = os.getenv("SHARED_STORE_PATH", "bot_state.db")
+LEADER_LEASE_TTL = int(os.getenv("LEADER_LEASE_TTL", "30"))
+
+# Сохранение состояния диалогов (context.user_data)
+USER_DATA_FLUSH_INTERVAL = int(os.getenv("USER_DATA_FLUSH_INTERVAL", "30"))
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", str(3 * 24 * 3600)))
+
 MAX_RETRIES = 3
 RETRY_DELAY = 5
 MAX_STARS = 100000
+# Время жизни счета CryptoBot и минимальный остаток жизни для его повторного использования
+INVOICE_TTL = 900
+INVOICE_REUSE_MIN_REMAINING = 60
+
+# URL изображений по умолчанию (переопределяются в файле настроек)
+PHOTO_URLS = {
+    "main_menu": "https://i.ibb.co/Jj1fvZ3X/Chat-GPT-Image-9-2025-20-22-00.png",
+    "buy_stars": "https://i.ibb.co/zWrKLHyN/Chat-GPT-Image-9-2025-20-20-03.png",
+    "invoice": "https://i.ibb.co/YBhRtD2q/photo-2025-06-09-23-19-53.jpg",
+    "profile": "https://i.ibb.co/rRFd15ry/Chat-GPT-Image-9-Juni-2025-21-05-34.png",
+    "support": "https://i.ibb.co/zhCxKY1n/Chat-GPT-Image-9-Juni-2025-21-12-34.png",
+    "username_input": "https://i.ibb.co/9CsNmQ5/Chat-GPT-Image-9-Juni-2025-21-09-14.png",
+    "currency_choice": "https://i.ibb.co/mCJsS2tJ/Chat-GPT-Image-9-2025-21-05-47.png",
+    "promo": "https://i.ibb.co/vCH6qkWf/Chat-GPT-Image-10-2025-12-28-53.png",
+}
+
+# Настройки магазина, которые меняются без перезапуска: JSON-файл поверх значений ниже
+BOT_CONFIG_FILE = os.getenv("BOT_CONFIG_FILE", "bot_config.json")
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "5"))
+DEFAULT_CONFIG = {
+    "price_per_star": 1.45,
+    "min_stars": 50,
+    "max_stars": MAX_STARS,
+    "photos": PHOTO_URLS,
+    # Код актива CryptoBot -> id в CoinGecko, подпись кнопки, минимальная сумма счета и курс до первого обновления
+    "assets": {
+        "TON": {"coingecko_id": "the-open-network", "button": "💎 Оплатить в TON", "min_amount": 0.01, "rate": 200},
+        "USDT": {"coingecko_id": "tether", "button": "💵 Оплатить в USDT", "min_amount": 0.01, "rate": 90},
+    },
+    # Промокод -> скидка в процентах и число активаций
+    "promocodes": {
+        "WELCOME10": {"discount": 10, "activations": 10},
+        "STARS20": {"discount": 20, "activations": 10},
+        "BEAR30": {"discount": 30, "activations": 5},
+        "MEGA40": {"discount": 40, "activations": 3},
+        "SUPER50": {"discount": 50, "activations": 3},
+        "ULTRA60": {"discount": 60, "activations": 2},
+        "EPIC70": {"discount": 70, "activations": 2},
+        "LEGEND80": {"discount": 80, "activations": 1},
+        "GOD99": {"discount": 99, "activations": 1}
+    }
+}
+# Чат для прогрева file_id фотографий при запуске (пусто - без прогрева)
+MEDIA_WARMUP_CHAT_ID = os.getenv("MEDIA_WARMUP_CHAT_ID", ADMIN_CHAT_ID)
+# Сколько ждать завершения прогрева перед операциями, которые от него зависят
+READINESS_TIMEOUT = int(os.getenv("READINESS_TIMEOUT", "30"))
+# Пауза перед повтором неудавшейся фазы прогрева
+WARMUP_RETRY_DELAY = int(os.getenv("WARMUP_RETRY_DELAY", "30"))
+# Сколько ждать завершения начатых доставок при остановке
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+
+# HTTP endpoint метрик Prometheus (0 - выключен). Воркер N слушает METRICS_PORT + N
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# Диагностика блокировок event loop
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "0") == "1"
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.25"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.1"))
+
+# Диагностика памяти (/mem): глубина стека tracemalloc, строк в отчете,
+# элементов выборки при оценке размера структур
+MEM_TRACE_FRAMES = int(os.getenv("MEM_TRACE_FRAMES", "1"))
+MEM_TOP = int(os.getenv("MEM_TOP", "15"))
+MEM_SIZE_SAMPLE = int(os.getenv("MEM_SIZE_SAMPLE", "200"))
+
+# Трассировка пути оплаты по этапам (PAYMENT_TRACE=1); трассы пишутся строками JSON
+PAYMENT_TRACE = os.getenv("PAYMENT_TRACE", "0") == "1"
+PAYMENT_TRACE_FILE = os.getenv("PAYMENT_TRACE_FILE", "payment_traces.jsonl")
+# Последние трассы в памяти для /trace
+PAYMENT_TRACE_KEEP = int(os.getenv("PAYMENT_TRACE_KEEP", "1000"))
+# Доля трасс под cProfile; профиль сохраняется, если оплата шла дольше PAYMENT_PROFILE_SLOW секунд
+PAYMENT_PROFILE_RATE = float(os.getenv("PAYMENT_PROFILE_RATE", "0.05"))
+PAYMENT_PROFILE_SLOW = float(os.getenv("PAYMENT_PROFILE_SLOW", "2"))
+PAYMENT_PROFILE_DIR = os.getenv("PAYMENT_PROFILE_DIR", "payment_profiles")
+
+# Запись трафика для воспроизведения (replay.py); пусто - запись выключена
+TRAFFIC_RECORD_FILE = os.getenv("TRAFFIC_RECORD_FILE")
+# Соль псевдонимов: одинаковая соль дает одинаковые псевдонимы в разных файлах
+TRAFFIC_RECORD_SALT = os.getenv("TRAFFIC_RECORD_SALT")
 
-# URL изображений
-MAIN_MENU_PHOTO_URL = "https://i.ibb.co/Jj1fvZ3X/Chat-GPT-Image-9-2025-20-22-00.png"
-BUY_STARS_PHOTO_URL = "https://i.ibb.co/zWrKLHyN/Chat-GPT-Image-9-2025-20-20-03.png"
-INVOICE_PHOTO_URL = "https://i.ibb.co/YBhRtD2q/photo-2025-06-09-23-19-53.jpg"
-PROFILE_PHOTO_URL = "https://i.ibb.co/rRFd15ry/Chat-GPT-Image-9-Juni-2025-21-05-34.png"
-SUPPORT_PHOTO_URL = "https://i.ibb.co/zhCxKY1n/Chat-GPT-Image-9-Juni-2025-21-12-34.png"
-USERNAME_INPUT_PHOTO_URL = "https://i.ibb.co/9CsNmQ5/Chat-GPT-Image-9-Juni-2025-21-09-14.png"
-CURRENCY_CHOICE_PHOTO_URL = "https://i.ibb.co/mCJsS2tJ/Chat-GPT-Image-9-2025-21-05-47.png"
-PROMO_PHOTO_URL = "https://i.ibb.co/vCH6qkWf/Chat-GPT-Image-10-2025-12-28-53.png"
+# Журнал заказов; пусто - журнал выключен
+ORDER_JOURNAL_FILE = os.getenv("ORDER_JOURNAL_FILE", "orders.journal")
+# Окно накопления записей журнала перед одним fsync
+JOURNAL_COMMIT_DELAY = float(os.getenv("JOURNAL_COMMIT_DELAY", "0.002"))
+# Сколько хранить в журнале завершенные заказы (больше RECONCILE_LOOKBACK)
+JOURNAL_RETENTION = int(os.getenv("JOURNAL_RETENTION", str(7 * 24 * 3600)))
+
+# Индекс заказов по журналам для API поиска (SQLite); строится только при заданном ADMIN_API_PORT
+ORDER_INDEX_PATH = os.getenv("ORDER_INDEX_PATH", "orders_index.db")
+ORDER_INDEX_INTERVAL = float(os.getenv("ORDER_INDEX_INTERVAL", "2"))
+# HTTP API поиска заказов для поддержки (0 - выключен), слушает только воркер 0
+ADMIN_API_PORT = int(os.getenv("ADMIN_API_PORT", "0"))
+ADMIN_API_LISTEN = os.getenv("ADMIN_API_LISTEN", "127.0.0.1")
+# Токен для заголовка Authorization: Bearer <токен>
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+ADMIN_API_PAGE_SIZE = int(os.getenv("ADMIN_API_PAGE_SIZE", "50"))
+ADMIN_API_MAX_PAGE_SIZE = int(os.getenv("ADMIN_API_MAX_PAGE_SIZE", "500"))
+
+# Сверка оплаченных счетов CryptoBot с доставками по журналу; 0 - выключена
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "600"))
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "1000"))
+# Глубина первой сверки, пока нет курсора
+RECONCILE_LOOKBACK = int(os.getenv("RECONCILE_LOOKBACK", str(24 * 3600)))
+# Свежие оплаты оставляются обычной проверке
+RECONCILE_GRACE = int(os.getenv("RECONCILE_GRACE", "120"))
+
+# Лимиты действий пользователей (токенов в секунду и запас); скорость 0 - без лимита
+THROTTLE_NAV_RATE = float(os.getenv("THROTTLE_NAV_RATE", "2"))
+THROTTLE_NAV_BURST = float(os.getenv("THROTTLE_NAV_BURST", "10"))
+THROTTLE_NAV_GLOBAL_RATE = float(os.getenv("THROTTLE_NAV_GLOBAL_RATE", "200"))
+THROTTLE_NAV_GLOBAL_BURST = float(os.getenv("THROTTLE_NAV_GLOBAL_BURST", "400"))
+# Дорогие действия: создание счета и проверка оплаты
+THROTTLE_EXPENSIVE_RATE = float(os.getenv("THROTTLE_EXPENSIVE_RATE", "0.2"))
+THROTTLE_EXPENSIVE_BURST = float(os.getenv("THROTTLE_EXPENSIVE_BURST", "3"))
+THROTTLE_EXPENSIVE_GLOBAL_RATE = float(os.getenv("THROTTLE_EXPENSIVE_GLOBAL_RATE", "20"))
+THROTTLE_EXPENSIVE_GLOBAL_BURST = float(os.getenv("THROTTLE_EXPENSIVE_GLOBAL_BURST", "40"))
+THROTTLE_IDLE_TTL = int(os.getenv("THROTTLE_IDLE_TTL", "600"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+
+# Планировщик исходящих сообщений Telegram (сообщений в секунду и запас); общая скорость 0 - отправка без очереди
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_GLOBAL_BURST = float(os.getenv("SEND_GLOBAL_BURST", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "5"))
+# В группах Telegram допускает около 20 сообщений в минуту
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_GROUP_BURST = float(os.getenv("SEND_GROUP_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+SEND_MAX_CHATS = int(os.getenv("SEND_MAX_CHATS", "100000"))
+SEND_DRAIN_TIMEOUT = float(os.getenv("SEND_DRAIN_TIMEOUT", "5"))
+# Предел длины объединенного уведомления администратору (Telegram допускает 4096 символов)
+ADMIN_MESSAGE_LIMIT = 4000
+
+# Рассылка /broadcast: сообщений в секунду, пользователей в порции, одновременных отправок
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "10"))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "100"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Как часто лидер проверяет, не запущена ли рассылка с другого воркера
+BROADCAST_POLL_INTERVAL = int(os.getenv("BROADCAST_POLL_INTERVAL", "10"))
+
+# Счетчики продаж для /stats: период сброса в хранилище и срок хранения почасовых корзин
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+STATS_HOURLY_RETENTION_DAYS = int(os.getenv("STATS_HOURLY_RETENTION_DAYS", "14"))
+
+# Кэш проверки получателей в Fragment: найденные, не найденные (могут появиться позже) и размер
+RECIPIENT_CACHE_TTL = int(os.getenv("RECIPIENT_CACHE_TTL", "3600"))
+RECIPIENT_NEGATIVE_TTL = int(os.getenv("RECIPIENT_NEGATIVE_TTL", "300"))
+RECIPIENT_CACHE_SIZE = int(os.getenv("RECIPIENT_CACHE_SIZE", "10000"))
+USERNAME_PATTERN = re.compile(r"[A-Za-z0-9_]{5,32}")
+
+# Подарок списком: число получателей в одном счете, параллельные запросы к Fragment, размер файла
+BULK_MAX_RECIPIENTS = int(os.getenv("BULK_MAX_RECIPIENTS", "100"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "5"))
+BULK_FILE_MAX_BYTES = int(os.getenv("BULK_FILE_MAX_BYTES", str(64 * 1024)))
 
 # Хранилище данных пользователей
 user_data_store = {}
 
-class FragmentAPIClient:
-    def __init__(self, api_key: str, telegram_token: Optional[str] = None, cryptobot_token: Optional[str] = None):
-        self.base_url = "https://api.fragment-api.com/v1"
-        self.api_key = api_key
-        self.telegram_token = telegram_token
-        self.cryptobot_token = cryptobot_token
-        self.session = requests.Session()
-        self.session.headers.update({
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "User-Agent": "FragmentBot/1.0"
-        })
-        self.auth_token: Optional[str] = None
-        self.MIN_STARS = 50
-        self.PRICE_PER_STAR = 1.45
-        self.ton_rate = 200
-        self.usdt_rate = 90
-        self.last_rate_update = 0
+_MISSING = object()
 
-    async def update_rates(self):
-        """Обновление курсов TON/RUB и USDT/RUB"""
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DELIVERY_LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render(self) -> List[str]:
+        value = self.value
+        if self.function:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.warning(f"Ошибка вычисления метрики {self.name}: {str(e)}")
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счетчики по корзинам..., сумма, количество]
+        self.values: Dict[tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {count}")
+                le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+UPSTREAM_LATENCY = metrics.register(Histogram(
+    "starbot_upstream_latency_seconds", "Длительность запросов к внешним API", ("upstream", "outcome")))
+UPSTREAM_RETRIES = metrics.register(Counter(
+    "starbot_upstream_retries_total", "Повторные попытки запросов к внешним API", ("upstream",)))
+UPSTREAM_ERRORS = metrics.register(Counter(
+    "starbot_upstream_errors_total", "Ошибки запросов к внешним API", ("upstream",)))
+UPSTREAM_DEADLINES = metrics.register(Counter(
+    "starbot_upstream_deadline_exceeded_total", "Запросы, не отправленные из-за истекшего срока", ("upstream",)))
+HANDLER_LATENCY = metrics.register(Histogram(
+    "starbot_handler_latency_seconds", "Длительность обработчиков Telegram", ("handler",)))
+HANDLER_ERRORS = metrics.register(Counter(
+    "starbot_handler_errors_total", "Необработанные ошибки в обработчиках", ("handler",)))
+PENDING_INVOICES = metrics.register(Gauge(
+    "starbot_pending_invoices", "Неоплаченные и необработанные счета"))
+DELIVERY_QUEUE = metrics.register(Gauge(
+    "starbot_delivery_inflight", "Проверки и доставки платежей в процессе"))
+RATE_AGE = metrics.register(Gauge(
+    "starbot_rate_age_seconds", "Возраст курсов активов"))
+PAID_TO_DELIVERED = metrics.register(Histogram(
+    "starbot_paid_to_delivered_seconds", "Задержка от оплаты до зачисления звезд", (), DELIVERY_LAG_BUCKETS))
+LOOP_LAG = metrics.register(Histogram(
+    "starbot_event_loop_lag_seconds", "Задержка пробуждения event loop"))
+PAYMENT_STAGE_LATENCY = metrics.register(Histogram(
+    "starbot_payment_stage_seconds", "Длительность этапов оплаты (при PAYMENT_TRACE=1)", ("stage",)))
+LOOP_BLOCKED = metrics.register(Counter(
+    "starbot_event_loop_blocked_seconds_total", "Время блокировки event loop по обработчикам", ("handler",)))
+THROTTLED = metrics.register(Counter(
+    "starbot_throttled_total", "Действия, отклоненные лимитом", ("kind", "scope")))
+RECONCILE_GAPS = metrics.register(Counter(
+    "starbot_reconcile_gaps_total", "Оплаченные счета без доставки, найденные сверкой", ("action",)))
+SEND_QUEUE = metrics.register(Gauge(
+    "starbot_send_queue", "Сообщения Telegram в очереди планировщика"))
+SEND_WAIT = metrics.register(Histogram(
+    "starbot_send_wait_seconds", "Ожидание сообщения в очереди планировщика", ("priority",)))
+RECIPIENT_LOOKUPS = metrics.register(Counter(
+    "starbot_recipient_lookups_total", "Проверки получателей: из кэша, запросом к Fragment, ожиданием чужого запроса",
+    ("result",)))
+CONFIG_RELOADS = metrics.register(Counter(
+    "starbot_config_reloads_total", "Перезагрузки файла настроек: применено или отклонено", ("result",)))
+SEND_EVENTS = metrics.register(Counter(
+    "starbot_send_events_total", "События планировщика: объединенные правки, retry_after, отказы", ("event",)))
+
+
+class upstream_timer:
+    """Замер запроса к внешнему API: with upstream_timer("cryptobot_create_invoice"): ..."""
+    def __init__(self, upstream: str):
+        self.upstream = upstream
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        finished = time.perf_counter()
+        outcome = "error" if exc_type else "ok"
+        UPSTREAM_LATENCY.observe(finished - self.started, self.upstream, outcome)
+        if exc_type:
+            UPSTREAM_ERRORS.inc(self.upstream)
+        trace = _payment_trace.get()
+        if trace:
+            trace.add(self.upstream, self.upstream.split("_", 1)[0], self.started, finished, exc_type is not None)
+        return False
+
+
+_payment_trace: contextvars.ContextVar = contextvars.ContextVar("payment_trace", default=None)
+
+
+class PaymentTrace:
+    """Этапы одной проверки оплаты. Завершается, когда закрыты корень и фоновые этапы"""
+    __slots__ = ("tracer", "payment_id", "source", "ts", "started", "finished", "spans", "open", "profile")
+
+    def __init__(self, tracer: "PaymentTracer", payment_id: Optional[str], source: str):
+        self.tracer = tracer
+        self.payment_id = payment_id
+        self.source = source
+        self.ts = time.time()
+        self.started = time.perf_counter()
+        self.finished = self.started
+        # (этап, внешний API или None, начало, конец, ошибка, фоновый); дописывается и из потоков пулов
+        self.spans: List[tuple] = []
+        self.open = 1
+        self.profile: Optional[cProfile.Profile] = None
+
+    def add(self, stage: str, upstream: Optional[str], started: float, finished: float, error: bool,
+            background: bool = False):
+        self.spans.append((stage, upstream, started, finished, error, background))
+
+    def release(self):
+        self.open -= 1
+        if self.open == 0:
+            self.tracer.finish(self)
+
+
+class payment_trace:
+    """Корень трассы оплаты: with payment_trace(tracer, payment_id, "check"): ..."""
+    def __init__(self, tracer: Optional["PaymentTracer"], payment_id: Optional[str], source: str):
+        self.tracer = tracer
+        self.payment_id = payment_id
+        self.source = source
+        self.trace: Optional[PaymentTrace] = None
+
+    def __enter__(self):
+        current = _payment_trace.get()
+        if current is not None:
+            # Вложенный корень только дописывает payment_id, если внешний открыт до того, как он стал известен
+            current.payment_id = current.payment_id or self.payment_id
+        elif self.tracer:
+            self.trace = PaymentTrace(self.tracer, self.payment_id, self.source)
+            self.token = _payment_trace.set(self.trace)
+            self.tracer.start_profile(self.trace)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace:
+            _payment_trace.reset(self.token)
+            self.trace.finished = time.perf_counter()
+            self.tracer.stop_profile(self.trace)
+            self.trace.release()
+        return False
+
+
+class trace_span:
+    """Этап внутри трассы оплаты: with trace_span("journal"): ...; вне трассы ничего не делает"""
+    def __init__(self, stage: str, upstream: Optional[str] = None):
+        self.stage = stage
+        self.upstream = upstream
+
+    def __enter__(self):
+        self.trace = _payment_trace.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace:
+            self.trace.add(self.stage, self.upstream, self.started, time.perf_counter(), exc_type is not None)
+        return False
+
+
+def trace_background(coro, stage: str):
+    """Фоновый этап (уведомление админа): трасса записывается после его завершения"""
+    trace = _payment_trace.get()
+    if trace is None:
+        return coro
+    trace.open += 1
+    started = time.perf_counter()
+
+    async def traced():
+        error = False
         try:
-            response = requests.get(
-                "https://api.coingecko.com/api/v3/simple/price?ids=the-open-network,tether&vs_currencies=rub", 
-                timeout=10
+            return await coro
+        except BaseException:
+            error = True
+            raise
+        finally:
+            trace.add(stage, None, started, time.perf_counter(), error, background=True)
+            trace.release()
+    return traced()
+
+
+_request_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+
+class request_deadline:
+    """Срок (time.monotonic) для запросов к внешним API внутри блока: with request_deadline(25): ..."""
+    def __init__(self, seconds: Optional[float]):
+        self.seconds = seconds
+
+    def __enter__(self):
+        # None снимает срок: доставка оплаченного заказа не обрывается из-за того, что пользователь устал ждать
+        deadline = None
+        if self.seconds is not None:
+            deadline = time.monotonic() + self.seconds
+            current = _request_deadline.get()
+            if current is not None:
+                deadline = min(deadline, current)
+        self.token = _request_deadline.set(deadline)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _request_deadline.reset(self.token)
+        return False
+
+
+def deadline_remaining() -> Optional[float]:
+    deadline = _request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def deadline_allows(seconds: float) -> bool:
+    """Хватит ли срока, чтобы подождать seconds и повторить запрос"""
+    remaining = deadline_remaining()
+    return remaining is None or remaining > seconds
+
+
+def timed_handler(name: str):
+    """Замер длительности и ошибок обработчика"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with request_deadline(USER_REQUEST_DEADLINE):
+                    return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def parse_paid_at(paid_at: Optional[str]) -> Optional[float]:
+    if not paid_at:
+        return None
+    try:
+        return datetime.fromisoformat(paid_at.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class LoopMonitor:
+    """Замер задержки event loop; при пропаже пульса отдельный поток снимает стек блокирующего вызова"""
+    # Обертки, которые не считаются обработчиком при разборе стека
+    SKIP_FRAMES = {"wrapper", "_drain", "run_inflight", "__exit__", "__enter__"}
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.offenders: Dict[str, Dict[str, Any]] = {}
+        self.max_lag = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self._sample())
+        self.thread = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self.thread.start()
+        logger.info(f"Мониторинг event loop включен (порог {self.threshold * 1000:.0f} мс)")
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self.heartbeat = now
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+
+    def _blame(self, frame) -> tuple:
+        """Обработчик (первая функция бота в текущем шаге задачи) и место блокировки (последняя)"""
+        module_file = __file__
+        handler, site = None, None
+        for summary in traceback.extract_stack(frame):
+            if summary.name == "_run" and os.path.basename(os.path.dirname(summary.filename)) == "asyncio":
+                # Шаг задачи начинается в Handle._run: все, что выше, - запуск бота (<module>, main)
+                handler, site = None, None
+                continue
+            if summary.filename != module_file or summary.name in self.SKIP_FRAMES:
+                continue
+            if handler is None:
+                handler = summary.name
+            site = f"{summary.name}:{summary.lineno}"
+        return handler or "unknown", site or "unknown"
+
+    def _watch(self):
+        stall_started = None
+        stall_handler = None
+        while not self.stopped.wait(self.threshold / 2):
+            stalled_for = time.monotonic() - self.heartbeat - self.interval
+            if stalled_for > self.threshold and stall_started is None:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is None:
+                    continue
+                stall_started = self.heartbeat
+                stall_handler, site = self._blame(frame)
+                stack = "".join(traceback.format_stack(frame)[-8:])
+                logger.warning(
+                    f"Event loop заблокирован дольше {self.threshold * 1000:.0f} мс: "
+                    f"{stall_handler} ({site})\n{stack}"
+                )
+                entry = self.offenders.setdefault(stall_handler, {'count': 0, 'total': 0.0, 'max': 0.0, 'site': site})
+                entry['count'] += 1
+                entry['site'] = site
+            elif stall_started is not None and self.heartbeat != stall_started:
+                duration = max(0.0, self.heartbeat - stall_started - self.interval)
+                entry = self.offenders[stall_handler]
+                entry['total'] += duration
+                entry['max'] = max(entry['max'], duration)
+                LOOP_BLOCKED.inc(stall_handler, amount=duration)
+                stall_started = None
+
+    def report(self, top: int = 10) -> str:
+        worst = sorted(self.offenders.items(), key=lambda item: item[1]['total'], reverse=True)[:top]
+        lines = [f"Макс. задержка цикла: {self.max_lag * 1000:.0f} мс"]
+        for handler, entry in worst:
+            lines.append(
+                f"{handler}: {entry['count']} блокировок, всего {entry['total']:.2f} с, "
+                f"макс. {entry['max'] * 1000:.0f} мс ({entry['site']})"
             )
-            data = response.json()
-            
-            ton_rate = data.get('the-open-network', {}).get('rub', self.ton_rate)
-            usdt_rate = data.get('tether', {}).get('rub', self.usdt_rate)
-            
-            if ton_rate and ton_rate != self.ton_rate:
-                logger.info(f"Обновлен курс TON: {self.ton_rate} -> {ton_rate} RUB")
-                self.ton_rate = ton_rate
-                
-            if usdt_rate and usdt_rate != self.usdt_rate:
-                logger.info(f"Обновлен курс USDT: {self.usdt_rate} -> {usdt_rate} RUB")
-                self.usdt_rate = usdt_rate
-                
-            self.last_rate_update = time.time()
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка при обновлении курсов: {str(e)}")
-            return False
+        return "\n".join(lines)
 
-    def get_ton_rate(self):
-        if time.time() - self.last_rate_update > 3600:
-            asyncio.create_task(self.update_rates())
-        return self.ton_rate
 
-    def get_usdt_rate(self):
-        if time.time() - self.last_rate_update > 3600:
-            asyncio.create_task(self.update_rates())
-        return self.usdt_rate
+def approx_size(obj, sample: int = MEM_SIZE_SAMPLE, depth: int = 4) -> int:
+    """Примерный размер объекта в байтах вместе с содержимым"""
+    size = sys.getsizeof(obj)
+    if depth <= 0 or isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if hasattr(obj, "items"):
+        items = list(itertools.islice(obj.items(), sample))
+        measured = sum(approx_size(k, sample, depth - 1) + approx_size(v, sample, depth - 1) for k, v in items)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        items = list(itertools.islice(obj, sample))
+        measured = sum(approx_size(item, sample, depth - 1) for item in items)
+    elif hasattr(obj, "__slots__"):
+        return size + sum(approx_size(getattr(obj, name, None), sample, depth - 1) for name in obj.__slots__)
+    elif hasattr(obj, "__dict__"):
+        return size + approx_size(vars(obj), sample, depth - 1)
+    else:
+        return size
+    if not items:
+        return size
+    # Первые sample элементов на всю длину; общие объекты считаются в каждом контейнере - оценка скорее завышена
+    return size + measured * len(obj) // len(items)
 
-    def authenticate(self, phone_number: str, mnemonics: list[str]) -> bool:
-        endpoint = f"{self.base_url}/auth/authenticate/"
-        payload = {
-            "api_key": self.api_key,
-            "phone_number": phone_number,
-            "mnemonics": mnemonics
+
+def format_bytes(size: float) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+class MemoryInspector:
+    """Диагностика памяти для /mem: размеры структур бота и разница снимков tracemalloc"""
+    def __init__(self, bot: "StarBot", frames: int = MEM_TRACE_FRAMES, top: int = MEM_TOP):
+        self.bot = bot
+        self.frames = frames
+        self.top = top
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.previous_at = 0.0
+
+    @staticmethod
+    def rss() -> str:
+        try:
+            with open("/proc/self/status", encoding="ascii") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+            return f"RSS {fields['VmRSS'].strip()}, пик {fields['VmHWM'].strip()}"
+        except (OSError, KeyError):
+            import resource
+            return f"пик RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} kB"
+
+    def structures(self) -> Dict[str, Any]:
+        bot = self.bot
+        structures = {
+            "user_data_store": bot.user_data_store,
+            "pending_payments": bot.pending_payments,
+            "processing_payments": bot.processing_payments,
+            "promocodes": bot.promocodes,
+            "invoice_cache": bot.invoice_cache,
+            "media.file_ids": bot.media.file_ids,
+            "recipients.cache": bot.recipients.cache,
+            "stats.pending": bot.stats.pending,
+            "admin_outbox": bot.admin_outbox,
+            "lifecycle.inflight": bot.lifecycle.inflight
         }
+        for kind, throttle in bot.throttles.items():
+            structures[f"throttle.{kind}"] = throttle.users
+        if bot.journal:
+            structures["journal.states"] = bot.journal.states
+        application = bot.application
+        if application:
+            structures["ptb.user_data"] = application.user_data
+            structures["ptb.chat_data"] = application.chat_data
+            scheduler = getattr(application.bot, "rate_limiter", None)
+            if isinstance(scheduler, SendScheduler):
+                structures["send.chats"] = scheduler.chats
+                structures["send.queues"] = scheduler.queues
+                structures["send.edits"] = scheduler.edits
+        return structures
 
-        for attempt in range(MAX_RETRIES):
+    def structures_report(self) -> List[str]:
+        """Число записей и примерный размер; данные в SQLite только считаются"""
+        rows = []
+        for name, value in self.structures().items():
+            if isinstance(value, StoreMapping):
+                rows.append((0, f"{name}: {len(value)} записей (в SQLite)"))
+                continue
+            count = sum(len(queue) for queue in value) if name == "send.queues" else len(value)
+            size = approx_size(value)
+            rows.append((size, f"{name}: {count} записей, ~{format_bytes(size)}"))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return [self.rss()] + [line for _, line in rows]
+
+    def _snapshot(self) -> List[str]:
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Отслежено {format_bytes(current)}, пик {format_bytes(peak)}, "
+            f"расход tracemalloc {format_bytes(tracemalloc.get_tracemalloc_memory())}"
+        ]
+        if self.previous:
+            lines.append(f"Прирост за {time.time() - self.previous_at:.0f} с:")
+            for stat in snapshot.compare_to(self.previous, "lineno")[:self.top]:
+                lines.append(
+                    f"{self._site(stat.traceback)}: {'+' if stat.size_diff >= 0 else '-'}"
+                    f"{format_bytes(abs(stat.size_diff))} ({stat.count_diff:+d} блоков), "
+                    f"всего {format_bytes(stat.size)}"
+                )
+        else:
+            lines.append("Крупнейшие места выделения:")
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                lines.append(f"{self._site(stat.traceback)}: {format_bytes(stat.size)} ({stat.count} блоков)")
+        self.previous = snapshot
+        self.previous_at = time.time()
+        return lines
+
+    @staticmethod
+    def _site(trace: tracemalloc.Traceback) -> str:
+        frame = trace[0]
+        return f"{os.path.join(*frame.filename.split(os.sep)[-2:])}:{frame.lineno}"
+
+    async def trace(self) -> List[str]:
+        """Первый вызов включает трассировку, следующие снимают снимок и сравнивают с прошлым"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = None
+            logger.info("tracemalloc включен командой /mem")
+            return ["Трассировка включена. Повторите /mem trace, чтобы снять первый снимок."]
+        # Снимок и сравнение занимают сотни миллисекунд на большом процессе
+        return await asyncio.to_thread(self._snapshot)
+
+    def stop(self) -> str:
+        if not tracemalloc.is_tracing():
+            return "Трассировка не включена."
+        tracemalloc.stop()
+        self.previous = None
+        logger.info("tracemalloc выключен командой /mem")
+        return "Трассировка выключена, снимки удалены."
+
+
+class PaymentTracer:
+    """Трассировка пути оплаты по этапам и внешним API, выборочно под cProfile"""
+    def __init__(self, path: Optional[str] = PAYMENT_TRACE_FILE, profile_rate: float = PAYMENT_PROFILE_RATE,
+                 slow: float = PAYMENT_PROFILE_SLOW, profile_dir: str = PAYMENT_PROFILE_DIR,
+                 keep: int = PAYMENT_TRACE_KEEP):
+        self.path = path
+        self.profile_rate = profile_rate
+        self.slow = slow
+        self.profile_dir = profile_dir
+        self.recent: deque = deque(maxlen=keep)
+        # Одновременно активен только один cProfile
+        self.profiling = False
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8", buffering=1) if path else None
+        self.traces = 0
+        self.profiles = 0
+
+    def start_profile(self, trace: PaymentTrace):
+        if self.profiling or random.random() >= self.profile_rate:
+            return
+        # cProfile видит только поток event loop, в том числе чужие обработчики
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Профилировщик уже включен снаружи
+            return
+        self.profiling = True
+        trace.profile = profile
+
+    def stop_profile(self, trace: PaymentTrace):
+        if trace.profile:
+            trace.profile.disable()
+            self.profiling = False
+
+    def finish(self, trace: PaymentTrace):
+        spans = sorted(list(trace.spans), key=lambda span: span[2])
+        if not any(span[0] == "process_payment" for span in spans):
+            # Проверка неоплаченного счета - не путь оплаты
+            return
+        # Общее время - до ответа пользователю; фоновые этапы показаны, но в него не входят
+        total = trace.finished - trace.started
+        record = {
+            "ts": round(trace.ts, 3),
+            "payment_id": trace.payment_id,
+            "source": trace.source,
+            "total_ms": round(total * 1000, 1),
+            "spans": [
+                {
+                    "stage": stage, "upstream": upstream,
+                    "start_ms": round((started - trace.started) * 1000, 1),
+                    "ms": round((ended - started) * 1000, 1),
+                    **({"error": True} if error else {}),
+                    **({"background": True} if background else {})
+                } for stage, upstream, started, ended, error, background in spans
+            ]
+        }
+        for stage, _, started, ended, _, _ in spans:
+            PAYMENT_STAGE_LATENCY.observe(ended - started, stage)
+        self.recent.append(record)
+        self.traces += 1
+        if self.file:
+            with self.lock:
+                self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if trace.profile and total >= self.slow:
+            path = os.path.join(self.profile_dir, f"{trace.payment_id}-{int(trace.ts)}.prof")
+            threading.Thread(target=self._dump_profile, args=(trace.profile, path, total), daemon=True).start()
+
+    def _dump_profile(self, profile: cProfile.Profile, path: str, total: float):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile.dump_stats(path)
+            self.profiles += 1
+            logger.info(f"Профиль медленной оплаты ({total:.2f} с) сохранен: {path}")
+        except OSError as e:
+            logger.error(f"Не удалось сохранить профиль оплаты: {str(e)}")
+
+    def report(self) -> List[str]:
+        return summarize_traces(list(self.recent))
+
+    def close(self):
+        if self.file:
+            with self.lock:
+                self.file.close()
+        logger.info(f"Трассы оплат: {self.traces}, профилей медленных оплат: {self.profiles}")
+
+
+class MetricsServer:
+    """HTTP endpoint /metrics в текстовом формате Prometheus"""
+    def __init__(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.listen = listen
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+        logger.info(f"Метрики доступны на {self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+class SqliteStore:
+    """Общее хранилище состояния для нескольких процессов бота"""
+    def __init__(self, path: str = SHARED_STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def mapping(self, namespace: str) -> "StoreMapping":
+        return StoreMapping(self, namespace)
+
+    def get(self, namespace: str, key: Any, default: Any = None) -> Any:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, json.dumps(key))
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key: Any, value: Any):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, json.dumps(key), json.dumps(value))
+            )
+
+    def insert_if_absent(self, namespace: str, key: Any, value: Any):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, json.dumps(key), json.dumps(value))
+            )
+
+    def delete(self, namespace: str, key: Any) -> bool:
+        with self.lock:
+            cursor = self.conn.execute(
+                "DELETE FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, json.dumps(key))
+            )
+        return cursor.rowcount > 0
+
+    def items(self, namespace: str) -> List[tuple]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM kv WHERE namespace = ? ORDER BY key", (namespace,)
+            ).fetchall()
+        return [(json.loads(k), json.loads(v)) for k, v in rows]
+
+    def page(self, namespace: str, after: Any, limit: int) -> List[tuple]:
+        """Порция пар по возрастанию ключа, начиная после after (None - с начала)"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM kv WHERE namespace = ? AND key > ? ORDER BY key LIMIT ?",
+                (namespace, "" if after is None else json.dumps(after), limit)
+            ).fetchall()
+        return [(json.loads(k), json.loads(v)) for k, v in rows]
+
+    def count(self, namespace: str) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM kv WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    def atomic_update(self, namespace: str, key: Any, fn: Callable[[Any], tuple]) -> Any:
+        """Чтение-изменение-запись под эксклюзивной транзакцией. fn(value) -> (результат, новое значение или None)"""
+        encoded_key = json.dumps(key)
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
             try:
-                logger.info(f"Попытка аутентификации #{attempt + 1}")
-                response = self.session.post(endpoint, json=payload, timeout=60)
-                logger.info(f"Ответ API: {response.status_code}, {response.text}")
-                
-                response.raise_for_status()
-                data = response.json()
-                self.auth_token = data.get("token")
-                
-                if self.auth_token:
-                    logger.info("Аутентификация успешна")
-                    return True
-                
-                logger.error("Токен не получен в ответе")
-                return False
-                
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Ошибка аутентификации: {str(e)}")
-                if attempt < MAX_RETRIES - 1:
-                    logger.warning(f"Повтор через {RETRY_DELAY} сек...")
-                    time.sleep(RETRY_DELAY)
-                    continue
-                logger.error(f"Ошибка аутентификации после {MAX_RETRIES} попыток")
-                return False
+                row = self.conn.execute(
+                    "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, encoded_key)
+                ).fetchone()
+                result, new_value = fn(json.loads(row[0]) if row else None)
+                if new_value is not None:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                        (namespace, encoded_key, json.dumps(new_value))
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return result
 
-    def send_stars(self, username: str, quantity: int) -> Dict[str, Any]:
-        if not self.auth_token:
-            logger.error("Токен аутентификации отсутствует")
-            return {"error": "Требуется аутентификация"}
+    def try_acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Захват или продление аренды лидера. True, если аренда принадлежит owner"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now)
+            )
+            row = self.conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return bool(row and row[0] == owner)
+
+    def release_lease(self, name: str, owner: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+class StoreMapping(MutableMapping):
+    """Словарь поверх пространства имен SqliteStore"""
+    def __init__(self, store: SqliteStore, namespace: str):
+        self.store = store
+        self.namespace = namespace
+
+    def __getitem__(self, key):
+        value = self.store.get(self.namespace, key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store.set(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        if not self.store.delete(self.namespace, key):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter([key for key, _ in self.store.items(self.namespace)])
+
+    def __len__(self):
+        return self.store.count(self.namespace)
+
+    def __contains__(self, key):
+        return self.store.get(self.namespace, key, _MISSING) is not _MISSING
+
+    def items(self):
+        return self.store.items(self.namespace)
+
+    def pop(self, key, default=None):
+        value = self.store.get(self.namespace, key, default)
+        self.store.delete(self.namespace, key)
+        return value
+
+    def atomic_update(self, key, fn: Callable[[Any], tuple]) -> Any:
+        return self.store.atomic_update(self.namespace, key, fn)
+
+
+class SqliteUserDataPersistence(BasePersistence):
+    """Хранение context.user_data в SQLite с отложенной пакетной записью и удалением старых диалогов"""
+    def __init__(self, store: SqliteStore, ttl: int = CONVERSATION_TTL,
+                 update_interval: float = USER_DATA_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+        self.ttl = ttl
+        self.last_seen: Dict[int, float] = {}
+        self._dirty: Dict[int, tuple] = {}
+        self._dropped = set()
+        self._commit_task: Optional[asyncio.Task] = None
+        with store.lock:
+            store.conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_data ("
+                "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _updated_at(self, user_ids: List[int]) -> Dict[int, float]:
+        updated = {}
+        with self.store.lock:
+            for start in range(0, len(user_ids), 500):
+                batch = user_ids[start:start + 500]
+                updated.update(self.store.conn.execute(
+                    f"SELECT user_id, updated_at FROM user_data WHERE user_id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+        return updated
+
+    async def expired_user_ids(self) -> List[int]:
+        deadline = time.time() - self.ttl
+        candidates = [user_id for user_id, seen in self.last_seen.items() if seen < deadline]
+        if not candidates:
+            return []
+        # Диалог мог продолжиться на другом воркере: решает время из общей таблицы
+        for user_id, updated_at in (await asyncio.to_thread(self._updated_at, candidates)).items():
+            if updated_at >= deadline and user_id in self.last_seen:
+                self.last_seen[user_id] = max(self.last_seen[user_id], updated_at)
+        return [user_id for user_id in candidates if self.last_seen.get(user_id, time.time()) < deadline]
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        def load():
+            with self.store.lock:
+                self.store.conn.execute("DELETE FROM user_data WHERE updated_at < ?", (time.time() - self.ttl,))
+                return self.store.conn.execute("SELECT user_id, data, updated_at FROM user_data").fetchall()
         
-        endpoint = f"{self.base_url}/order/stars/"
+        rows = await asyncio.to_thread(load)
+        user_data = {}
+        for user_id, data, updated_at in rows:
+            user_data[user_id] = json.loads(data)
+            self.last_seen[user_id] = updated_at
+        logger.info(f"Загружено состояние диалогов: {len(user_data)}")
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        now = time.time()
+        self.last_seen[user_id] = now
+        self._dropped.discard(user_id)
+        self._dirty[user_id] = (data, now)
+        # Все изменения одного прохода update_persistence пишутся одной транзакцией
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit())
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.last_seen.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        self._dropped.add(user_id)
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit())
+
+    async def _commit(self):
+        dirty, self._dirty = self._dirty, {}
+        dropped, self._dropped = self._dropped, set()
+        if not dirty and not dropped:
+            return
         
-        payload = {
-            "username": username,
-            "quantity": quantity
-        }
+        def write():
+            with self.store.lock:
+                self.store.conn.execute("BEGIN")
+                try:
+                    self.store.conn.executemany(
+                        "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                        [(user_id, json.dumps(data), updated_at) for user_id, (data, updated_at) in dirty.items()]
+                    )
+                    self.store.conn.executemany(
+                        "DELETE FROM user_data WHERE user_id = ?", [(user_id,) for user_id in dropped]
+                    )
+                    self.store.conn.execute("COMMIT")
+                except Exception:
+                    self.store.conn.execute("ROLLBACK")
+                    raise
+        
+        try:
+            await asyncio.to_thread(write)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния диалогов: {str(e)}")
+            for user_id, entry in dirty.items():
+                self._dirty.setdefault(user_id, entry)
+            self._dropped |= dropped
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._commit_task:
+            await asyncio.gather(self._commit_task, return_exceptions=True)
+        await self._commit()
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]) -> None:
+        pass
+
+
+def atomic_update(mapping, key, fn: Callable[[Any], tuple]) -> Any:
+    """Атомарно изменяет значение по ключу в словаре или общем хранилище"""
+    if isinstance(mapping, StoreMapping):
+        return mapping.atomic_update(key, fn)
+    result, new_value = fn(mapping.get(key))
+    if new_value is not None:
+        mapping[key] = new_value
+    return result
+
+def mapping_page(mapping, after: Any, limit: int) -> List[tuple]:
+    """Порция (ключ, значение) из словаря или общего хранилища в порядке ключей хранилища"""
+    if isinstance(mapping, StoreMapping):
+        return mapping.store.page(mapping.namespace, after, limit)
+    start = "" if after is None else json.dumps(after)
+    keys = sorted((k for k in mapping if json.dumps(k) > start), key=json.dumps)[:limit]
+    return [(k, mapping[k]) for k in keys]
+
+class MediaCache:
+    """file_id уже загруженных фото, чтобы Telegram не скачивал их по URL каждый раз"""
+    def __init__(self, store: Optional[SqliteStore] = None):
+        self.store = store
+        self.file_ids: Dict[str, str] = {}
+
+    def load(self):
+        if self.store:
+            self.file_ids.update(dict(self.store.items("media")))
+
+    def get(self, url: str) -> str:
+        return self.file_ids.get(url, url)
+
+    def remember(self, url: str, message: Optional[Message]):
+        if url in self.file_ids or not isinstance(message, Message) or not message.photo:
+            return
+        self.file_ids[url] = message.photo[-1].file_id
+        if self.store:
+            self.store.set("media", url, self.file_ids[url])
+
+    def forget(self, url: str):
+        self.file_ids.pop(url, None)
+        if self.store:
+            self.store.delete("media", url)
+
+    async def warm_up(self, tg_bot: Bot, chat_id: Optional[str], urls: List[str]):
+        missing = [url for url in urls if url not in self.file_ids]
+        if not chat_id or not missing:
+            return
+        
+        async def upload(url: str):
+            try:
+                message = await tg_bot.send_photo(chat_id=chat_id, photo=url, disable_notification=True)
+                self.remember(url, message)
+                await message.delete()
+            except Exception as e:
+                logger.warning(f"Не удалось прогреть фото {url}: {str(e)}")
+        
+        await asyncio.gather(*(upload(url) for url in missing))
+
+class TrafficRecorder:
+    """Запись обновлений и ответов внешних API для replay.py; персональные данные заменяются стабильными псевдонимами"""
+    NAME_KEYS = {"first_name", "last_name", "title"}
+    # comment - произвольный текст покупателя к счету CryptoBot, hidden_message и payload повторяют заказ
+    DROP_KEYS = {"phone_number", "caption", "caption_entities", "comment", "hidden_message", "payload"}
+    SECRET_KEYS = {"token", "auth_token"}
+    ID_PARENTS = {"from", "chat", "user", "sender_chat"}
+    USERNAME_RE = re.compile(r"@(\w{5,32})")
+
+    def __init__(self, path: str, salt: Optional[str] = TRAFFIC_RECORD_SALT, keep_words=()):
+        self.path = path
+        self.salt = salt or os.urandom(8).hex()
+        # Слова, которые сохраняются как есть (промокоды)
+        self.keep_words = keep_words
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        self.events = 0
+
+    def _digest(self, value: str) -> str:
+        return hashlib.sha256(f"{self.salt}:{value}".encode()).hexdigest()
+
+    def pseudo_username(self, username: str) -> str:
+        """Псевдоним той же длины, чтобы проходили проверки длины username"""
+        if not username:
+            return username
+        return ("u" + self._digest(username.lower()))[:max(len(username), 5)]
+
+    def pseudo_id(self, value: int) -> int:
+        pseudo = int(self._digest(str(abs(value)))[:10], 16)
+        return -pseudo if value < 0 else pseudo
+
+    def redact_text(self, text: str) -> str:
+        stripped = text.strip()
+        if not stripped or stripped.startswith("/") or stripped.isdigit() or stripped.upper() in self.keep_words:
+            return text
+        prefix = "@" if stripped.startswith("@") else ""
+        return prefix + self.pseudo_username(stripped.lstrip("@"))
+
+    def redact(self, value: Any, parent: str = "") -> Any:
+        if isinstance(value, dict):
+            result = {}
+            for key, item in value.items():
+                if key in self.DROP_KEYS:
+                    continue
+                if key in self.NAME_KEYS:
+                    result[key] = "User"
+                elif key in self.SECRET_KEYS:
+                    result[key] = "[REDACTED]"
+                elif key == "username" and isinstance(item, str):
+                    result[key] = self.pseudo_username(item)
+                elif key == "id" and parent in self.ID_PARENTS and isinstance(item, int):
+                    result[key] = self.pseudo_id(item)
+                elif key == "text" and isinstance(item, str):
+                    result[key] = self.redact_text(item)
+                else:
+                    result[key] = self.redact(item, key)
+            return result
+        if isinstance(value, list):
+            return [self.redact(item, parent) for item in value]
+        if isinstance(value, str):
+            return self.USERNAME_RE.sub(lambda m: "@" + self.pseudo_username(m.group(1)), value)
+        return value
+
+    def _write(self, event: Dict[str, Any]):
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.events += 1
+
+    def record_update(self, data: Dict[str, Any]):
+        self._write({"ts": round(time.time(), 3), "ev": "update", "data": self.redact(data)})
+
+    def record_upstream(self, name: str, key: Optional[str], status: int, body: Any):
+        if key is not None and name in ("fragment_order_stars", "fragment_user_lookup"):
+            key = self.pseudo_username(key)
+        self._write({
+            "ts": round(time.time(), 3), "ev": "upstream", "name": name,
+            "key": key, "status": status, "data": self.redact(body)
+        })
+
+    async def on_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            self.record_update(update.to_dict())
+        except Exception as e:
+            logger.error(f"Ошибка записи трафика: {str(e)}")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(f"Записано событий трафика: {self.events} ({self.path})")
+
+def worker_file(path: str, worker_id: int) -> str:
+    """Отдельный файл на воркер, если их несколько"""
+    if BOT_WORKERS <= 1:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}.worker{worker_id}{ext}"
+
+class OrderJournal:
+    """Журнал событий заказов (created, paid, attempted, delivered, failed, expired): дозапись, fsync пачками"""
+    TERMINAL = {"delivered", "failed", "expired"}
+    # Порядок событий заказа: из записей разных журналов берется самое позднее
+    PROGRESS = {"created": 0, "paid": 1, "attempted": 2, "delivered": 3, "failed": 3, "expired": 3}
+
+    def __init__(self, path: str, commit_delay: float = JOURNAL_COMMIT_DELAY):
+        self.path = path
+        self.commit_delay = commit_delay
+        # Последнее событие по каждому заказу
+        self.states: Dict[str, str] = {}
+        self.cond = threading.Condition()
+        self.queue: List[tuple] = []
+        self.closed = False
+        self.file = None
+        self.thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.records = 0
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """Состояние заказов по журналу; оборванная при сбое последняя строка пропускается"""
+        orders: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Пропущена поврежденная запись журнала заказов: {line[:100]}")
+                        continue
+                    order = orders.setdefault(event["id"], {})
+                    order.update(event.get("data", {}))
+                    order["state"] = event["ev"]
+                    order["ts"] = event["ts"]
+        states = {payment_id: order["state"] for payment_id, order in orders.items()}
+        # События, добавленные после открытия журнала, новее прочитанных
+        states.update(self.states)
+        self.states = states
+        return orders
+
+    def compact(self, retention: float = JOURNAL_RETENTION) -> int:
+        """Переписывает журнал без заказов, завершенных раньше retention секунд назад; возвращает их число"""
+        if not os.path.exists(self.path):
+            return 0
+        lines: Dict[str, List[bytes]] = {}
+        last: Dict[str, tuple] = {}
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                lines.setdefault(event["id"], []).append(line.rstrip(b"\n") + b"\n")
+                last[event["id"]] = (event["ev"], event["ts"])
+        deadline = time.time() - retention
+        finished = {payment_id for payment_id, (ev, ts) in last.items() if ev in self.TERMINAL and ts < deadline}
+        kept = b"".join(line for payment_id, group in lines.items() if payment_id not in finished for line in group)
+        if not finished:
+            return 0
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(kept)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        logger.info(f"Журнал заказов сжат: убрано завершенных заказов {len(finished)}")
+        return len(finished)
+
+    def open(self):
+        self.compact()
+        self.file = open(self.path, "a", encoding="utf-8")
+        if self.file.tell() and not self._ends_with_newline():
+            # Оборванную при сбое строку нельзя склеивать с новой записью
+            self.file.write("\n")
+        self.thread = threading.Thread(target=self._run, name="order-journal", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def read_states(path: str, position: Optional[tuple], states: Dict[str, str]) -> Optional[tuple]:
+        """Дочитывает журнал с позиции (inode, offset) (только целые строки), возвращает новую позицию"""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return position
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            # Сжатие заменяет файл: позиция в прежнем файле к новому не относится
+            offset = position[1] if position and position[0] == inode else 0
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                states[event["id"]] = event["ev"]
+        return inode, offset
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append(self, event: str, payment_id: str, **data) -> asyncio.Future:
+        """Ставит запись в очередь; future завершается после fsync"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        record = {"ts": round(time.time(), 3), "ev": event, "id": payment_id}
+        if data:
+            record["data"] = data
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        # Запись без ожидания ("paid") не оставляет непрочитанное исключение: ошибку логирует поток журнала
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self.states[payment_id] = event
+        with self.cond:
+            self.queue.append((line, future, loop))
+            self.cond.notify()
+        return future
+
+    async def write(self, event: str, payment_id: str, **data):
+        await self.append(event, payment_id, **data)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self.cond:
+                batch, self.queue = self.queue, []
+            error = None
+            try:
+                self.file.write("".join(line for line, _, _ in batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                error = e
+                logger.error(f"Ошибка записи журнала заказов: {str(e)}")
+            self.batches += 1
+            self.records += len(batch)
+            for _, future, loop in batch:
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(self._resolve, future, error)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, error: Optional[Exception]):
+        if future.done():
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+        if self.file:
+            self.file.close()
+        logger.info(f"Журнал заказов: {self.records} записей за {self.batches} fsync")
+
+class OrderIndex:
+    """Индекс заказов в SQLite по журналам всех воркеров: поиск по счету, покупателю, получателю и дате"""
+    SCHEMA = (
+        # state - из самого позднего события: события заказа приходят из журналов разных воркеров в любом порядке
+        "CREATE TABLE IF NOT EXISTS orders ("
+        "payment_id TEXT PRIMARY KEY, user_id INTEGER, sender_username TEXT COLLATE NOCASE, "
+        "recipient TEXT, recipients INTEGER, stars INTEGER, currency TEXT, amount_rub REAL, "
+        "amount_crypto REAL, promo_code TEXT, state TEXT, error TEXT, paid_at REAL, "
+        "created_at REAL, updated_at REAL NOT NULL)",
+        # Выборки по (поле, created_at, payment_id) с курсором: время ответа не зависит от объема истории и номера страницы
+        "CREATE INDEX IF NOT EXISTS orders_by_user ON orders (user_id, created_at, payment_id)",
+        "CREATE INDEX IF NOT EXISTS orders_by_username ON orders (sender_username, created_at, payment_id)",
+        "CREATE INDEX IF NOT EXISTS orders_by_date ON orders (created_at, payment_id)",
+        # Получатели отдельно: у заказа списком их до BULK_MAX_RECIPIENTS
+        "CREATE TABLE IF NOT EXISTS order_recipients ("
+        "recipient TEXT COLLATE NOCASE NOT NULL, created_at REAL NOT NULL, payment_id TEXT NOT NULL, "
+        "PRIMARY KEY (recipient, created_at, payment_id)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS order_events ("
+        "payment_id TEXT NOT NULL, ts REAL NOT NULL, ev TEXT NOT NULL, data TEXT)",
+        "CREATE INDEX IF NOT EXISTS order_events_by_order ON order_events (payment_id, ts)",
+        # inode отличает сжатый журнал от прежнего файла с тем же путем
+        "CREATE TABLE IF NOT EXISTS journal_offsets (path TEXT PRIMARY KEY, offset INTEGER NOT NULL, inode INTEGER)"
+    )
+    BATCH = 5000
+    COLUMNS = ("payment_id", "user_id", "sender_username", "recipient", "recipients", "stars", "currency",
+               "amount_rub", "amount_crypto", "promo_code", "state", "error", "paid_at", "created_at", "updated_at")
+
+    def __init__(self, path: str = ORDER_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        if "inode" not in [column[1] for column in self.conn.execute("PRAGMA table_info(journal_offsets)")]:
+            self.conn.execute("ALTER TABLE journal_offsets ADD COLUMN inode INTEGER")
+        # Заказы, проиндексированные без created_at, давали в поиске курсор "None:<id>"
+        self.conn.execute(
+            "UPDATE orders SET created_at = (SELECT MIN(ts) FROM order_events WHERE order_events.payment_id = orders.payment_id) "
+            "WHERE created_at IS NULL"
+        )
+        # Чтение через отдельное соединение не ждет синхронизацию журналов (WAL)
+        self.read_lock = threading.Lock()
+        self.reader = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+
+    def close(self):
+        # Синхронизация могла остаться в потоке после отмены задачи
+        with self.lock, self.read_lock:
+            self.conn.close()
+            self.reader.close()
+
+    def sync(self, paths: List[str]) -> int:
+        """Дочитывает журналы и переносит новые события в индекс; возвращает их число"""
+        total = 0
+        for path in paths:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                inode = os.fstat(f.fileno()).st_ino
+                with self.lock:
+                    row = self.conn.execute(
+                        "SELECT offset, inode FROM journal_offsets WHERE path = ?", (path,)
+                    ).fetchone()
+                # Журнал заменен сжатием (или позиция записана без inode): читается заново, повторы событий пропускаются
+                offset = row[0] if row and row[1] == inode else 0
+                f.seek(offset)
+                while True:
+                    # Первая синхронизация большого журнала идет пачками, а не одной транзакцией
+                    lines = [line for line in itertools.islice(f, self.BATCH) if line.endswith(b"\n")]
+                    if not lines:
+                        break
+                    offset += sum(len(line) for line in lines)
+                    self._commit(path, inode, offset, lines)
+                    total += len(lines)
+        return total
+
+    def _commit(self, path: str, inode: int, offset: int, lines: List[bytes]):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for line in lines:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(event)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO journal_offsets (path, offset, inode) VALUES (?, ?, ?)", (path, offset, inode)
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _apply(self, event: Dict[str, Any]):
+        payment_id, ts, ev = event["id"], event["ts"], event["ev"]
+        data = event.get("data") or {}
+        self.conn.execute(
+            "INSERT INTO order_events (payment_id, ts, ev, data) SELECT ?, ?, ?, ? WHERE NOT EXISTS "
+            "(SELECT 1 FROM order_events WHERE payment_id = ? AND ts = ? AND ev = ?)",
+            (payment_id, ts, ev, json.dumps({k: v for k, v in data.items() if k != "payment"}, ensure_ascii=False)
+             if data else None, payment_id, ts, ev)
+        )
+        if ev == "created" and "payment" in data:
+            payment = data["payment"]
+            recipients = payment.get("recipients") or []
+            self.conn.execute(
+                "INSERT INTO orders (payment_id, user_id, sender_username, recipient, recipients, stars, currency, "
+                "amount_rub, amount_crypto, promo_code, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'created', ?, ?) "
+                "ON CONFLICT (payment_id) DO UPDATE SET user_id = excluded.user_id, "
+                "sender_username = excluded.sender_username, recipient = excluded.recipient, "
+                "recipients = excluded.recipients, stars = excluded.stars, currency = excluded.currency, "
+                "amount_rub = excluded.amount_rub, amount_crypto = excluded.amount_crypto, "
+                "promo_code = excluded.promo_code, created_at = excluded.created_at",
+                (payment_id, payment.get("user_id"), payment.get("sender_username"), payment.get("recipient"),
+                 len(recipients) or None, payment.get("stars_amount"), payment.get("currency"),
+                 payment.get("amount_rub"), payment.get("amount_crypto"), payment.get("promo_code"), ts, ts)
+            )
+            # Покупка себе (recipient пуст) ищется и по имени покупателя как получателя
+            names = [username for username, _ in recipients] or [payment.get("recipient") or payment.get("sender_username")]
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO order_recipients (recipient, created_at, payment_id) VALUES (?, ?, ?)",
+                [(name, ts, payment_id) for name in names if name]
+            )
+            return
+        # created_at - время первого увиденного события: "created" мог остаться в журнале другого воркера
+        self.conn.execute(
+            "INSERT INTO orders (payment_id, state, error, paid_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (payment_id) DO UPDATE SET created_at = MIN(COALESCE(orders.created_at, excluded.created_at), "
+            "excluded.created_at), "
+            "state = CASE WHEN excluded.updated_at >= orders.updated_at THEN excluded.state ELSE orders.state END, "
+            "error = COALESCE(excluded.error, orders.error), paid_at = COALESCE(excluded.paid_at, orders.paid_at), "
+            "updated_at = MAX(orders.updated_at, excluded.updated_at)",
+            (payment_id, ev, data.get("error"), data.get("paid_at") or (ts if ev == "paid" else None), ts, ts)
+        )
+
+    def _rows(self, sql: str, params: tuple) -> List[Dict[str, Any]]:
+        with self.read_lock:
+            rows = self.reader.execute(sql, params).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def get(self, payment_id: str) -> Optional[Dict[str, Any]]:
+        """Заказ с историей событий и списком получателей"""
+        rows = self._rows(f"SELECT {', '.join(self.COLUMNS)} FROM orders WHERE payment_id = ?", (payment_id,))
+        if not rows:
+            return None
+        order = rows[0]
+        with self.read_lock:
+            events = self.reader.execute(
+                "SELECT ts, ev, data FROM order_events WHERE payment_id = ? ORDER BY ts", (payment_id,)
+            ).fetchall()
+            if order["recipients"]:
+                order["recipient_list"] = [row[0] for row in self.reader.execute(
+                    "SELECT recipient FROM order_recipients WHERE payment_id = ? ORDER BY recipient", (payment_id,)
+                )]
+        order["events"] = [
+            {"ts": ts, "ev": ev, **({"data": json.loads(data)} if data else {})} for ts, ev, data in events
+        ]
+        return order
+
+    def search(self, user_id: Optional[int] = None, username: Optional[str] = None,
+               recipient: Optional[str] = None, state: Optional[str] = None,
+               since: Optional[float] = None, until: Optional[float] = None,
+               limit: int = ADMIN_API_PAGE_SIZE, cursor: Optional[tuple] = None) -> tuple:
+        """Заказы от новых к старым и курсор (created_at, payment_id) следующей страницы; None - страниц больше нет"""
+        table = "o"
+        sql = f"SELECT {', '.join('o.' + column for column in self.COLUMNS)} FROM orders o"
+        conditions, params = [], []
+        if recipient:
+            # Поиск по получателю идет по таблице получателей, сортировка - по ее ключу
+            sql += " JOIN order_recipients r ON r.payment_id = o.payment_id"
+            table = "r"
+            conditions.append("r.recipient = ?")
+            params.append(recipient.lstrip("@"))
+        if user_id is not None:
+            conditions.append("o.user_id = ?")
+            params.append(user_id)
+        if username:
+            conditions.append("o.sender_username = ?")
+            params.append(username.lstrip("@"))
+        if state:
+            conditions.append("o.state = ?")
+            params.append(state)
+        if since is not None:
+            conditions.append(f"{table}.created_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append(f"{table}.created_at < ?")
+            params.append(until)
+        if cursor:
+            conditions.append(f"({table}.created_at, {table}.payment_id) < (?, ?)")
+            params.extend(cursor)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {table}.created_at DESC, {table}.payment_id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        orders = self._rows(sql, tuple(params))
+        if len(orders) <= limit:
+            return orders, None
+        orders = orders[:limit]
+        return orders, (orders[-1]["created_at"], orders[-1]["payment_id"])
+
+    async def run(self, paths: List[str], interval: float = ORDER_INDEX_INTERVAL):
+        while True:
+            try:
+                count = await asyncio.to_thread(self.sync, paths)
+                if count:
+                    logger.debug(f"Индекс заказов: добавлено событий {count}")
+            except Exception as e:
+                logger.error(f"Ошибка обновления индекса заказов: {str(e)}", exc_info=True)
+            await asyncio.sleep(interval)
+
+
+class AdminApiServer:
+    """HTTP API поиска заказов для поддержки, только чтение"""
+    def __init__(self, index: OrderIndex, listen: str = ADMIN_API_LISTEN, port: int = ADMIN_API_PORT,
+                 token: Optional[str] = ADMIN_API_TOKEN):
+        self.index = index
+        self.listen = listen
+        self.port = port
+        self.token = token
+        self.runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    def _time(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+
+    @staticmethod
+    def _cursor(value: Optional[str]) -> Optional[tuple]:
+        if not value:
+            return None
+        created_at, payment_id = value.split(":", 1)
+        return float(created_at), payment_id
+
+    @web.middleware
+    async def authorize(self, request: web.Request, handler):
+        if self.token and not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {self.token}"
+        ):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        return await handler(request)
+
+    async def handle_order(self, request: web.Request) -> web.Response:
+        order = await asyncio.to_thread(self.index.get, request.match_info["payment_id"])
+        if order is None:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.json_response({"order": order}, dumps=functools.partial(json.dumps, ensure_ascii=False))
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        query = request.query
+        try:
+            user_id = int(query["user_id"]) if query.get("user_id") else None
+            limit = min(int(query.get("limit", ADMIN_API_PAGE_SIZE)), ADMIN_API_MAX_PAGE_SIZE)
+            since, until = self._time(query.get("since")), self._time(query.get("until"))
+            cursor = self._cursor(query.get("cursor"))
+        except ValueError as e:
+            return web.json_response({"error": f"bad parameter: {e}"}, status=400)
+        if limit < 1:
+            return web.json_response({"error": "bad parameter: limit"}, status=400)
+
+        orders, next_cursor = await asyncio.to_thread(
+            self.index.search, user_id=user_id, username=query.get("username"),
+            recipient=query.get("recipient"), state=query.get("state"),
+            since=since, until=until, limit=limit, cursor=cursor
+        )
+        return web.json_response({
+            "orders": orders,
+            "next_cursor": f"{next_cursor[0]!r}:{next_cursor[1]}" if next_cursor else None
+        }, dumps=functools.partial(json.dumps, ensure_ascii=False))
+
+    async def start(self):
+        if not self.token:
+            logger.warning("ADMIN_API_TOKEN не задан: API заказов доступно без авторизации")
+        app = web.Application(middlewares=[self.authorize])
+        # ?user_id=&username=&recipient=&state=&since=&until=&limit=&cursor=; since/until - unix-время или ISO 8601
+        app.router.add_get("/orders", self.handle_search)
+        # Заказ с историей событий
+        app.router.add_get("/orders/{payment_id}", self.handle_order)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+        logger.info(f"API заказов доступно на {self.listen}:{self.port}/orders")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+class BotConfig:
+    """Снимок настроек магазина. После создания не меняется: перезагрузка подменяет снимок целиком"""
+    __slots__ = ("price_per_star", "min_stars", "max_stars", "photos", "assets", "promocodes", "version")
+
+    def __init__(self, data: Dict[str, Any], version: int = 0):
+        self.version = version
+        self.price_per_star = data["price_per_star"]
+        self.min_stars = data["min_stars"]
+        self.max_stars = data["max_stars"]
+        self.photos = dict(data["photos"])
+        self.assets = {code: dict(asset) for code, asset in data["assets"].items()}
+        self.promocodes = {code.upper(): dict(promo) for code, promo in data["promocodes"].items()}
+        self.validate()
+
+    @classmethod
+    def load(cls, path: str, version: int = 0) -> "BotConfig":
+        """Значения по умолчанию с разделами из файла; нет файла - только значения по умолчанию"""
+        data = dict(DEFAULT_CONFIG)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                overrides = json.load(f)
+            if not isinstance(overrides, dict):
+                raise ValueError("файл настроек должен содержать JSON-объект")
+            unknown = set(overrides) - set(DEFAULT_CONFIG)
+            if unknown:
+                raise ValueError(f"неизвестные параметры: {', '.join(sorted(unknown))}")
+            for section in ("photos", "assets", "promocodes"):
+                value = overrides.get(section, {})
+                if not isinstance(value, dict):
+                    raise ValueError(f"{section}: нужен JSON-объект")
+                if section != "photos" and not all(isinstance(item, dict) for item in value.values()):
+                    raise ValueError(f"{section}: каждый элемент должен быть JSON-объектом")
+            data.update(overrides)
+            # Фото можно переопределить по одному, остальные разделы задаются целиком
+            data["photos"] = {**PHOTO_URLS, **overrides.get("photos", {})}
+        return cls(data, version)
+
+    def validate(self):
+        def number(value) -> bool:
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+        if not number(self.price_per_star) or self.price_per_star <= 0:
+            raise ValueError("price_per_star должен быть положительным числом")
+        if not all(isinstance(value, int) and not isinstance(value, bool) for value in (self.min_stars, self.max_stars)) \
+                or not 1 <= self.min_stars <= self.max_stars:
+            raise ValueError("min_stars и max_stars - целые числа, 1 <= min_stars <= max_stars")
+        for name in PHOTO_URLS:
+            if not isinstance(self.photos.get(name), str) or not self.photos[name]:
+                raise ValueError(f"photos.{name}: нужна строка с URL или file_id")
+        if not self.assets:
+            raise ValueError("assets: нужен хотя бы один актив")
+        for code, asset in self.assets.items():
+            if not re.fullmatch(r"[A-Z0-9]{2,10}", code):
+                raise ValueError(f"assets.{code}: код актива CryptoBot в верхнем регистре")
+            if not isinstance(asset.get("coingecko_id"), str) or not isinstance(asset.get("button"), str):
+                raise ValueError(f"assets.{code}: нужны coingecko_id и button")
+            if not number(asset.get("min_amount")) or asset["min_amount"] <= 0:
+                raise ValueError(f"assets.{code}.min_amount должен быть положительным числом")
+            if not number(asset.get("rate")) or asset["rate"] <= 0:
+                raise ValueError(f"assets.{code}.rate должен быть положительным числом")
+        for code, promo in self.promocodes.items():
+            discount, activations = promo.get("discount"), promo.get("activations")
+            if not isinstance(discount, int) or not 1 <= discount <= 99:
+                raise ValueError(f"promocodes.{code}.discount - целое от 1 до 99")
+            if not isinstance(activations, int) or activations < 0:
+                raise ValueError(f"promocodes.{code}.activations - целое не меньше 0")
+
+
+class ConfigWatcher:
+    """Перезагрузка настроек при изменении файла; ошибка в файле оставляет в работе прежние настройки"""
+    def __init__(self, path: str = BOT_CONFIG_FILE, interval: float = CONFIG_POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.signature = self._signature()
+        # Ошибка в файле при запуске не дает стартовать с неожиданными ценами
+        self.current = BotConfig.load(path)
+        self.listeners: List[Callable[[BotConfig], None]] = []
+
+    def _signature(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self) -> bool:
+        signature = self._signature()
+        # Удаленный файл не сбрасывает настройки к значениям по умолчанию
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        try:
+            config = BotConfig.load(self.path, self.current.version + 1)
+        except Exception as e:
+            CONFIG_RELOADS.inc("rejected")
+            logger.error(f"Настройки из {self.path} не применены, работают прежние: {str(e)}")
+            return False
+        
+        self.current = config
+        for listener in self.listeners:
+            try:
+                listener(config)
+            except Exception as e:
+                logger.error(f"Ошибка применения настроек: {str(e)}", exc_info=True)
+        CONFIG_RELOADS.inc("applied")
+        logger.info(f"Настройки из {self.path} применены (версия {config.version})")
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Ошибка проверки настроек: {str(e)}", exc_info=True)
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """Срок запроса истек до отправки: повторять бессмысленно"""
+
+
+class Upstream:
+    """Свой пул соединений и потоков у каждого внешнего API: медленный Fragment не занимает ресурсы CryptoBot"""
+    def __init__(self, name: str, pool_size: int, read_timeout: float, total_timeout: float,
+                 connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "User-Agent": "FragmentBot/1.0"
+        })
+        # pool_block: лишние запросы ждут свободное соединение, а не открывают новые
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=f"upstream-{name}")
+
+    def timeout(self, read_timeout: Optional[float] = None) -> tuple:
+        budget = self.total_timeout
+        remaining = deadline_remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                UPSTREAM_DEADLINES.inc(self.name)
+                raise DeadlineExceeded(f"{self.name}: срок запроса истек")
+            budget = min(budget, remaining)
+        return min(self.connect_timeout, budget), min(read_timeout or self.read_timeout, budget)
+
+    def get(self, url: str, read_timeout: Optional[float] = None, **kwargs):
+        return self.session.get(url, timeout=self.timeout(read_timeout), **kwargs)
+
+    def post(self, url: str, read_timeout: Optional[float] = None, **kwargs):
+        return self.session.post(url, timeout=self.timeout(read_timeout), **kwargs)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Синхронный вызов клиента в пуле потоков этого API; срок запроса переходит в поток"""
+        context = contextvars.copy_context()
+        if _payment_trace.get() is not None:
+            fn = functools.partial(self._traced_call, time.perf_counter(), fn)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, fn, *args, **kwargs)
+        )
+
+    def _traced_call(self, submitted: float, fn: Callable, *args, **kwargs):
+        """Ожидание свободного потока пула попадает в трассу оплаты отдельным этапом"""
+        _payment_trace.get().add(f"{self.name}_pool_wait", None, submitted, time.perf_counter(), False)
+        return fn(*args, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+class FragmentAPIClient:
+    def __init__(self, api_key: str, telegram_token: Optional[str] = None, cryptobot_token: Optional[str] = None):
+        self.base_url = FRAGMENT_API_URL
+        self.api_key = api_key
+        self.telegram_token = telegram_token
+        self.cryptobot_token = cryptobot_token
+        self.fragment = Upstream("fragment", *UPSTREAM_POOLS["fragment"])
+        self.cryptobot = Upstream("cryptobot", *UPSTREAM_POOLS["cryptobot"])
+        self.coingecko = Upstream("coingecko", *UPSTREAM_POOLS["coingecko"])
+        self.telegram = Upstream("telegram", *UPSTREAM_POOLS["telegram"])
+        self.upstreams = [self.fragment, self.cryptobot, self.coingecko, self.telegram]
+        self.auth_token: Optional[str] = None
+        self.config = BotConfig(DEFAULT_CONFIG)
+        # Код актива -> курс к рублю
+        self.rates: Dict[str, float] = {}
+        self.apply_config(self.config)
+        self.last_rate_update = 0
+        # Версия котировки: меняется при каждом изменении курсов
+        self.rates_version = 0
+        self.recorder: Optional[TrafficRecorder] = None
+
+    def use_session(self, session):
+        """Один сеанс для всех API: заглушки в бенчмарках и при воспроизведении записи"""
+        for upstream in self.upstreams:
+            upstream.session = session
+
+    def close(self):
+        for upstream in self.upstreams:
+            upstream.close()
+
+    def _record(self, name: str, key: Optional[str], response):
+        if not self.recorder:
+            return
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+        self.recorder.record_upstream(name, key, response.status_code, body)
+
+    def apply_config(self, config: BotConfig) -> bool:
+        """Переход на новые настройки; True, если изменился набор курсов для обновления"""
+        previous = {asset["coingecko_id"] for asset in self.config.assets.values()}
+        self.config = config
+        for code, asset in config.assets.items():
+            self.rates.setdefault(code, asset["rate"])
+        return previous != {asset["coingecko_id"] for asset in config.assets.values()}
+
+    async def update_rates(self):
+        """Обновление курсов активов к рублю"""
+        ids = ",".join(sorted({asset["coingecko_id"] for asset in self.config.assets.values()}))
+        try:
+            with upstream_timer("coingecko"):
+                response = await self.coingecko.run(
+                    self.coingecko.get, f"{COINGECKO_API_URL}/simple/price?ids={ids}&vs_currencies=rub"
+                )
+            self._record("coingecko", None, response)
+            self.apply_rates(response.json())
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении курсов: {str(e)}")
+            return False
+
+    def apply_rates(self, data: Dict[str, Any]):
+        """Применяет ответ CoinGecko"""
+        for code, asset in self.config.assets.items():
+            rate = data.get(asset["coingecko_id"], {}).get('rub')
+            if rate and rate != self.rates.get(code):
+                logger.info(f"Обновлен курс {code}: {self.rates.get(code)} -> {rate} RUB")
+                self.rates[code] = rate
+                self.rates_version += 1
+            
+        self.last_rate_update = time.time()
+
+    def get_rate(self, asset: str) -> float:
+        if time.time() - self.last_rate_update > 3600:
+            try:
+                asyncio.get_running_loop().create_task(self.update_rates())
+            except RuntimeError:
+                # Вызов из пула потоков: курс обновит следующий вызов из event loop
+                pass
+        return self.rates[asset]
+
+    def authenticate(self, phone_number: str, mnemonics: list[str]) -> bool:
+        endpoint = f"{self.base_url}/auth/authenticate/"
+        payload = {
+            "api_key": self.api_key,
+            "phone_number": phone_number,
+            "mnemonics": mnemonics
+        }
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                logger.info(f"Попытка аутентификации #{attempt + 1}")
+                with upstream_timer("fragment_auth"):
+                    response = self.fragment.post(endpoint, json=payload)
+                self._record("fragment_auth", None, response)
+                logger.info(f"Ответ API: {response.status_code}, {response.text}", extra={"payload": True})
+
+                response.raise_for_status()
+                data = response.json()
+                self.auth_token = data.get("token")
+                
+                if self.auth_token:
+                    logger.info("Аутентификация успешна")
+                    return True
+                
+                logger.error("Токен не получен в ответе")
+                return False
+                
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Ошибка аутентификации: {str(e)}")
+                if attempt < MAX_RETRIES - 1 and deadline_allows(RETRY_DELAY):
+                    UPSTREAM_RETRIES.inc("fragment_auth")
+                    logger.warning(f"Повтор через {RETRY_DELAY} сек...")
+                    time.sleep(RETRY_DELAY)
+                    continue
+                logger.error(f"Ошибка аутентификации после {attempt + 1} попыток")
+                return False
+
+    def send_stars(self, username: str, quantity: int) -> Dict[str, Any]:
+        if not self.auth_token:
+            logger.error("Токен аутентификации отсутствует")
+            return {"error": "Требуется аутентификация"}
+        
+        endpoint = f"{self.base_url}/order/stars/"
+        
+        payload = {
+            "username": username,
+            "quantity": quantity
+        }
+
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"JWT {self.auth_token}"
+        }
+
+        try:
+            logger.info(f"Отправка звезд: {payload}", extra={"payload": True})
+            logger.debug(f"Заголовки запроса: {headers}")
+            
+            with upstream_timer("fragment_order_stars"):
+                response = self.fragment.post(endpoint, headers=headers, json=payload)
+            self._record("fragment_order_stars", username, response)
+            logger.info(f"Ответ API: {response.status_code}, {response.text}", extra={"payload": True})
+            
+            if response.status_code == 403:
+                logger.warning("Обнаружена 403 ошибка, пробуем переаутентификацию")
+                if self.authenticate(PHONE_NUMBER, MNEMONICS):
+                    headers["Authorization"] = f"JWT {self.auth_token}"
+                    logger.info("Повторная отправка запроса с новым токеном")
+                    UPSTREAM_RETRIES.inc("fragment_order_stars")
+                    with upstream_timer("fragment_order_stars"):
+                        response = self.fragment.post(endpoint, headers=headers, json=payload)
+                    self._record("fragment_order_stars", username, response)
+                    logger.info(
+                        f"Ответ API после повторной аутентификации: {response.status_code}, {response.text}",
+                        extra={"payload": True}
+                    )
+            
+            if response.status_code == 200:
+                result = response.json()
+                return {"success": True, "data": result}
+            else:
+                UPSTREAM_ERRORS.inc("fragment_order_stars")
+                error_msg = f"Ошибка {response.status_code}"
+                try:
+                    error_data = response.json()
+                    if 'detail' in error_data:
+                        error_msg += f": {error_data['detail']}"
+                    elif 'error' in error_data:
+                        error_msg += f": {error_data['error']}"
+                except:
+                    error_msg += f": {response.text[:100]}"
+                return {"error": error_msg}
+                
+        except requests.exceptions.RequestException as e:
+            error_msg = f"Ошибка запроса: {str(e)}"
+            logger.error(error_msg)
+            return {"error": error_msg}
+
+    def create_cryptobot_invoice(
+        self,
+        stars_amount: int,
+        asset: str = "TON",
+        recipient: Optional[str] = None,
+        description: str = "Покупка звезд",
+        hidden_message: Optional[str] = None,
+        paid_btn_name: Optional[str] = None,
+        paid_btn_url: Optional[str] = None,
+        payload: Optional[str] = None,
+        allow_comments: bool = True,
+        allow_anonymous: bool = True,
+        discount_percent: int = 0,
+        expires_in: int = INVOICE_TTL,
+        config: Optional[BotConfig] = None
+    ) -> Dict[str, Any]:
+        if not self.cryptobot_token:
+            raise ValueError("Требуется токен CryptoBot")
+        
+        config = config or self.config
+        if stars_amount < config.min_stars:
+            raise ValueError(f"Минимальное количество звезд для покупки: {config.min_stars}")
+        if asset not in config.assets:
+            raise ValueError(f"Неподдерживаемая валюта: {asset}")
+
+        amount_rub = stars_amount * config.price_per_star * (1 - discount_percent / 100)
+        amount_asset = amount_rub / self.get_rate(asset)
+        
+        min_amount = config.assets[asset]["min_amount"]
+        if amount_asset < min_amount:
+            raise ValueError(f"Сумма платежа слишком мала: {amount_asset:.6f} {asset}. Минимум {min_amount} {asset}.")
+        
+        endpoint = f"{CRYPTOBOT_API_URL}/createInvoice"
+        headers = {"Crypto-Pay-API-Token": self.cryptobot_token}
+        
+        formatted_amount = f"{amount_asset:.9f}".rstrip('0').rstrip('.')
+        if formatted_amount == '':
+            formatted_amount = '0'
+        
+        desc = f"{description} ({stars_amount} звезд)"
+        if discount_percent > 0:
+            desc += f" со скидкой {discount_percent}%"
+        if recipient:
+            desc += f" для @{recipient}"
+            
+        payload_data = {
+            "asset": asset,
+            "amount": formatted_amount,
+            "description": desc,
+            "hidden_message": hidden_message or f"Спасибо за покупку {stars_amount} звезд!" + (f" для @{recipient}" if recipient else ""),
+            "paid_btn_name": paid_btn_name or "openBot",
+            "paid_btn_url": paid_btn_url or "https://t.me/WhiteBearStars_bot",
+            "payload": payload or f"stars_{stars_amount}",
+            "allow_comments": allow_comments,
+            "allow_anonymous": allow_anonymous,
+            "expires_in": expires_in
+        }
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                logger.info(f"Отправка запроса в CryptoBot: {payload_data}", extra={"payload": True})
+                with upstream_timer("cryptobot_create_invoice"):
+                    response = self.cryptobot.post(endpoint, json=payload_data, headers=headers)
+                self._record("cryptobot_create_invoice", None, response)
+                logger.info(f"Ответ CryptoBot: {response.status_code}, {response.text}", extra={"payload": True})
+                
+                response.raise_for_status()
+                data = response.json()
+                
+                if not data.get('ok'):
+                    error_msg = data.get('error', 'Неизвестная ошибка CryptoBot')
+                    logger.error(f"Ошибка CryptoBot: {error_msg}")
+                    return {"error": error_msg}
+                
+                return data
+            except requests.exceptions.RequestException as e:
+                if attempt < MAX_RETRIES - 1 and deadline_allows(RETRY_DELAY):
+                    UPSTREAM_RETRIES.inc("cryptobot_create_invoice")
+                    logger.warning(f"Ошибка создания инвойса, повтор #{attempt+1}: {str(e)}")
+                    time.sleep(RETRY_DELAY)
+                    continue
+                error_msg = f"Ошибка создания инвойса: {str(e)}"
+                logger.error(error_msg)
+                return {"error": error_msg}
+
+    def check_recipient(self, username: str) -> Optional[bool]:
+        """Может ли Fragment отправить звезды пользователю; None - проверить не удалось"""
+        if not self.auth_token:
+            return None
+        endpoint = f"{self.base_url}/misc/user/{username}/"
+        headers = {
+            "Accept": "application/json",
+            "Authorization": f"JWT {self.auth_token}"
+        }
+        
+        try:
+            with upstream_timer("fragment_user_lookup"):
+                response = self.fragment.get(endpoint, headers=headers, read_timeout=10)
+            self._record("fragment_user_lookup", username, response)
+            
+            if response.status_code == 403 and self.authenticate(PHONE_NUMBER, MNEMONICS):
+                headers["Authorization"] = f"JWT {self.auth_token}"
+                UPSTREAM_RETRIES.inc("fragment_user_lookup")
+                with upstream_timer("fragment_user_lookup"):
+                    response = self.fragment.get(endpoint, headers=headers, read_timeout=10)
+                self._record("fragment_user_lookup", username, response)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Не удалось проверить получателя @{username}: {str(e)}")
+            return None
+        
+        if response.status_code == 200:
+            return True
+        if response.status_code in (400, 404):
+            # 404 отдает и прокси, и неверный путь: отказ только при явном ответе "пользователь не найден"
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+            if isinstance(body, dict):
+                body = " ".join(str(body.get(key, "")) for key in ("detail", "error", "message"))
+            detail = body.lower() if isinstance(body, str) else ""
+            if "user" in detail and "not found" in detail:
+                return False
+        UPSTREAM_ERRORS.inc("fragment_user_lookup")
+        logger.warning(f"Проверка получателя @{username}: ответ {response.status_code}")
+        return None
+
+    def get_invoices(self, invoice_ids: Optional[str] = None, status: Optional[str] = None,
+                     offset: int = 0, count: int = 100) -> Dict[str, Any]:
+        """Счета CryptoBot: по списку id через запятую или страница истории по статусу"""
+        endpoint = f"{CRYPTOBOT_API_URL}/getInvoices"
+        headers = {"Crypto-Pay-API-Token": self.cryptobot_token}
+        if invoice_ids is not None:
+            params = {"invoice_ids": invoice_ids}
+        else:
+            params = {"status": status, "offset": offset, "count": count}
+        with upstream_timer("cryptobot_get_invoices"):
+            response = self.cryptobot.get(endpoint, params=params, headers=headers)
+            self._record("cryptobot_get_invoices", invoice_ids, response)
+            response.raise_for_status()
+        return response.json()
+
+    def _notify_admin(self, message: str) -> bool:
+        if not self.telegram_token:
+            logger.warning("Telegram токен не указан")
+            return False
+
+        endpoint = f"{TELEGRAM_API_URL}{self.telegram_token}/sendMessage"
+        payload = {
+            "chat_id": ADMIN_CHAT_ID,
+            "text": message,
+            "parse_mode": "HTML"
+        }
+
+        for attempt in range(MAX_RETRIES):
+            try:
+                with upstream_timer("telegram_notify_admin"):
+                    response = self.telegram.post(endpoint, json=payload)
+                    response.raise_for_status()
+                return True
+            except Exception as e:
+                if attempt < MAX_RETRIES - 1 and deadline_allows(RETRY_DELAY):
+                    UPSTREAM_RETRIES.inc("telegram_notify_admin")
+                    logger.warning(f"Ошибка уведомления админа, повтор #{attempt+1}: {str(e)}")
+                    time.sleep(RETRY_DELAY)
+                    continue
+                logger.error(f"Ошибка уведомления админа: {str(e)}")
+                return False
+
+class RecipientValidator:
+    """Проверка получателя звезд в Fragment до выставления счета"""
+    def __init__(self, client: "FragmentAPIClient", ttl: int = RECIPIENT_CACHE_TTL,
+                 negative_ttl: int = RECIPIENT_NEGATIVE_TTL, max_size: int = RECIPIENT_CACHE_SIZE):
+        self.client = client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # username -> (найден ли, monotonic-время устаревания)
+        self.cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    async def validate(self, username: str) -> Optional[bool]:
+        key = username.lower()
+        cached = self.cache.get(key)
+        if cached:
+            if cached[1] > time.monotonic():
+                self.cache.move_to_end(key)
+                RECIPIENT_LOOKUPS.inc("cached")
+                return cached[0]
+            del self.cache[key]
+        
+        lookup = self.inflight.get(key)
+        if lookup is None:
+            RECIPIENT_LOOKUPS.inc("upstream")
+            lookup = self.inflight[key] = asyncio.ensure_future(self._lookup(key))
+            lookup.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            RECIPIENT_LOOKUPS.inc("coalesced")
+        # Отмена одного обработчика не прерывает запрос, который ждут другие
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, key: str) -> Optional[bool]:
+        found = await self.client.fragment.run(self.client.check_recipient, key)
+        if found is not None:
+            self.cache[key] = (found, time.monotonic() + (self.ttl if found else self.negative_ttl))
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return found
+
+    async def validate_many(self, usernames: List[str], concurrency: int = BULK_CONCURRENCY) -> List[Optional[bool]]:
+        """Проверка списка имен, не более concurrency запросов к Fragment одновременно"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def validate_one(username: str) -> Optional[bool]:
+            async with semaphore:
+                return await self.validate(username)
+
+        return await asyncio.gather(*(validate_one(username) for username in usernames))
+
+
+def parse_bulk_recipients(text: str, min_stars: int, max_stars: int) -> Tuple[List[list], List[str]]:
+    """Разбирает список подарка: строка "username количество", разделители - пробелы, запятая или ;.
+
+    Повторы одного имени складываются. Возвращает [[username, количество], ...]
+    в порядке первого упоминания и описания ошибочных строк.
+    """
+    totals: Dict[str, list] = {}
+    errors = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [part for part in re.split(r"[\s,;]+", line) if part]
+        if len(parts) != 2 or not parts[1].isdigit():
+            # Заголовок CSV ("username,quantity")
+            if number == 1 and len(parts) == 2:
+                continue
+            errors.append(f"строка {number}: нужен формат «username количество»")
+            continue
+        username = parts[0].lstrip("@")
+        if not USERNAME_PATTERN.fullmatch(username):
+            errors.append(f"строка {number}: некорректный username")
+            continue
+        entry = totals.setdefault(username.lower(), [username, 0])
+        entry[1] += int(parts[1])
+    
+    recipients = list(totals.values())
+    for username, quantity in recipients:
+        if not min_stars <= quantity <= max_stars:
+            errors.append(f"@{username}: от {min_stars} до {max_stars} звезд на получателя")
+    return recipients, errors
+
+
+def format_recipients(recipients: List[list], limit: int = 10) -> str:
+    lines = [f"• @{username} — {quantity}" for username, quantity in recipients[:limit]]
+    if len(recipients) > limit:
+        lines.append(f"… и еще {len(recipients) - limit}")
+    return "\n".join(lines)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "warned")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.warned = False
+
+    def take(self, now: float, cost: float = 1.0) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def wait_time(self, now: float, cost: float = 1.0) -> float:
+        """Через сколько секунд take() будет успешным; токены не расходуются"""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    @classmethod
+    def shared(cls, rate: float, capacity: float, now: float) -> "TokenBucket":
+        """Общий лимит всех воркеров: каждому достается своя доля скорости"""
+        return cls(rate / max(BOT_WORKERS, 1), capacity, now)
+
+
+def evict_idle(buckets: "OrderedDict[Any, TokenBucket]", now: float, max_size: int, idle_ttl: float = 0.0):
+    """Вытесняет с начала OrderedDict (порядок обращений) простаивающие корзины и лишние сверх max_size"""
+    while len(buckets) > 1:
+        oldest = next(iter(buckets.values()))
+        # Корзина, простоявшая дольше времени наполнения, и так полна - ее удаление ничего не меняет
+        if now - oldest.updated < max(idle_ttl, oldest.capacity / oldest.rate) and len(buckets) <= max_size:
+            break
+        buckets.popitem(last=False)
+
+
+class Throttle:
+    """Лимит одного класса действий: корзина на пользователя и общая корзина"""
+    def __init__(self, kind: str, rate: float, burst: float, global_rate: float, global_burst: float,
+                 idle_ttl: int = THROTTLE_IDLE_TTL, max_users: int = THROTTLE_MAX_USERS):
+        self.kind = kind
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = idle_ttl
+        self.max_users = max_users
+        self.users: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self.global_bucket = TokenBucket.shared(global_rate, global_burst, time.monotonic())
+
+    def allow(self, user_id: int) -> tuple:
+        """(разрешено, нужно ли предупредить пользователя)"""
+        if self.rate <= 0:
+            return True, False
+        now = time.monotonic()
+        bucket = self.users.get(user_id)
+        if bucket is None:
+            bucket = self.users[user_id] = TokenBucket(self.rate, self.burst, now)
+            evict_idle(self.users, now, self.max_users, self.idle_ttl)
+        else:
+            self.users.move_to_end(user_id)
+
+        if not bucket.take(now):
+            THROTTLED.inc(self.kind, "user")
+        elif self.global_bucket.rate > 0 and not self.global_bucket.take(now):
+            bucket.tokens += 1
+            THROTTLED.inc(self.kind, "global")
+        else:
+            bucket.warned = False
+            return True, False
+
+        warn = not bucket.warned
+        bucket.warned = True
+        return False, warn
+
+
+PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+PRIORITY_NAMES = ("critical", "normal", "low")
+_send_priority: contextvars.ContextVar = contextvars.ContextVar("send_priority", default=PRIORITY_NORMAL)
+
+
+class send_priority:
+    """Приоритет сообщений, отправленных внутри блока: with send_priority(PRIORITY_CRITICAL): ..."""
+    def __init__(self, priority: int):
+        self.priority = priority
+
+    def __enter__(self):
+        self.token = _send_priority.set(self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _send_priority.reset(self.token)
+        return False
+
+
+class SendJob:
+    __slots__ = ("priority", "chat_id", "merge_key", "callback", "args", "kwargs",
+                 "futures", "attempts", "queued_at", "newer", "outcome")
+
+    def __init__(self, priority: int, chat_id, merge_key: Optional[tuple], callback, args, kwargs, now: float):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.merge_key = merge_key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.attempts = 0
+        self.queued_at = now
+        # Правка того же сообщения, поставленная, пока эта отправлялась
+        self.newer: Optional["SendJob"] = None
+        # (результат, ошибка) после завершения
+        self.outcome: Optional[tuple] = None
+
+
+class SendScheduler(BaseRateLimiter):
+    """Очередь исходящих сообщений Telegram с приоритетами, общим лимитом и лимитом чата"""
+    # Остальные методы Bot API (ответы на кнопки, удаление) идут без очереди
+    LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, global_burst: float = SEND_GLOBAL_BURST,
+                 chat_rate: float = SEND_CHAT_RATE, chat_burst: float = SEND_CHAT_BURST,
+                 group_rate: float = SEND_GROUP_RATE, group_burst: float = SEND_GROUP_BURST,
+                 max_retries: int = SEND_MAX_RETRIES, max_chats: int = SEND_MAX_CHATS):
+        now = time.monotonic()
+        self.global_bucket = TokenBucket.shared(global_rate, global_burst, now)
+        self.chat_limits = (chat_rate, chat_burst)
+        self.group_limits = (group_rate, group_burst)
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.chats: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self.edits: Dict[tuple, SendJob] = {}
+        # Правки, которые сейчас отправляются
+        self.sending: Dict[tuple, SendJob] = {}
+        self.paused_until = 0.0
+        self.inflight = set()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def initialize(self):
+        # PTB вызывает initialize и для приложения, и для Updater с тем же ботом
+        if self.task:
+            return
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if not self.task:
+            return
+        deadline = time.monotonic() + SEND_DRAIN_TIMEOUT
+        while (self.depth() or self.inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        
+        dropped = 0
+        for queue in self.queues:
+            while queue:
+                dropped += 1
+                self._finish(queue.popleft(), error=RuntimeError("Бот остановлен до отправки сообщения"))
+        if dropped:
+            SEND_EVENTS.inc("dropped", amount=dropped)
+            logger.warning(f"Не отправлено сообщений при остановке: {dropped}")
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(self.LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+        
+        priority = (rate_limit_args or {}).get("priority", _send_priority.get())
+        merge_key = None
+        if endpoint.startswith("edit"):
+            merge_key = (endpoint, data.get("chat_id"), data.get("message_id"), data.get("inline_message_id"))
+        
+        previous = self.edits.get(merge_key) if merge_key else None
+        if previous:
+            # Правка еще в очереди: отправится новый текст на ее месте
+            previous.callback, previous.args, previous.kwargs = callback, args, kwargs
+            future = asyncio.get_running_loop().create_future()
+            previous.futures.append(future)
+            if priority < previous.priority:
+                self.queues[previous.priority].remove(previous)
+                previous.priority = priority
+                self.queues[priority].append(previous)
+                self.wakeup.set()
+            SEND_EVENTS.inc("merged")
+            return await future
+        
+        job = SendJob(priority, data.get("chat_id"), merge_key, callback, args, kwargs, time.monotonic())
+        if merge_key:
+            self.edits[merge_key] = job
+            if merge_key in self.sending:
+                self.sending[merge_key].newer = job
+        self.queues[priority].append(job)
+        self.wakeup.set()
+        return await job.futures[0]
+
+    def _chat_bucket(self, chat_id, now: float) -> Optional[TokenBucket]:
+        if chat_id is None:
+            return None
+        bucket = self.chats.get(chat_id)
+        if bucket is not None:
+            self.chats.move_to_end(chat_id)
+            return bucket
+        
+        is_group = str(chat_id).startswith(("-", "@"))
+        rate, burst = self.group_limits if is_group else self.chat_limits
+        if rate <= 0:
+            return None
+        bucket = self.chats[chat_id] = TokenBucket(rate, burst, now)
+        evict_idle(self.chats, now, self.max_chats)
+        return bucket
+
+    def _next_job(self) -> tuple:
+        """(сообщение для отправки, None) или (None, сколько ждать; None - до нового сообщения)"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        if not self.depth():
+            return None, None
+        global_wait = self.global_bucket.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+        
+        delay = None
+        # Очереди по убыванию приоритета: подтверждение оплаты не стоит за перерисовкой меню
+        for queue in self.queues:
+            for job in queue:
+                bucket = self._chat_bucket(job.chat_id, now)
+                wait = bucket.wait_time(now) if bucket else 0.0
+                if wait <= 0:
+                    queue.remove(job)
+                    if bucket:
+                        bucket.take(now)
+                    self.global_bucket.take(now)
+                    if job.merge_key and self.edits.get(job.merge_key) is job:
+                        del self.edits[job.merge_key]
+                    if job.merge_key:
+                        self.sending[job.merge_key] = job
+                    return job, None
+                delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    async def _run(self):
+        while True:
+            job, delay = self._next_job()
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if not job.attempts:
+                SEND_WAIT.observe(time.monotonic() - job.queued_at, PRIORITY_NAMES[job.priority])
+            task = asyncio.create_task(self._send(job))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    async def _send(self, job: SendJob):
+        job.attempts += 1
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            SEND_EVENTS.inc("retry_after")
+            if job.attempts > self.max_retries:
+                self._finish(job, error=e)
+                return
+            logger.warning(f"Telegram retry_after {e.retry_after} с для чата {job.chat_id}")
+            # Пауза только для этого чата: общий лимит планировщик соблюдает сам, сообщение ждет в начале очереди
+            now = time.monotonic()
+            bucket = self._chat_bucket(job.chat_id, now)
+            if bucket:
+                bucket.tokens = min(bucket.tokens, 0.0) - e.retry_after * bucket.rate
+                bucket.updated = now
+            else:
+                self.paused_until = max(self.paused_until, now + e.retry_after)
+            if job.newer:
+                self._supersede(job)
+                return
+            if job.merge_key:
+                self.edits[job.merge_key] = job
+            self.queues[job.priority].appendleft(job)
+            self.wakeup.set()
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+        finally:
+            if job.merge_key and self.sending.get(job.merge_key) is job:
+                del self.sending[job.merge_key]
+
+    def _supersede(self, job: SendJob):
+        """Устаревшая правка после retry_after не повторяется: ее ожидающие получат результат новой"""
+        newest = job.newer
+        while newest.newer:
+            newest = newest.newer
+        SEND_EVENTS.inc("merged")
+        if newest.outcome:
+            result, error = newest.outcome
+            self._finish(job, result=result, error=error)
+            return
+        newest.futures.extend(job.futures)
+        if job.priority < newest.priority and self.edits.get(newest.merge_key) is newest:
+            self.queues[newest.priority].remove(newest)
+            newest.priority = job.priority
+            self.queues[newest.priority].appendleft(newest)
+            self.wakeup.set()
+
+    @staticmethod
+    def _finish(job: SendJob, result=None, error: Optional[BaseException] = None):
+        job.outcome = (result, error)
+        for future in job.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class BotLifecycle:
+    """Остановка без потери заказов: прием прекращается, начатые доставки завершаются, состояние сохраняется"""
+    def __init__(self, bot: "StarBot", drain_timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+        self.bot = bot
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self.inflight = set()
+        self.shutdown_started: Optional[float] = None
+        self.finished = False
+
+    def begin_shutdown(self):
+        if self.accepting:
+            self.accepting = False
+            self.shutdown_started = time.monotonic()
+            logger.info("Остановка: прием новых заказов прекращен")
+
+    def remaining(self) -> float:
+        if self.shutdown_started is None:
+            return self.drain_timeout
+        return max(0.0, self.drain_timeout - (time.monotonic() - self.shutdown_started))
+
+    async def run_inflight(self, coro):
+        """Операция, которую не прерывает отмена обработчика или фоновой задачи"""
+        task = asyncio.create_task(coro)
+        self.inflight.add(task)
+        task.add_done_callback(self.inflight.discard)
+        return await asyncio.shield(task)
+
+    def install_signal_handlers(self):
+        """Сигнал остановки сразу прекращает прием заказов, затем останавливает цикл PTB"""
+        def on_signal():
+            self.begin_shutdown()
+            raise SystemExit
+        
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, on_signal)
+
+    async def shutdown(self):
+        if self.finished:
+            return
+        self.begin_shutdown()
+        
+        background = [t for t in (self.bot.auto_check_task, self.bot.rate_update_task, self.bot.warmup_task,
+                                  self.bot.recovery_task, self.bot.reconcile_task, self.bot.broadcast_task,
+                                  self.bot.order_index_task) if t]
+        self.bot.stop_background_tasks()
+        for task in (self.bot.warmup_task, self.bot.recovery_task):
+            if task:
+                task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        for task in (self.bot.stats_task, self.bot.config_task):
+            if task:
+                task.cancel()
+        
+        if self.inflight:
+            logger.info(f"Ожидание завершения доставок: {len(self.inflight)}")
+            _, pending = await asyncio.wait(set(self.inflight), timeout=self.remaining())
+            if pending:
+                logger.error(f"Доставки не завершены к сроку остановки: {len(pending)}")
+        
+        try:
+            await asyncio.to_thread(self.bot.checkpoint)
+            await asyncio.to_thread(self.bot.stats.flush)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния при остановке: {str(e)}", exc_info=True)
+        self.bot.fragment_client.close()
+        
+        if self.bot.metrics_server:
+            await self.bot.metrics_server.stop()
+        if self.bot.admin_api:
+            await self.bot.admin_api.stop()
+        if self.bot.loop_monitor:
+            logger.info(f"Итоги мониторинга event loop:\n{self.bot.loop_monitor.report()}")
+            await self.bot.loop_monitor.stop()
+        if self.bot.tracer:
+            logger.info("Итоги трассировки оплат:\n" + "\n".join(self.bot.tracer.report()))
+            self.bot.tracer.close()
+        if self.bot.recorder:
+            self.bot.recorder.close()
+        if self.bot.journal:
+            await asyncio.to_thread(self.bot.journal.close)
+        if self.bot.order_index:
+            self.bot.order_index.close()
+
+        self.finished = True
+        logger.info(f"Остановка завершена за {self.drain_timeout - self.remaining():.2f} с")
+
+class PaymentReconciler:
+    """Сверка оплаченных счетов CryptoBot с журналом: невыданные заказы доставляются заново, прочие пробелы - админу"""
+    def __init__(self, bot: "StarBot", interval: int = RECONCILE_INTERVAL, page_size: int = RECONCILE_PAGE_SIZE):
+        self.bot = bot
+        self.interval = interval
+        self.page_size = page_size
+        self.state: Dict[str, Any] = {"cursor": None, "handled": {}}
+        # Журналы других воркеров дочитываются с запомненной позиции
+        self.positions: Dict[str, tuple] = {}
+        self.states: Dict[str, str] = {}
+
+    async def run(self):
+        await self.bot.readiness['state'].wait()
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Ошибка сверки платежей: {str(e)}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def _load_state(self) -> Dict[str, Any]:
+        if self.bot.store:
+            return self.bot.store.get("reconciler", "state") or self.state
+        return self.state
+
+    def _save_state(self, state: Dict[str, Any]):
+        self.state = state
+        if self.bot.store:
+            self.bot.store.set("reconciler", "state", state)
+
+    def _delivery_states(self) -> Dict[str, str]:
+        if BOT_WORKERS <= 1:
+            return self.bot.journal.states
+        for worker_id in range(BOT_WORKERS):
+            path = worker_file(ORDER_JOURNAL_FILE, worker_id)
+            self.positions[path] = OrderJournal.read_states(path, self.positions.get(path), self.states)
+        return self.states
+
+    async def _fetch_paid(self, stop_before: float) -> tuple:
+        """Оплаченные счета, созданные не раньше stop_before, и число прочитанных страниц"""
+        client = self.bot.fragment_client
+        items, offset, pages = [], 0, 0
+        while True:
+            data = await client.cryptobot.run(
+                client.get_invoices, status="paid", offset=offset, count=self.page_size
+            )
+            if not data.get('ok'):
+                raise RuntimeError(f"CryptoBot вернул ошибку: {data.get('error')}")
+            page = data['result']['items']
+            pages += 1
+            for item in page:
+                created = parse_paid_at(item.get('created_at'))
+                if created is not None and created < stop_before:
+                    return items, pages
+                items.append(item)
+            if len(page) < self.page_size:
+                return items, pages
+            offset += self.page_size
+
+    async def reconcile(self):
+        started = time.time()
+        state = await asyncio.to_thread(self._load_state)
+        cursor = state.get("cursor")
+        # Счет, созданный раньше прошлой сверки минус срок жизни, после нее уже не мог быть оплачен
+        window_start = cursor - INVOICE_TTL - 60 if cursor else started - RECONCILE_LOOKBACK
+        
+        paid, pages = await self._fetch_paid(window_start)
+        delivered = await asyncio.to_thread(self._delivery_states)
+        handled = {k: v for k, v in state.get("handled", {}).items() if v >= window_start}
+        
+        redeliver, gaps = [], []
+        for item in paid:
+            payment_id = str(item['invoice_id'])
+            journal_state = delivered.get(payment_id)
+            if journal_state == "delivered" or payment_id in handled or payment_id in self.bot.processing_payments:
+                continue
+            paid_at = parse_paid_at(item.get('paid_at'))
+            if paid_at and started - paid_at < RECONCILE_GRACE:
+                continue
+            handled[payment_id] = parse_paid_at(item.get('created_at')) or started
+            payment = self.bot.pending_payments.get(payment_id)
+            if payment and not payment.get('processed', False) and journal_state != "attempted":
+                redeliver.append((payment_id, paid_at))
+            else:
+                gaps.append((payment_id, item, journal_state or "нет записи"))
+        
+        for payment_id, paid_at in redeliver:
+            RECONCILE_GAPS.inc("redelivered")
+            success, message = await self.bot.lifecycle.run_inflight(self.bot._process_payment(payment_id, paid_at))
+            logger.warning(f"Сверка: повторная доставка {payment_id}: {message}")
+        
+        if gaps:
+            RECONCILE_GAPS.inc("alerted", amount=len(gaps))
+            lines = [
+                f"• {payment_id}: {item.get('amount')} {item.get('asset')}, журнал: {journal_state}"
+                for payment_id, item, journal_state in gaps[:20]
+            ]
+            if len(gaps) > 20:
+                lines.append(f"... и еще {len(gaps) - 20}")
+            admin_msg = f"⚠️ Сверка: оплачено, но не доставлено ({len(gaps)}):\n" + "\n".join(lines)
+            await self.bot.notify_admin(admin_msg)
+        
+        await asyncio.to_thread(self._save_state, {"cursor": started, "handled": handled})
+        logger.info(
+            f"Сверка платежей: страниц {pages}, оплаченных счетов {len(paid)}, "
+            f"повторных доставок {len(redeliver)}, расхождений {len(gaps)} "
+            f"за {time.time() - started:.2f} с"
+        )
+
+def merge_counts(target: Dict[str, Any], delta: Dict[str, Any]):
+    """Прибавляет счетчики delta к target, вложенные словари складываются по ключам"""
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            merge_counts(target.setdefault(key, {}), value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+class SalesStats:
+    """Накопительные счетчики продаж по часам и дням для /stats, сбрасываемые в хранилище атомарно"""
+    def __init__(self, store: Optional[SqliteStore] = None):
+        self.buckets = store.mapping("stats") if store else {}
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        # record() вызывается в event loop, flush() - в потоке
+        self.lock = threading.Lock()
+        self.pruned_at = 0.0
 
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"JWT {self.auth_token}"
-        }
+    def record(self, event: str, ts: Optional[float] = None, **amounts):
+        """Событие: invoices, paid, delivered, failed или expired; amounts - суммы к нему"""
+        moment = time.localtime(time.time() if ts is None else ts)
+        delta = {event: 1, **amounts}
+        with self.lock:
+            # Корзины часа и дня: отчет читает несколько десятков корзин вместо обхода всех транзакций
+            for key in (time.strftime("h:%Y-%m-%dT%H", moment), time.strftime("d:%Y-%m-%d", moment)):
+                merge_counts(self.pending.setdefault(key, {}), delta)
 
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        keys = list(pending)
         try:
-            logger.info(f"Отправка звезд: {payload}")
-            logger.debug(f"Заголовки запроса: {headers}")
-            
-            response = requests.post(endpoint, headers=headers, json=payload, timeout=60)
-            logger.info(f"Ответ API: {response.status_code}, {response.text}")
-            
-            if response.status_code == 403:
-                logger.warning("Обнаружена 403 ошибка, пробуем переаутентификацию")
-                if self.authenticate(PHONE_NUMBER, MNEMONICS):
-                    headers["Authorization"] = f"JWT {self.auth_token}"
-                    logger.info("Повторная отправка запроса с новым токеном")
-                    response = requests.post(endpoint, headers=headers, json=payload, timeout=60)
-                    logger.info(f"Ответ API после повторной аутентификации: {response.status_code}, {response.text}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {"success": True, "data": result}
-            else:
-                error_msg = f"Ошибка {response.status_code}"
-                try:
-                    error_data = response.json()
-                    if 'detail' in error_data:
-                        error_msg += f": {error_data['detail']}"
-                    elif 'error' in error_data:
-                        error_msg += f": {error_data['error']}"
-                except:
-                    error_msg += f": {response.text[:100]}"
-                return {"error": error_msg}
+            while keys:
+                delta = pending[keys[0]]
                 
-        except requests.exceptions.RequestException as e:
-            error_msg = f"Ошибка запроса: {str(e)}"
-            logger.error(error_msg)
-            return {"error": error_msg}
-
-    def create_cryptobot_invoice(
-        self,
-        stars_amount: int,
-        asset: str = "TON",
-        recipient: Optional[str] = None,
-        description: str = "Покупка звезд",
-        hidden_message: Optional[str] = None,
-        paid_btn_name: Optional[str] = None,
-        paid_btn_url: Optional[str] = None,
-        payload: Optional[str] = None,
-        allow_comments: bool = True,
-        allow_anonymous: bool = True,
-        discount_percent: int = 0
-    ) -> Dict[str, Any]:
-        if not self.cryptobot_token:
-            raise ValueError("Требуется токен CryptoBot")
+                def add(bucket):
+                    bucket = bucket or {}
+                    merge_counts(bucket, delta)
+                    return None, bucket
+                
+                atomic_update(self.buckets, keys[0], add)
+                keys.pop(0)
+        finally:
+            if keys:
+                # Несохраненное вернется в следующий сброс
+                with self.lock:
+                    for key in keys:
+                        merge_counts(self.pending.setdefault(key, {}), pending[key])
         
-        if stars_amount < self.MIN_STARS:
-            raise ValueError(f"Минимальное количество звезд для покупки: {self.MIN_STARS}")
+        if time.time() - self.pruned_at > 3600:
+            self.pruned_at = time.time()
+            cutoff = time.strftime("h:%Y-%m-%dT%H", time.localtime(time.time() - STATS_HOURLY_RETENTION_DAYS * 86400))
+            for key, _ in mapping_page(self.buckets, "h:", 1000):
+                if key >= cutoff:
+                    break
+                del self.buckets[key]
+
+    def read(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Корзины по ключам вместе с еще не сброшенными событиями процесса"""
+        result = {}
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket:
+                merge_counts(result.setdefault(key, {}), bucket)
+        with self.lock:
+            for key in keys:
+                if key in self.pending:
+                    merge_counts(result.setdefault(key, {}), self.pending[key])
+        return result
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения статистики продаж: {str(e)}")
+
+    @staticmethod
+    def describe(counts: Dict[str, Any]) -> str:
+        invoices, paid = counts.get("invoices", 0), counts.get("paid", 0)
+        conversion = f" ({paid / invoices * 100:.0f}%)" if invoices else ""
+        text = (
+            f"счетов {invoices}, оплачено {paid}{conversion}, истекло {counts.get('expired', 0)}, "
+            f"доставлено {counts.get('delivered', 0)}, ошибок доставки {counts.get('failed', 0)}, "
+            f"звезд {counts.get('stars', 0)}, выручка {counts.get('revenue_rub', 0):.2f} RUB"
+        )
+        revenue = counts.get("revenue") or {}
+        if revenue:
+            text += " (" + ", ".join(f"{amount:.4f} {currency}" for currency, amount in sorted(revenue.items())) + ")"
+        promo = counts.get("promo") or {}
+        if promo:
+            text += "; промокоды: " + ", ".join(f"{code}×{uses}" for code, uses in sorted(promo.items()))
+        return text
 
-        amount_rub = stars_amount * self.PRICE_PER_STAR * (1 - discount_percent / 100)
+    def report(self, now: Optional[float] = None) -> str:
+        now = time.time() if now is None else now
+        days = [time.strftime("d:%Y-%m-%d", time.localtime(now - i * 86400)) for i in range(30)]
+        hours = [time.strftime("h:%Y-%m-%dT%H", time.localtime(now - i * 3600)) for i in range(24)]
+        daily = self.read(days)
+        hourly = self.read(hours)
         
-        if asset == "TON":
-            amount_asset = amount_rub / self.get_ton_rate()
-        elif asset == "USDT":
-            amount_asset = amount_rub / self.get_usdt_rate()
-        else:
-            raise ValueError(f"Неподдерживаемая валюта: {asset}")
+        def total(keys: List[str]) -> Dict[str, Any]:
+            counts: Dict[str, Any] = {}
+            for key in keys:
+                merge_counts(counts, daily.get(key, {}))
+            return counts
         
-        if amount_asset < 0.01:
-            raise ValueError(f"Сумма платежа слишком мала: {amount_asset:.6f} {asset}. Минимум 0.01 {asset}.")
+        lines = ["<b>📊 Статистика продаж</b>", ""]
+        for title, keys in (("Сегодня", days[:1]), ("Вчера", days[1:2]), ("7 дней", days[:7]), ("30 дней", days)):
+            lines.append(f"<b>{title}:</b> {self.describe(total(keys))}")
         
-        endpoint = "https://pay.crypt.bot/api/createInvoice"
-        headers = {"Crypto-Pay-API-Token": self.cryptobot_token}
+        lines += ["", "<b>По дням:</b>"]
+        for key in days[:7]:
+            counts = daily.get(key, {})
+            lines.append(
+                f"{key[2:]}: счетов {counts.get('invoices', 0)}, оплачено {counts.get('paid', 0)}, "
+                f"звезд {counts.get('stars', 0)}, {counts.get('revenue_rub', 0):.0f} RUB, "
+                f"ошибок {counts.get('failed', 0)}"
+            )
         
-        formatted_amount = f"{amount_asset:.9f}".rstrip('0').rstrip('.')
-        if formatted_amount == '':
-            formatted_amount = '0'
+        active = [key for key in reversed(hours) if key in hourly]
+        lines += ["", "<b>По часам (24 ч):</b>"]
+        for key in active:
+            counts = hourly[key]
+            lines.append(
+                f"{key[-2:]}:00: счетов {counts.get('invoices', 0)}, оплачено {counts.get('paid', 0)}, "
+                f"звезд {counts.get('stars', 0)}, {counts.get('revenue_rub', 0):.0f} RUB, "
+                f"ошибок {counts.get('failed', 0)}"
+            )
+        if not active:
+            lines.append("нет событий")
+        return "\n".join(lines)
+
+
+class Broadcaster:
+    """Рассылка администратора всем пользователям порциями с сохранением курсора после каждой"""
+    def __init__(self, bot: "StarBot", rate: float = BROADCAST_RATE, chunk_size: int = BROADCAST_CHUNK,
+                 concurrency: int = BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.state: Optional[Dict[str, Any]] = None
+        self.wakeup = asyncio.Event()
+
+    def _load_state(self) -> Optional[Dict[str, Any]]:
+        if self.bot.store:
+            return self.bot.store.get("broadcast", "state")
+        return self.state
+
+    def _save_state(self, state: Dict[str, Any]):
+        self.state = state
+        if self.bot.store:
+            self.bot.store.set("broadcast", "state", state)
+
+    def _update_state(self, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Сохраняет прогресс, только если state все еще текущая рассылка; возвращает сохраненное состояние"""
+        def update(current):
+            if not current or current["id"] != state["id"]:
+                return current, None
+            if current["status"] != "running":
+                # Отмена записана другим обработчиком: счетчики сохраняются с ее статусом
+                state["status"] = current["status"]
+            return state, state
         
-        desc = f"{description} ({stars_amount} звезд)"
-        if discount_percent > 0:
-            desc += f" со скидкой {discount_percent}%"
-        if recipient:
-            desc += f" для @{recipient}"
-            
-        payload_data = {
-            "asset": asset,
-            "amount": formatted_amount,
-            "description": desc,
-            "hidden_message": hidden_message or f"Спасибо за покупку {stars_amount} звезд!" + (f" для @{recipient}" if recipient else ""),
-            "paid_btn_name": paid_btn_name or "openBot",
-            "paid_btn_url": paid_btn_url or "https://t.me/WhiteBearStars_bot",
-            "payload": payload or f"stars_{stars_amount}",
-            "allow_comments": allow_comments,
-            "allow_anonymous": allow_anonymous
+        return self._atomic(update)
+
+    def _atomic(self, fn: Callable[[Any], tuple]) -> Any:
+        """Чтение-изменение-запись состояния рассылки: fn(state) -> (результат, новое состояние или None)"""
+        if self.bot.store:
+            return self.bot.store.atomic_update("broadcast", "state", fn)
+        result, new_state = fn(self.state)
+        if new_state is not None:
+            self.state = new_state
+        return result
+
+    async def start(self, text: str) -> Optional[Dict[str, Any]]:
+        """Запускает рассылку; None, если предыдущая еще идет"""
+        current = await asyncio.to_thread(self._load_state)
+        if current and current["status"] == "running":
+            return None
+        state = {
+            "id": uuid.uuid4().hex[:8],
+            "text": text,
+            "status": "running",
+            "cursor": None,
+            "total": len(self.bot.user_data_store),
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "skipped": 0,
+            "elapsed": 0.0
         }
+        await asyncio.to_thread(self._save_state, state)
+        self.wakeup.set()
+        return state
 
-        for attempt in range(MAX_RETRIES):
+    async def cancel(self) -> Optional[Dict[str, Any]]:
+        def mark_cancelled(current):
+            # Меняется только статус: счетчики и итог записывает воркер, который ведет рассылку
+            if not current or current["status"] != "running":
+                return None, None
+            current["status"] = "cancelled"
+            return current, current
+        
+        return await asyncio.to_thread(self._atomic, mark_cancelled)
+
+    async def status(self) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load_state)
+
+    @staticmethod
+    def describe(state: Dict[str, Any]) -> str:
+        statuses = {"running": "идет", "done": "завершена", "cancelled": "отменена"}
+        processed = state["sent"] + state["blocked"] + state["failed"] + state["skipped"]
+        text = (
+            f"📣 Рассылка #{state['id']}: {statuses.get(state['status'], state['status'])}\n"
+            f"• Обработано: {processed} из {state['total']}\n"
+            f"• Доставлено: {state['sent']}, заблокировали бота: {state['blocked']}, "
+            f"ошибок: {state['failed']}, пропущено: {state['skipped']}"
+        )
+        if state["elapsed"] > 0:
+            speed = (processed - state["skipped"]) / state["elapsed"]
+            text += f"\n• Скорость: {speed:.1f} сообщ./с"
+            if state["status"] == "running" and speed > 0:
+                eta = max(0, state["total"] - processed) / speed
+                text += f", осталось ~{int(eta // 60)} мин {int(eta % 60)} с"
+        return text
+
+    async def run(self):
+        await self.bot.readiness['state'].wait()
+        while True:
             try:
-                logger.info(f"Отправка запроса в CryptoBot: {payload_data}")
-                response = self.session.post(endpoint, json=payload_data, headers=headers, timeout=30)
-                logger.info(f"Ответ CryptoBot: {response.status_code}, {response.text}")
-                
-                response.raise_for_status()
-                data = response.json()
-                
-                if not data.get('ok'):
-                    error_msg = data.get('error', 'Неизвестная ошибка CryptoBot')
-                    logger.error(f"Ошибка CryptoBot: {error_msg}")
-                    return {"error": error_msg}
-                
-                return data
-            except requests.exceptions.RequestException as e:
-                if attempt < MAX_RETRIES - 1:
-                    logger.warning(f"Ошибка создания инвойса, повтор #{attempt+1}: {str(e)}")
-                    time.sleep(RETRY_DELAY)
+                state = await asyncio.to_thread(self._load_state)
+                if state and state["status"] == "running":
+                    await self.process(state)
                     continue
-                error_msg = f"Ошибка создания инвойса: {str(e)}"
-                logger.error(error_msg)
-                return {"error": error_msg}
-
-    def _notify_admin(self, message: str) -> bool:
-        if not self.telegram_token:
-            logger.warning("Telegram токен не указан")
-            return False
+            except Exception as e:
+                logger.error(f"Ошибка рассылки: {str(e)}", exc_info=True)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), BROADCAST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
-        endpoint = f"https://api.telegram.org/bot{self.telegram_token}/sendMessage"
-        payload = {
-            "chat_id": ADMIN_CHAT_ID,
-            "text": message,
-            "parse_mode": "HTML"
-        }
+    async def process(self, state: Dict[str, Any]):
+        logger.info(f"Рассылка #{state['id']}: продолжение после {state['cursor']}")
+        bucket = TokenBucket(self.rate, max(1.0, self.rate), time.monotonic())
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def deliver(user_id: Any) -> str:
+            async with semaphore:
+                while not bucket.take(time.monotonic()):
+                    await asyncio.sleep(bucket.wait_time(time.monotonic()))
+                return await self._send(user_id, state["text"])
+        
+        while True:
+            chunk_started = time.monotonic()
+            chunk = await asyncio.to_thread(mapping_page, self.bot.user_data_store, state["cursor"], self.chunk_size)
+            if not chunk:
+                state["status"] = "done"
+                break
+            
+            recipients = [user_id for user_id, record in chunk if not record.get('blocked')]
+            state["skipped"] += len(chunk) - len(recipients)
+            for outcome in await asyncio.gather(*(deliver(user_id) for user_id in recipients)):
+                state[outcome] += 1
+            state["cursor"] = chunk[-1][0]
+            state["elapsed"] += time.monotonic() - chunk_started
+            
+            # Отмену могли записать с любого воркера
+            current = await asyncio.to_thread(self._update_state, state)
+            if not current or current["id"] != state["id"]:
+                logger.info(f"Рассылка #{state['id']} отменена и заменена новой")
+                return
+            if state["status"] != "running":
+                break
+        
+        current = await asyncio.to_thread(self._update_state, state)
+        if not current or current["id"] != state["id"]:
+            logger.info(f"Рассылка #{state['id']} отменена и заменена новой")
+            return
+        logger.info(f"Рассылка #{state['id']} {state['status']}: {state['sent']} доставлено, "
+                    f"{state['blocked']} заблокировали, {state['failed']} ошибок")
+        await self.bot.notify_admin(self.describe(state))
 
+    async def _send(self, user_id: Any, text: str) -> str:
+        """Исход отправки: sent, blocked или failed"""
         for attempt in range(MAX_RETRIES):
             try:
-                response = self.session.post(endpoint, json=payload, timeout=60)
-                response.raise_for_status()
-                return True
+                with send_priority(PRIORITY_LOW):
+                    await self.bot.application.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML')
+                return "sent"
+            except Forbidden:
+                break
+            except BadRequest as e:
+                if "chat not found" not in str(e).lower():
+                    logger.warning(f"Рассылка: ошибка отправки {user_id}: {str(e)}")
+                    return "failed"
+                break
+            except RetryAfter as e:
+                # Без планировщика отправки retry_after приходит сюда
+                await asyncio.sleep(e.retry_after)
             except Exception as e:
-                if attempt < MAX_RETRIES - 1:
-                    logger.warning(f"Ошибка уведомления админа, повтор #{attempt+1}: {str(e)}")
-                    time.sleep(RETRY_DELAY)
-                    continue
-                logger.error(f"Ошибка уведомления админа: {str(e)}")
-                return False
+                logger.warning(f"Рассылка: ошибка отправки {user_id}: {str(e)}")
+                return "failed"
+        else:
+            return "failed"
+        
+        def mark_blocked(record):
+            if record is None:
+                return None, None
+            record['blocked'] = True
+            return None, record
+        
+        await asyncio.to_thread(atomic_update, self.bot.user_data_store, user_id, mark_blocked)
+        return "blocked"
+
 
 class StarBot:
-    def __init__(self, api_key: str, telegram_token: str, cryptobot_token: str):
+    def __init__(self, api_key: str, telegram_token: str, cryptobot_token: str,
+                 store: Optional[SqliteStore] = None, shared_state: bool = False):
         self.fragment_client = FragmentAPIClient(
             api_key=api_key,
             telegram_token=telegram_token,
             cryptobot_token=cryptobot_token
         )
         self.telegram_token = telegram_token
-        self.pending_payments = {}
+        self.store = store
+        self.config_watcher = ConfigWatcher()
+        self.config = self.config_watcher.current
+        self.fragment_client.apply_config(self.config)
+        self.config_watcher.listeners.append(self.apply_config)
+        self.config_task = None
+        self.application: Optional[Application] = None
         self.auto_check_task = None
         self.rate_update_task = None
+        self.warmup_task = None
+        self.recovery_task = None
+        self.reconcile_task = None
+        self.media = MediaCache(store)
+        self.lifecycle = BotLifecycle(self)
+        self.worker_id = 0
+        self.metrics_server: Optional[MetricsServer] = None
+        self.loop_monitor: Optional[LoopMonitor] = None
+        self.tracer: Optional[PaymentTracer] = None
+        self.recorder: Optional[TrafficRecorder] = None
+        self.journal: Optional[OrderJournal] = None
+        self.order_index: Optional[OrderIndex] = None
+        self.order_index_task = None
+        self.admin_api: Optional[AdminApiServer] = None
+        self.reconciler = PaymentReconciler(self)
+        self.broadcaster = Broadcaster(self)
+        self.broadcast_task = None
+        self.stats = SalesStats(store)
+        self.stats_task = None
+        self.recipients = RecipientValidator(self.fragment_client)
+        self.admin_outbox: deque = deque()
+        self.admin_flush_task: Optional[asyncio.Task] = None
+        self.memory = MemoryInspector(self)
+        self.throttles = {
+            'navigation': Throttle('navigation', THROTTLE_NAV_RATE, THROTTLE_NAV_BURST,
+                                   THROTTLE_NAV_GLOBAL_RATE, THROTTLE_NAV_GLOBAL_BURST),
+            'expensive': Throttle('expensive', THROTTLE_EXPENSIVE_RATE, THROTTLE_EXPENSIVE_BURST,
+                                  THROTTLE_EXPENSIVE_GLOBAL_RATE, THROTTLE_EXPENSIVE_GLOBAL_BURST)
+        }
+        # Готовность подсистем после запуска
+        self.readiness = {
+            'state': asyncio.Event(),
+            'auth': asyncio.Event(),
+            'rates': asyncio.Event(),
+            'media': asyncio.Event()
+        }
         
+        if store and shared_state:
+            # Состояние платежей, промокодов и пользователей общее для всех воркеров
+            self.pending_payments = store.mapping("pending_payments")
+            self.user_data_store = store.mapping("users")
+            self.promocodes = store.mapping("promocodes")
+        else:
+            self.pending_payments = {}
+            self.user_data_store = user_data_store
+            self.promocodes = {}
         # Словарь активных промокодов с количеством активаций
-        self.promocodes = {
-            "WELCOME10": {"discount": 10, "activations": 10},
-            "STARS20": {"discount": 20, "activations": 10},
-            "BEAR30": {"discount": 30, "activations": 5},
-            "MEGA40": {"discount": 40, "activations": 3},
-            "SUPER50": {"discount": 50, "activations": 3},
-            "ULTRA60": {"discount": 60, "activations": 2},
-            "EPIC70": {"discount": 70, "activations": 2},
-            "LEGEND80": {"discount": 80, "activations": 1},
-            "GOD99": {"discount": 99, "activations": 1}
-        }
+        self.sync_promocodes(self.config)
         
         self.processing_payments = set()
+        
+        # Кэш выставленных счетов: (user_id, звезды, валюта, получатель, скидка, версии курса и настроек) -> счет
+        self.invoice_cache = {}
+
+    async def post_init(self, application: Application):
+        """Запуск прогрева в фоне: обработчики Telegram доступны сразу"""
+        self.application = application
+
+        PENDING_INVOICES.set_function(lambda: len(self.pending_payments))
+        DELIVERY_QUEUE.set_function(lambda: len(self.processing_payments) + len(self.lifecycle.inflight))
+        RATE_AGE.set_function(lambda: time.time() - self.fragment_client.last_rate_update)
+        if LOOP_MONITOR:
+            self.loop_monitor = LoopMonitor()
+            self.loop_monitor.start()
+        if PAYMENT_TRACE:
+            self.tracer = PaymentTracer(worker_file(PAYMENT_TRACE_FILE, self.worker_id) if PAYMENT_TRACE_FILE else None)
+        if METRICS_PORT:
+            self.metrics_server = MetricsServer(port=METRICS_PORT + self.worker_id)
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"Не удалось запустить сервер метрик: {str(e)}")
+                self.metrics_server = None
+
+        if ORDER_JOURNAL_FILE:
+            self.journal = OrderJournal(worker_file(ORDER_JOURNAL_FILE, self.worker_id))
+            self.journal.open()
+            if ORDER_INDEX_PATH and ADMIN_API_PORT:
+                self.order_index = OrderIndex(ORDER_INDEX_PATH)
+                if ADMIN_API_PORT and self.worker_id == 0:
+                    self.admin_api = AdminApiServer(self.order_index)
+                    try:
+                        await self.admin_api.start()
+                    except OSError as e:
+                        logger.error(f"Не удалось запустить API заказов: {str(e)}")
+                        self.admin_api = None
+
+        self.warmup_task = asyncio.create_task(self.warm_up(application))
+        # Файл настроек отслеживает каждый воркер
+        self.config_task = asyncio.create_task(self.config_watcher.run())
+        # Счетчики копит и сбрасывает каждый воркер, а не только лидер
+        self.stats_task = asyncio.create_task(self.stats.run())
+
+    def apply_config(self, config: BotConfig):
+        """Переход на перезагруженные настройки; заказы и счета в памяти сохраняются"""
+        self.config = config
+        if self.fragment_client.apply_config(config):
+            # Курсы новых активов запрашиваются сразу, а не при следующем плановом обновлении
+            self._send_in_background(self._warm_up_rates(force=True))
+        self.sync_promocodes(config)
+
+    def sync_promocodes(self, config: BotConfig):
+        """Приводит промокоды к настройкам, не сбрасывая израсходованные активации"""
+        for code, promo in config.promocodes.items():
+            def upsert(record, promo=promo):
+                if record is None:
+                    record = {"activations": promo["activations"]}
+                # Остаток заменяется, только если лимит в файле изменился
+                elif record.get("limit", promo["activations"]) != promo["activations"]:
+                    record["activations"] = promo["activations"]
+                record["discount"] = promo["discount"]
+                record["limit"] = promo["activations"]
+                return None, record
+            atomic_update(self.promocodes, code, upsert)
+        
+        removed = [code for code, record in list(self.promocodes.items())
+                   if code not in config.promocodes and "limit" in record]
+        for code in removed:
+            self.promocodes.pop(code, None)
+
+    def start_recording(self, path: str):
+        self.recorder = TrafficRecorder(path, keep_words=self.promocodes)
+        self.fragment_client.recorder = self.recorder
+        logger.info(f"Запись трафика включена: {path}")
+
+    async def _warmup_phase(self, name: str, phase: Callable[[], Awaitable]):
+        """Повторяет фазу до успеха: готовность не отмечается, пока фаза не прошла"""
+        started = time.perf_counter()
+        while True:
+            try:
+                await phase()
+                break
+            except Exception as e:
+                logger.error(f"Ошибка фазы запуска '{name}', повтор через {WARMUP_RETRY_DELAY} с: {str(e)}", exc_info=True)
+                await asyncio.sleep(WARMUP_RETRY_DELAY)
+        self.readiness[name].set()
+        logger.info(f"Фаза запуска '{name}' заняла {time.perf_counter() - started:.2f} с")
+
+    async def _load_state(self):
+        if self.store:
+            await asyncio.to_thread(self.media.load)
+            self.load_shared_rates()
+            await asyncio.to_thread(self.restore_checkpoint)
+        if self.journal:
+            await self.recover_orders()
+
+    async def recover_orders(self):
+        """Доставляет оплаченные заказы из журнала; начатые без записанного итога передаются администратору"""
+        orders = await asyncio.to_thread(self.journal.load)
+        # Заказ этого воркера мог выдать лидер: итог тогда записан только в журнале лидера
+        other_states = await asyncio.to_thread(self._other_journal_states)
+        resume, unknown = [], []
+        for payment_id, order in orders.items():
+            state = max(order["state"], other_states.get(payment_id, "created"), key=OrderJournal.PROGRESS.get)
+            if state in OrderJournal.TERMINAL:
+                self.pending_payments.pop(payment_id, None)
+                continue
+            payment = self.pending_payments.get(payment_id) or order.get("payment")
+            if payment:
+                payment = dict(payment, processed=(state == "attempted"))
+                self.pending_payments[payment_id] = payment
+            if state == "paid":
+                resume.append(payment_id)
+            elif state == "attempted":
+                unknown.append((payment_id, payment))
+        
+        for payment_id, payment in unknown:
+            logger.error(f"Заказ {payment_id}: результат отправки звезд неизвестен после перезапуска")
+            admin_msg = (
+                f"⚠️ Результат отправки звезд неизвестен (сбой во время доставки):\n"
+                f"• Payment ID: {payment_id}\n"
+            )
+            if payment and payment.get('recipients'):
+                deliveries = payment.get('deliveries') or {}
+                unknown_recipients = [
+                    f"@{username}" for username, _ in payment['recipients'] if deliveries.get(username) != "delivered"
+                ]
+                admin_msg += (
+                    f"• Покупатель: @{payment['sender_username']}\n"
+                    f"• Звезд: {payment['stars_amount']}, получателей: {len(payment['recipients'])}\n"
+                    f"• Без подтверждения доставки: {', '.join(unknown_recipients[:20]) or 'нет'}"
+                )
+            elif payment:
+                admin_msg += (
+                    f"• Покупатель: @{payment['sender_username']}\n"
+                    f"• Звезд: {payment['stars_amount']}\n"
+                    f"• Получатель: @{payment['recipient'] or payment['sender_username']}"
+                )
+            await self.notify_admin(admin_msg)
+            await self._journal("failed", payment_id, error="unknown outcome after restart")
+        
+        if resume:
+            logger.info(f"Возобновление доставки оплаченных заказов: {len(resume)}")
+            self.recovery_task = asyncio.create_task(self._resume_deliveries(resume))
+        logger.info(f"Журнал заказов загружен: {len(orders)} заказов")
+
+    def _other_journal_states(self) -> Dict[str, str]:
+        states: Dict[str, str] = {}
+        if BOT_WORKERS > 1:
+            for worker_id in range(BOT_WORKERS):
+                if worker_id != self.worker_id:
+                    OrderJournal.read_states(worker_file(ORDER_JOURNAL_FILE, worker_id), None, states)
+        return states
+
+    async def _resume_deliveries(self, payment_ids: List[str]):
+        for payment_id in payment_ids:
+            success, message = await self.lifecycle.run_inflight(self._process_payment(payment_id))
+            logger.info(f"Возобновленная доставка {payment_id}: {message}")
+
+    async def notify_admin(self, message: str) -> bool:
+        """Уведомление администратора; пока предыдущее ждет лимита чата, новые копятся в одно сообщение"""
+        if not self.application:
+            return await self.fragment_client.telegram.run(self.fragment_client._notify_admin, message)
+        if not ADMIN_CHAT_ID:
+            logger.warning("ADMIN_CHAT_ID не указан")
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self.admin_outbox.append((message, future))
+        if not self.admin_flush_task or self.admin_flush_task.done():
+            self.admin_flush_task = asyncio.create_task(self._flush_admin_outbox())
+        return await future
+
+    async def _flush_admin_outbox(self):
+        # Пачка общая для разных заказов: ее отправка не относится к трассе оплаты, создавшей задачу
+        _payment_trace.set(None)
+        while self.admin_outbox:
+            batch, size = [], 0
+            while self.admin_outbox and (not batch or size + len(self.admin_outbox[0][0]) <= ADMIN_MESSAGE_LIMIT):
+                batch.append(self.admin_outbox.popleft())
+                size += len(batch[-1][0]) + 2
+            try:
+                with upstream_timer("telegram_notify_admin"):
+                    await self.application.bot.send_message(
+                        chat_id=ADMIN_CHAT_ID,
+                        text="\n\n".join(message for message, _ in batch),
+                        parse_mode='HTML'
+                    )
+                sent = True
+            except Exception as e:
+                logger.error(f"Ошибка уведомления админа ({len(batch)} сообщ.): {str(e)}")
+                sent = False
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(sent)
+
+    def _send_in_background(self, coro):
+        """Отправка, результат которой не нужен обработчику; остановка бота ее дожидается"""
+        async def send():
+            try:
+                await coro
+            except Exception as e:
+                logger.warning(f"Ошибка фоновой отправки: {str(e)}")
+        
+        task = asyncio.create_task(send())
+        self.lifecycle.inflight.add(task)
+        task.add_done_callback(self.lifecycle.inflight.discard)
+
+    async def _show_progress(self, query: CallbackQuery, text: str):
+        """Промежуточный статус платежа с низким приоритетом; с планировщиком отправка не ждется"""
+        with send_priority(PRIORITY_LOW):
+            if query.message.photo:
+                edit = query.edit_message_caption(caption=text, parse_mode='HTML')
+            else:
+                edit = query.edit_message_text(text, parse_mode='HTML')
+            if getattr(query.get_bot(), "rate_limiter", None):
+                self._send_in_background(edit)
+            else:
+                await edit
+
+    async def _journal(self, event: str, payment_id: str, **data):
+        if self.journal:
+            with trace_span("journal"):
+                await self.journal.write(event, payment_id, **data)
+
+    async def _journal_failure(self, payment_id: str, error: str):
+        """Запись "failed" из обработчика ошибки: сбой записи не должен подменить исходную ошибку"""
+        try:
+            await self._journal("failed", payment_id, error=error)
+        except OSError:
+            # Поток журнала уже записал ошибку в лог
+            pass
+
+    def checkpoint(self):
+        """Сохраняет платежи, промокоды, профили и курсы, которые живут только в памяти"""
+        if not self.store:
+            return
+        self.publish_rates()
+        if isinstance(self.pending_payments, StoreMapping):
+            return
+        self.store.set("checkpoint", "pending_payments", list(self.pending_payments.items()))
+        self.store.set("checkpoint", "promocodes", list(self.promocodes.items()))
+        self.store.set("checkpoint", "users", list(self.user_data_store.items()))
+        logger.info(f"Состояние сохранено: ожидающих платежей {len(self.pending_payments)}")
+
+    def restore_checkpoint(self):
+        if not self.store or isinstance(self.pending_payments, StoreMapping):
+            return
+        pending = self.store.get("checkpoint", "pending_payments") or []
+        for payment_id, payment_data in pending:
+            self.pending_payments.setdefault(payment_id, payment_data)
+        # Снимок одноразовый: после сбоя он вернул бы уже выданные заказы
+        self.store.delete("checkpoint", "pending_payments")
+        for code, promo in self.store.get("checkpoint", "promocodes") or []:
+            self.promocodes[code] = promo
+        # Настройки могли измениться, пока бот был остановлен
+        self.sync_promocodes(self.config)
+        for user_id, record in self.store.get("checkpoint", "users") or []:
+            self.user_data_store.setdefault(user_id, record)
+        if pending:
+            logger.info(f"Восстановлено ожидающих платежей: {len(pending)}")
+
+    async def _warm_up_auth(self):
+        if not await self.fragment_client.fragment.run(self.fragment_client.authenticate, PHONE_NUMBER, MNEMONICS):
+            raise RuntimeError("не удалось аутентифицироваться в Fragment API после нескольких попыток")
+
+    async def _warm_up_rates(self, force: bool = False):
+        if not force and time.time() - self.fragment_client.last_rate_update < 3600:
+            return
+        if not await self.fragment_client.update_rates():
+            raise RuntimeError("не удалось получить курсы")
+        self.publish_rates()
+
+    async def warm_up(self, application: Application):
+        started = time.perf_counter()
+        await self._warmup_phase('state', self._load_state)
+        await asyncio.gather(
+            self._warmup_phase('auth', self._warm_up_auth),
+            self._warmup_phase('rates', self._warm_up_rates),
+            self._warmup_phase('media', functools.partial(
+                self.media.warm_up, application.bot, MEDIA_WARMUP_CHAT_ID, list(self.config.photos.values())
+            ))
+        )
+        logger.info(f"Прогрев завершен за {time.perf_counter() - started:.2f} с")
+
+    async def wait_ready(self, name: str, timeout: float = READINESS_TIMEOUT) -> bool:
+        event = self.readiness[name]
+        if event.is_set():
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _send_photo(self, send: Callable, url: str, **kwargs) -> Message:
+        """Отправка фото по сохраненному file_id с откатом на URL"""
+        photo = self.media.get(url)
+        try:
+            message = await send(photo=photo, **kwargs)
+        except BadRequest:
+            if photo == url:
+                raise
+            logger.warning(f"file_id для {url} недействителен, отправка по URL")
+            self.media.forget(url)
+            message = await send(photo=url, **kwargs)
+        self.media.remember(url, message)
+        return message
+
+    def _get_cached_invoice(self, key: tuple) -> Optional[Dict[str, Any]]:
+        """Возвращает еще действующий счет для повторной одинаковой покупки"""
+        now = time.time()
+        for cached_key in [k for k, v in self.invoice_cache.items() if v['expires_at'] <= now]:
+            del self.invoice_cache[cached_key]
+        
+        cached = self.invoice_cache.get(key)
+        if not cached:
+            return None
+        
+        payment_data = self.pending_payments.get(cached['payment_id'])
+        if (not payment_data or payment_data.get('processed', False)
+                or cached['expires_at'] - now < INVOICE_REUSE_MIN_REMAINING):
+            del self.invoice_cache[key]
+            return None
+        return cached
 
+    async def _throttled(self, update: Update, kind: str) -> bool:
+        """True, если действие отклонено лимитом; предупреждение - один раз до восстановления лимита"""
+        user = update.effective_user
+        if user is None:
+            return False
+        allowed, warn = self.throttles[kind].allow(user.id)
+        if allowed:
+            return False
+        
+        text = "⏳ Слишком много запросов. Подождите несколько секунд."
+        try:
+            if update.callback_query:
+                # Ответ на нажатие нужен всегда, иначе кнопка "зависнет"
+                await update.callback_query.answer(text if warn else None)
+            elif warn and update.message:
+                await update.message.reply_text(text)
+        except Exception as e:
+            logger.debug(f"Не удалось сообщить об ограничении: {str(e)}")
+        return True
+
+    @timed_handler("start")
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message and await self._throttled(update, 'navigation'):
+            return
         user = update.effective_user
+        main_asset = next(iter(self.config.assets))
         welcome_text = (
             f"<b>Привет, {user.first_name}!</b>\n\n"
             "🌟 <b>Купить звёзды</b>\n"
             "Лучший курс, без скрытых условий\n\n"
-            "💳 <b>Оплачивай, как удобно:</b> TON, USDT\n\n"
-            f"1 звезда = {self.fragment_client.PRICE_PER_STAR} ₽ (~{1 / self.fragment_client.get_ton_rate() * self.fragment_client.PRICE_PER_STAR:.6f} TON)"
+            f"💳 <b>Оплачивай, как удобно:</b> {', '.join(self.config.assets)}\n\n"
+            f"1 звезда = {self.config.price_per_star} ₽ (~{self.config.price_per_star / self.fragment_client.get_rate(main_asset):.6f} {main_asset})"
         )
 
         keyboard = [
@@ -363,8 +3867,9 @@ class StarBot:
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         if update.message:
-            await update.message.reply_photo(
-                photo=MAIN_MENU_PHOTO_URL,
+            await self._send_photo(
+                update.message.reply_photo,
+                self.config.photos['main_menu'],
                 caption=welcome_text,
                 reply_markup=reply_markup,
                 parse_mode='HTML'
@@ -376,8 +3881,9 @@ class StarBot:
                 await query.message.delete()
             except Exception as e:
                 logger.error(f"Ошибка удаления сообщения: {e}")
-            await query.message.reply_photo(
-                photo=MAIN_MENU_PHOTO_URL,
+            await self._send_photo(
+                query.message.reply_photo,
+                self.config.photos['main_menu'],
                 caption=welcome_text,
                 reply_markup=reply_markup,
                 parse_mode='HTML'
@@ -387,13 +3893,14 @@ class StarBot:
         query = update.callback_query
         await query.answer()
 
+        assets = " или ".join(self.config.assets)
         instructions_text = (
             "<b>📚 Инструкция по покупке звезд</b>\n\n"
             "1. Нажмите кнопку <b>🛒 Купить звёзды</b>.\n"
             "2. Выберите, для кого покупаете звёзды (для себя или для друга).\n"
             "3. Если для друга, введите его username.\n"
-            "4. Выберите валюту оплаты (TON или USDT).\n"
-            "5. Введите количество звезд (минимум 50).\n"
+            f"4. Выберите валюту оплаты ({assets}).\n"
+            f"5. Введите количество звезд (минимум {self.config.min_stars}).\n"
             "6. Оплатите счет в течение 15 минут.\n"
             "7. После оплаты нажмите кнопку <b>🔄 Проверить оплату</b>.\n\n"
             "<b>Как пополнить CryptoBot?</b>\n"
@@ -402,7 +3909,7 @@ class StarBot:
             "• Перейдите в @CryptoBot\n"
             "• Нажмите <b>Start</b>\n"
             "• Выберите <b>Кошелек</b> -> <b>Пополнить</b>\n"
-            "• Выберите валюту (TON или USDT) и следуйте инструкциям.\n\n"
+            f"• Выберите валюту ({assets}) и следуйте инструкциям.\n\n"
             "После пополнения баланса в @CryptoBot вы можете оплатить счет в нашем боте."
         )
 
@@ -433,9 +3940,10 @@ class StarBot:
         except Exception as e:
             logger.error(f"Ошибка удаления сообщения: {e}")
 
-        await context.bot.send_photo(
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['promo'],
             chat_id=query.message.chat_id,
-            photo=PROMO_PHOTO_URL,
             caption="🎁 Введите промокод:",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]])
         )
@@ -452,6 +3960,7 @@ class StarBot:
         keyboard = [
             [InlineKeyboardButton("🫵 Для себя", callback_data="buy_self")],
             [InlineKeyboardButton("👥 Для друга", callback_data="buy_friend")],
+            [InlineKeyboardButton("📋 Подарок списком", callback_data="buy_bulk")],
             [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -461,20 +3970,92 @@ class StarBot:
         except Exception as e:
             logger.error(f"Ошибка удаления сообщения: {e}")
 
-        await context.bot.send_photo(
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['username_input'],
             chat_id=query.message.chat_id,
-            photo=USERNAME_INPUT_PHOTO_URL,
             caption=buy_text,
             reply_markup=reply_markup,
             parse_mode='HTML'
         )
 
+    def _is_admin(self, update: Update) -> bool:
+        return str(ADMIN_CHAT_ID) in (str(update.effective_chat.id), str(update.effective_user.id))
+
+    @timed_handler("broadcast")
+    async def broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/broadcast <текст> | status | cancel - только для администратора"""
+        if not self._is_admin(update):
+            return
+        parts = update.message.text.split(maxsplit=1)
+        argument = parts[1].strip() if len(parts) > 1 else ""
+        
+        if argument in ("", "status"):
+            state = await self.broadcaster.status()
+            usage = "Использование: /broadcast текст (HTML), /broadcast status, /broadcast cancel"
+            await update.message.reply_text(self.broadcaster.describe(state) if state else usage)
+        elif argument == "cancel":
+            state = await self.broadcaster.cancel()
+            await update.message.reply_text(
+                "⏹ Рассылка будет остановлена после текущей порции" if state else "Рассылка не запущена"
+            )
+        else:
+            # Предпросмотр заодно проверяет HTML до отправки всем
+            try:
+                await update.message.reply_text(argument, parse_mode='HTML')
+            except BadRequest as e:
+                await update.message.reply_text(f"❌ Текст не отправлен: {str(e)}")
+                return
+            state = await self.broadcaster.start(argument)
+            if state is None:
+                await update.message.reply_text("⚠️ Предыдущая рассылка еще идет: /broadcast status")
+            else:
+                await update.message.reply_text(
+                    f"📣 Рассылка #{state['id']} запущена: {state['total']} пользователей, "
+                    f"~{BROADCAST_RATE:g} сообщ./с"
+                )
+
+    @timed_handler("stats")
+    async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/stats - сводка продаж из накопительных счетчиков, только для администратора"""
+        if not self._is_admin(update):
+            return
+        report = await asyncio.to_thread(self.stats.report)
+        await update.message.reply_text(report, parse_mode='HTML')
+
+    @timed_handler("trace")
+    async def show_traces(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/trace - задержка доставки оплат по этапам и внешним API; только для администратора"""
+        if not self._is_admin(update):
+            return
+        if not self.tracer:
+            await update.message.reply_text("Трассировка оплат выключена (PAYMENT_TRACE=1).")
+            return
+        await self._send_report(update.effective_chat.id, "⏱ Путь оплаты", self.tracer.report())
+
+    @timed_handler("mem")
+    async def show_memory(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/mem [trace | stop] - память процесса и структур бота, снимки tracemalloc; только для администратора"""
+        if not self._is_admin(update):
+            return
+        parts = update.message.text.split(maxsplit=1)
+        argument = parts[1].strip().lower() if len(parts) > 1 else ""
+
+        if argument == "trace":
+            title, lines = "🧠 tracemalloc", await self.memory.trace()
+        elif argument == "stop":
+            title, lines = "🧠 tracemalloc", [self.memory.stop()]
+        else:
+            title, lines = "🧠 Память", self.memory.structures_report()
+        await self._send_report(update.effective_chat.id, title, lines)
+
+    @timed_handler("show_profile")
     async def show_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
 
         user_id = query.from_user.id
-        user_data = user_data_store.get(user_id, {
+        user_data = self.user_data_store.get(user_id, {
             'total_stars': 0,
             'transactions': []
         })
@@ -487,6 +4068,8 @@ class StarBot:
                 trans_line = f"{i}. {t['date']}: {t['stars']} звезд"
                 if t.get('recipient'):
                     trans_line += f" для @{t['recipient']}"
+                elif t.get('recipients'):
+                    trans_line += f" для {t['recipients']} получателей"
                 if t.get('promo') and t['promo'] != "без скидки":
                     trans_line += f" ({t['promo']})"
                 transactions_text += trans_line + "\n"
@@ -519,9 +4102,10 @@ class StarBot:
         except Exception as e:
             logger.error(f"Ошибка удаления сообщения: {e}")
 
-        await context.bot.send_photo(
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['profile'],
             chat_id=query.message.chat_id,
-            photo=PROFILE_PHOTO_URL,
             caption=profile_text,
             reply_markup=reply_markup,
             parse_mode='HTML'
@@ -549,9 +4133,10 @@ class StarBot:
         except Exception as e:
             logger.error(f"Ошибка удаления сообщения: {e}")
 
-        await context.bot.send_photo(
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['support'],
             chat_id=query.message.chat_id,
-            photo=SUPPORT_PHOTO_URL,
             caption=support_text,
             reply_markup=reply_markup,
             parse_mode='HTML'
@@ -568,62 +4153,117 @@ class StarBot:
         except Exception as e:
             logger.error(f"Ошибка удаления сообщения: {e}")
 
-        await context.bot.send_photo(
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['username_input'],
             chat_id=query.message.chat_id,
-            photo=USERNAME_INPUT_PHOTO_URL,
             caption="✏️ Введите username друга (без @):",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
         )
 
-    async def choose_currency(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def request_bulk_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
 
-        context.user_data['state'] = 'CHOOSING_CURRENCY'
+        context.user_data['state'] = 'ENTERING_BULK_LIST'
         
+        try:
+            await query.message.delete()
+        except Exception as e:
+            logger.error(f"Ошибка удаления сообщения: {e}")
+
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['username_input'],
+            chat_id=query.message.chat_id,
+            caption=(
+                "<b>📋 Подарок списком</b>\n\n"
+                "Отправьте список получателей, по строке на каждого:\n"
+                "<code>username количество</code>\n\n"
+                "Например:\n<code>friend_one 100\nfriend_two 50</code>\n\n"
+                f"Список можно прислать файлом .txt или .csv. До {BULK_MAX_RECIPIENTS} получателей, "
+                f"от {self.config.min_stars} звезд каждому. Счет будет один на всю сумму."
+            ),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]]),
+            parse_mode='HTML'
+        )
+
+    def _currency_choice(self) -> tuple:
+        """Текст с курсами и кнопки активов из текущих настроек"""
+        rates = "".join(
+            f"1 {code} = {self.fragment_client.get_rate(code):.2f} RUB\n" for code in self.config.assets
+        )
         currency_text = (
             "<b>💱 Выберите валюту оплаты</b>\n\n"
-            f"Текущий курс:\n"
-            f"1 TON = {self.fragment_client.get_ton_rate():.2f} RUB\n"
-            f"1 USDT = {self.fragment_client.get_usdt_rate():.2f} RUB\n\n"
-            f"1 звезда = {self.fragment_client.PRICE_PER_STAR} RUB"
+            f"Текущий курс:\n{rates}\n"
+            f"1 звезда = {self.config.price_per_star} RUB"
         )
-
         keyboard = [
-            [InlineKeyboardButton("💎 Оплатить в TON", callback_data="currency_ton")],
-            [InlineKeyboardButton("💵 Оплатить в USDT", callback_data="currency_usdt")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
+            [InlineKeyboardButton(asset["button"], callback_data=f"currency_{code.lower()}")]
+            for code, asset in self.config.assets.items()
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")])
+        return currency_text, InlineKeyboardMarkup(keyboard)
+
+    async def choose_currency(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+
+        context.user_data['state'] = 'CHOOSING_CURRENCY'
+        
+        currency_text, reply_markup = self._currency_choice()
 
         try:
             await query.message.delete()
         except Exception as e:
             logger.error(f"Ошибка удаления сообщения: {e}")
 
-        await context.bot.send_photo(
+        await self._send_photo(
+            context.bot.send_photo,
+            self.config.photos['currency_choice'],
             chat_id=query.message.chat_id,
-            photo=CURRENCY_CHOICE_PHOTO_URL,
             caption=currency_text,
             reply_markup=reply_markup,
             parse_mode='HTML'
         )
 
-    async def process_buy_stars(self, message: Message, amount: int, currency: str, recipient: Optional[str] = None, discount_percent: int = 0, promo_code: Optional[str] = None):
+    @timed_handler("process_buy_stars")
+    async def process_buy_stars(self, message: Message, amount: int, currency: str, recipient: Optional[str] = None, discount_percent: int = 0, promo_code: Optional[str] = None,
+                                recipients: Optional[List[list]] = None):
+        if not self.lifecycle.accepting:
+            await message.reply_text(
+                "🔧 Бот перезапускается. Попробуйте создать заказ через минуту.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+            )
+            return
+        
+        if not await self.wait_ready('rates'):
+            await message.reply_text(
+                "⏳ Бот запускается и получает актуальный курс. Попробуйте через минуту.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+            )
+            return
+        
+        # Один снимок настроек на весь заказ: перезагрузка не меняет цену посреди расчета
+        config = self.config
+        if currency not in config.assets:
+            await message.reply_text(
+                f"❌ Оплата в {currency} временно недоступна. Выберите другую валюту.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+            )
+            return
+        
         try:
             sender = message.from_user
             sender_username = sender.username if sender.username else sender.first_name
             
-            amount_rub = amount * self.fragment_client.PRICE_PER_STAR * (1 - discount_percent / 100)
-            
-            if currency == "TON":
-                amount_asset = amount_rub / self.fragment_client.get_ton_rate()
-            elif currency == "USDT":
-                amount_asset = amount_rub / self.fragment_client.get_usdt_rate()
+            amount_rub = amount * config.price_per_star * (1 - discount_percent / 100)
+            rate = self.fragment_client.get_rate(currency)
+            amount_asset = amount_rub / rate
             
-            if amount_asset < 0.01:
-                min_stars = math.ceil(0.01 * (self.fragment_client.get_ton_rate() if currency == "TON" else self.fragment_client.get_usdt_rate()) 
-                                      / (self.fragment_client.PRICE_PER_STAR * (1 - discount_percent / 100)))
+            min_amount = config.assets[currency]["min_amount"]
+            if amount_asset < min_amount:
+                min_stars = math.ceil(min_amount * rate / (config.price_per_star * (1 - discount_percent / 100)))
                 
                 await message.reply_text(
                     f"❌ После применения скидки {discount_percent}% сумма слишком мала для оплаты.\n"
@@ -631,61 +4271,103 @@ class StarBot:
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
                 )
                 return
-                
-            invoice = self.fragment_client.create_cryptobot_invoice(
-                stars_amount=amount,
-                asset=currency,
-                recipient=recipient,
-                discount_percent=discount_percent
+            
+            cache_key = (
+                sender.id,
+                amount,
+                currency,
+                tuple(map(tuple, recipients)) if recipients else recipient,
+                discount_percent,
+                promo_code,
+                # Курс именно этого актива: изменение других курсов счет не сбрасывает
+                rate,
+                config.version
             )
+            cached = self._get_cached_invoice(cache_key)
             
-            if "error" in invoice:
-                error_msg = invoice["error"]
-                logger.error(f"Ошибка создания инвойса: {error_msg}")
-                await message.reply_text(
-                    f"❌ Ошибка при создании платежа: {error_msg}",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+            if cached:
+                logger.info(f"Повторное использование счета {cached['payment_id']} для пользователя {sender.id}")
+                payment_id = cached['payment_id']
+                pay_url = cached['pay_url']
+                invoice_amount = cached['amount']
+                expires_at = cached['expires_at']
+            else:
+                invoice_options = {"description": f"Подарок звезд: {len(recipients)} получателей"} if recipients else {}
+                invoice = await self.fragment_client.cryptobot.run(
+                    self.fragment_client.create_cryptobot_invoice,
+                    stars_amount=amount,
+                    asset=currency,
+                    recipient=recipient,
+                    discount_percent=discount_percent,
+                    config=config,
+                    **invoice_options
                 )
-                return
                 
-            if not invoice.get('ok'):
-                await message.reply_text(
-                    "❌ Не удалось создать платеж. Попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
-                )
-                return
+                if "error" in invoice:
+                    error_msg = invoice["error"]
+                    logger.error(f"Ошибка создания инвойса: {error_msg}")
+                    await message.reply_text(
+                        f"❌ Ошибка при создании платежа: {error_msg}",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+                    )
+                    return
+                    
+                if not invoice.get('ok'):
+                    await message.reply_text(
+                        "❌ Не удалось создать платеж. Попробуйте позже.",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+                    )
+                    return
 
-            invoice_data = invoice['result']
-            payment_id = str(invoice_data['invoice_id'])
-            pay_url = invoice_data['pay_url']
-            
-            self.pending_payments[payment_id] = {
-                'user_id': message.from_user.id,
-                'sender_username': sender_username,
-                'recipient': recipient,
-                'stars_amount': amount,
-                'currency': currency,
-                'amount_rub': amount_rub,
-                'amount_crypto': float(invoice_data['amount']),
-                'discount_percent': discount_percent,
-                'promo_code': promo_code,
-                'processed': False
-            }
+                invoice_data = invoice['result']
+                payment_id = str(invoice_data['invoice_id'])
+                pay_url = invoice_data['pay_url']
+                invoice_amount = invoice_data['amount']
+                expires_at = time.time() + INVOICE_TTL
+                
+                payment_data = {
+                    'user_id': message.from_user.id,
+                    'sender_username': sender_username,
+                    'recipient': recipient,
+                    'stars_amount': amount,
+                    'currency': currency,
+                    'amount_rub': amount_rub,
+                    'amount_crypto': float(invoice_amount),
+                    'discount_percent': discount_percent,
+                    'promo_code': promo_code,
+                    'processed': False
+                }
+                if recipients:
+                    payment_data['recipients'] = recipients
+                self.pending_payments[payment_id] = payment_data
+                # Заказ записан в журнал до того, как пользователь увидит счет
+                await self._journal("created", payment_id, payment=payment_data)
+                self.stats.record("invoices")
+                
+                self.invoice_cache[cache_key] = {
+                    'payment_id': payment_id,
+                    'pay_url': pay_url,
+                    'amount': invoice_amount,
+                    'expires_at': expires_at
+                }
             
             payment_text = (
                 f"<b>💳 Оплата {amount} звезд</b>\n\n"
-                f"<b>Сумма к оплате:</b> {invoice_data['amount']} {currency}\n"
+                f"<b>Сумма к оплате:</b> {invoice_amount} {currency}\n"
             )
             
             if discount_percent > 0:
                 payment_text += f"<b>Скидка:</b> {discount_percent}%\n"
             
-            if recipient:
+            if recipients:
+                payment_text += f"<b>Получатели ({len(recipients)}):</b>\n{format_recipients(recipients)}\n\n"
+            elif recipient:
                 payment_text += f"<b>Получатель:</b> @{recipient}\n\n"
             else:
                 payment_text += "\n"
             
-            payment_text += "Ссылка для оплаты действительна 15 минут. После оплаты нажмите 'Проверить оплату'."
+            minutes_left = max(1, int((expires_at - time.time()) // 60))
+            payment_text += f"Ссылка для оплаты действительна {minutes_left} минут. После оплаты нажмите 'Проверить оплату'."
             
             keyboard = [
                 [InlineKeyboardButton("💳 Оплатить", url=pay_url)],
@@ -694,12 +4376,14 @@ class StarBot:
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await message.reply_photo(
-                photo=INVOICE_PHOTO_URL,
-                caption=payment_text,
-                reply_markup=reply_markup,
-                parse_mode='HTML'
-            )
+            with send_priority(PRIORITY_CRITICAL):
+                await self._send_photo(
+                    message.reply_photo,
+                    self.config.photos['invoice'],
+                    caption=payment_text,
+                    reply_markup=reply_markup,
+                    parse_mode='HTML'
+                )
             
         except Exception as e:
             logger.error(f"Ошибка при обработке покупки: {str(e)}", exc_info=True)
@@ -708,10 +4392,14 @@ class StarBot:
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
             )
 
+    @timed_handler("handle_callback")
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         data = query.data
 
+        if await self._throttled(update, 'expensive' if data.startswith("check_") else 'navigation'):
+            return
+
         if data == "main_menu":
             await self.start(update, context)
         elif data == "profile":
@@ -726,14 +4414,15 @@ class StarBot:
             await self.show_instructions(update, context)
         elif data.startswith("check_"):
             payment_id = data.split("_")[1]
-            await self.check_payment(update, context, payment_id)
+            with payment_trace(self.tracer, payment_id, "check"):
+                await self.check_payment(update, context, payment_id)
         elif data == "buy_self":
             # Сохраняем промокод при переходе между опциями
             promo_code = context.user_data.get('promo_code')
             discount_percent = context.user_data.get('discount_percent', 0)
             
             # Очищаем только данные о друге
-            keys_to_remove = ['friend_username', 'recipient', 'currency', 'state']
+            keys_to_remove = ['friend_username', 'recipient', 'currency', 'state', 'bulk']
             for key in keys_to_remove:
                 if key in context.user_data:
                     del context.user_data[key]
@@ -751,7 +4440,7 @@ class StarBot:
             discount_percent = context.user_data.get('discount_percent', 0)
             
             # Очищаем только данные о покупке
-            keys_to_remove = ['friend_username', 'recipient', 'currency', 'state']
+            keys_to_remove = ['friend_username', 'recipient', 'currency', 'state', 'bulk']
             for key in keys_to_remove:
                 if key in context.user_data:
                     del context.user_data[key]
@@ -763,45 +4452,46 @@ class StarBot:
                 
             context.user_data['state'] = 'ENTERING_FRIEND_USERNAME'
             await self.request_friend_username(update, context)
-        elif data == "currency_ton":
-            context.user_data['currency'] = "TON"
-            context.user_data['state'] = 'ENTERING_AMOUNT'
-            try:
-                await query.message.delete()
-            except Exception as e:
-                logger.error(f"Ошибка удаления сообщения: {e}")
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=BUY_STARS_PHOTO_URL,
-                caption="Введите количество звезд для покупки (минимум 50):",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
-            )
-        elif data == "currency_usdt":
-            context.user_data['currency'] = "USDT"
+        elif data == "buy_bulk":
+            for key in ['friend_username', 'currency', 'state']:
+                context.user_data.pop(key, None)
+            context.user_data['recipient'] = None
+            context.user_data['bulk'] = True
+            await self.choose_currency(update, context)
+        elif data.startswith("currency_"):
+            currency = data[len("currency_"):].upper()
+            if currency not in self.config.assets:
+                # Кнопка из сообщения, отправленного до отключения актива
+                await self.choose_currency(update, context)
+                return
+            context.user_data['currency'] = currency
+            if context.user_data.get('bulk'):
+                await self.request_bulk_list(update, context)
+                return
             context.user_data['state'] = 'ENTERING_AMOUNT'
             try:
                 await query.message.delete()
             except Exception as e:
                 logger.error(f"Ошибка удаления сообщения: {e}")
-            await context.bot.send_photo(
+            await self._send_photo(
+                context.bot.send_photo,
+                self.config.photos['buy_stars'],
                 chat_id=query.message.chat_id,
-                photo=BUY_STARS_PHOTO_URL,
-                caption="Введите количество звезд для покупки (минимум 50):",
+                caption=f"Введите количество звезд для покупки (минимум {self.config.min_stars}):",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
             )
 
+    @timed_handler("check_payment")
     async def check_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id: str = None):
         query = update.callback_query
-        await query.answer()
+        with trace_span("answer_callback", upstream="telegram"):
+            await query.answer()
 
         if payment_id in self.processing_payments:
-            await query.edit_message_caption(caption="⌛ Платеж уже проверяется. Пожалуйста, подождите...", parse_mode='HTML')
+            await self._show_progress(query, "⌛ Платеж уже проверяется. Пожалуйста, подождите...")
             return
 
-        if query.message.photo:
-            await query.edit_message_caption(caption="🔄 Проверяем статус платежа...", parse_mode='HTML')
-        else:
-            await query.edit_message_text("🔄 Проверяем статус платежа...", parse_mode='HTML')
+        await self._show_progress(query, "🔄 Проверяем статус платежа...")
 
         if not payment_id:
             payment_id = next((k for k, v in self.pending_payments.items() 
@@ -822,12 +4512,7 @@ class StarBot:
         
         self.processing_payments.add(payment_id)
         try:
-            endpoint = f"https://pay.crypt.bot/api/getInvoices?invoice_ids={payment_id}"
-            headers = {"Crypto-Pay-API-Token": self.fragment_client.cryptobot_token}
-            
-            response = requests.get(endpoint, headers=headers, timeout=60)
-            response.raise_for_status()
-            data = response.json()
+            data = await self.fragment_client.cryptobot.run(self.fragment_client.get_invoices, payment_id)
             
             if not data.get('ok'):
                 if query.message.photo:
@@ -852,24 +4537,28 @@ class StarBot:
             status = status_translation.get(invoice['status'], invoice['status'])
             
             if invoice['status'] == 'paid':
-                success, message = await self._process_payment(payment_id)
+                success, message = await self.lifecycle.run_inflight(
+                    self._process_payment(payment_id, parse_paid_at(invoice.get('paid_at')))
+                )
                 if success:
                     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("👤 Профиль", callback_data="profile")]])
                 else:
                     reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("💬 Поддержка", callback_data="support")]])
-                    
-                if query.message.photo:
-                    await query.edit_message_caption(
-                        caption=message,
-                        reply_markup=reply_markup,
-                        parse_mode='HTML'
-                    )
-                else:
-                    await query.edit_message_text(
-                        message,
-                        reply_markup=reply_markup,
-                        parse_mode='HTML'
-                    )
+                
+                # Результат оплаты уходит раньше остальных сообщений
+                with send_priority(PRIORITY_CRITICAL), trace_span("edit_message", upstream="telegram"):
+                    if query.message.photo:
+                        await query.edit_message_caption(
+                            caption=message,
+                            reply_markup=reply_markup,
+                            parse_mode='HTML'
+                        )
+                    else:
+                        await query.edit_message_text(
+                            message,
+                            reply_markup=reply_markup,
+                            parse_mode='HTML'
+                        )
             else:
                 payment_data = self.pending_payments.get(payment_id, {})
                 if not payment_data:
@@ -892,7 +4581,12 @@ class StarBot:
                 if payment_data.get('discount_percent', 0) > 0:
                     payment_text += f"<b>Скидка:</b> {payment_data['discount_percent']}%\n"
                 
-                if payment_data['recipient']:
+                if payment_data.get('recipients'):
+                    payment_text += (
+                        f"<b>Получатели ({len(payment_data['recipients'])}):</b>\n"
+                        f"{format_recipients(payment_data['recipients'])}\n\n"
+                    )
+                elif payment_data['recipient']:
                     payment_text += f"<b>Получатель:</b> @{payment_data['recipient']}\n\n"
                 else:
                     payment_text += "\n"
@@ -902,8 +4596,9 @@ class StarBot:
                     keyboard = [
                         [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
                     ]
-                    if payment_id in self.pending_payments:
-                        del self.pending_payments[payment_id]
+                    if self.pending_payments.pop(payment_id, None) is not None:
+                        self.stats.record("expired")
+                    await self._journal("expired", payment_id)
                 else:
                     payment_text += "Если вы уже оплатили, нажмите кнопку 'Проверить оплату' через 1-2 минуты."
                     keyboard = [
@@ -943,36 +4638,72 @@ class StarBot:
             if payment_id in self.processing_payments:
                 self.processing_payments.remove(payment_id)
 
-    async def _process_payment(self, payment_id: str) -> tuple:
-        if payment_id not in self.pending_payments:
-            return False, "Платеж не найден"
+    async def _process_payment(self, payment_id: str, paid_at: Optional[float] = None) -> tuple:
+        # Доставка после перезапуска и сверки начинает свою трассу
+        with payment_trace(self.tracer, payment_id, "process"), trace_span("process_payment"):
+            return await self._deliver_paid(payment_id, paid_at)
+
+    async def _deliver_paid(self, payment_id: str, paid_at: Optional[float]) -> tuple:
+        journal_state = self.journal.states.get(payment_id) if self.journal else None
+        if journal_state == "attempted" or journal_state in OrderJournal.TERMINAL:
+            # Заказ мог вернуться в pending_payments из устаревшего снимка
+            return False, "❌ Платеж уже был обработан ранее"
+        if self.journal and journal_state in (None, "created"):
+            # Без ожидания fsync: запись уйдет в одной пачке с "attempted"
+            self.journal.append("paid", payment_id, paid_at=paid_at)
         
-        payment_data = self.pending_payments[payment_id]
+        if not self.lifecycle.accepting:
+            return False, "🔧 Бот перезапускается. Оплата сохранена, повторите проверку через минуту."
+        
+        if not await self.wait_ready('state') or not await self.wait_ready('auth'):
+            return False, "⏳ Бот запускается. Повторите проверку оплаты через минуту."
         
-        if payment_data.get('processed', False):
+        def claim(payment):
+            if payment is None:
+                return "missing", None
+            if payment.get('processed', False):
+                return "processed", None
+            payment['processed'] = True
+            return "claimed", payment
+        
+        # Атомарная отметка, чтобы платеж не был выдан дважды разными воркерами
+        with trace_span("claim"):
+            claim_status = atomic_update(self.pending_payments, payment_id, claim)
+        if claim_status == "missing":
+            return False, "Платеж не найден"
+        if claim_status == "processed":
             return False, "❌ Платеж уже был обработан ранее"
         
-        payment_data['processed'] = True
-        self.pending_payments[payment_id] = payment_data
+        payment_data = self.pending_payments[payment_id]
+        self.stats.record("paid")
+        if payment_data.get('recipients'):
+            return await self._process_bulk_payment(payment_id, payment_data, paid_at)
+        delivered = False
         
         try:
             recipient_username = payment_data['recipient'] or payment_data['sender_username']
             
-            result = self.fragment_client.send_stars(
-                username=recipient_username,
-                quantity=payment_data['stars_amount']
-            )
+            # Попытка фиксируется до отправки: после сбоя заказ не будет выдан повторно вслепую
+            await self._journal("attempted", payment_id)
+            # Оборванный по сроку запрос оставил бы исход доставки неизвестным
+            with request_deadline(None):
+                result = await self.fragment_client.fragment.run(
+                    self.fragment_client.send_stars,
+                    username=recipient_username,
+                    quantity=payment_data['stars_amount']
+                )
             
             if "success" in result and result["success"]:
+                await self._journal("delivered", payment_id, recipient=recipient_username)
+                delivered = True
+                self.stats.record(
+                    "delivered",
+                    stars=payment_data['stars_amount'],
+                    revenue_rub=payment_data['amount_rub'],
+                    revenue={payment_data['currency']: payment_data['amount_crypto']},
+                    promo={payment_data['promo_code']: 1} if payment_data.get('promo_code') else {}
+                )
                 user_id = payment_data['user_id']
-                if user_id not in user_data_store:
-                    user_data_store[user_id] = {
-                        'total_stars': 0,
-                        'transactions': []
-                    }
-                
-                if not payment_data['recipient']:
-                    user_data_store[user_id]['total_stars'] += payment_data['stars_amount']
                 
                 transaction = {
                     'stars': payment_data['stars_amount'],
@@ -981,25 +4712,14 @@ class StarBot:
                 }
                 
                 promo_code = payment_data.get('promo_code')
-                if promo_code:
-                    if promo_code in self.promocodes:
-                        self.promocodes[promo_code]["activations"] -= 1
-                        
-                        discount_percent = payment_data.get('discount_percent', 0)
-                        transaction['promo'] = f"промокод {promo_code} ({discount_percent}%)"
-                        
-                        if self.promocodes[promo_code]["activations"] == 0:
-                            admin_msg = (
-                                f"⚠️ Промокод <code>{promo_code}</code> израсходован!\n"
-                                f"• Скидка: {discount_percent}%\n"
-                                f"• Последняя активация: @{payment_data['sender_username']}"
-                            )
-                            self.fragment_client._notify_admin(admin_msg)
+                transaction['promo'] = self._use_promo(payment_data) or transaction['promo']
                 
                 if payment_data['recipient']:
                     transaction['recipient'] = payment_data['recipient']
                 
-                user_data_store[user_id]['transactions'].append(transaction)
+                self._add_transaction(
+                    user_id, transaction, 0 if payment_data['recipient'] else payment_data['stars_amount']
+                )
                 
                 admin_msg = (
                     f"✅ Успешная покупка:\n"
@@ -1018,10 +4738,12 @@ class StarBot:
                     f"• Payment ID: {payment_id}"
                 )
                 
-                self.fragment_client._notify_admin(admin_msg)
-                
-                del self.pending_payments[payment_id]
+                self._send_in_background(trace_background(self.notify_admin(admin_msg), "notify_admin"))
                 
+                self.pending_payments.pop(payment_id, None)
+                if paid_at:
+                    PAID_TO_DELIVERED.observe(max(0.0, time.time() - paid_at))
+
                 if payment_data['recipient']:
                     user_msg = f"✅ {payment_data['stars_amount']} звезд отправлено @{payment_data['recipient']}!"
                 else:
@@ -1033,6 +4755,8 @@ class StarBot:
             else:
                 error_msg = result.get('error', 'Неизвестная ошибка')
                 logger.error(f"Ошибка отправки звезд: {error_msg}")
+                await self._journal("failed", payment_id, error=error_msg)
+                self.stats.record("failed")
                 
                 admin_msg = (
                     f"⚠️ Ошибка отправки звезд:\n"
@@ -1048,12 +4772,174 @@ class StarBot:
                     f"• Payment ID: {payment_id}"
                 )
                 
-                self.fragment_client._notify_admin(admin_msg)
+                self._send_in_background(trace_background(self.notify_admin(admin_msg), "notify_admin"))
                 return False, f"❌ Ошибка при отправке звезд: {error_msg}"
             
         except Exception as e:
             logger.error(f"Неожиданная ошибка: {str(e)}", exc_info=True)
+            if self.journal and self.journal.states.get(payment_id) == "attempted":
+                await self._journal_failure(payment_id, str(e))
+            if not delivered:
+                self.stats.record("failed")
+            return False, f"❌ Неожиданная ошибка: {str(e)}"
+
+    def _use_promo(self, payment_data: Dict[str, Any]) -> Optional[str]:
+        """Списывает активацию промокода заказа; возвращает отметку о скидке для истории"""
+        promo_code = payment_data.get('promo_code')
+        if not promo_code:
+            return None
+        
+        def use_activation(promo):
+            if promo is None:
+                return None, None
+            promo["activations"] -= 1
+            return promo["activations"], promo
+        
+        activations_left = atomic_update(self.promocodes, promo_code, use_activation)
+        if activations_left is None:
+            return None
+        discount_percent = payment_data.get('discount_percent', 0)
+        if activations_left == 0:
+            admin_msg = (
+                f"⚠️ Промокод <code>{promo_code}</code> израсходован!\n"
+                f"• Скидка: {discount_percent}%\n"
+                f"• Последняя активация: @{payment_data['sender_username']}"
+            )
+            self._send_in_background(self.notify_admin(admin_msg))
+        return f"промокод {promo_code} ({discount_percent}%)"
+
+    def _add_transaction(self, user_id: int, transaction: Dict[str, Any], own_stars: int):
+        def add_transaction(record):
+            record = record or {
+                'total_stars': 0,
+                'transactions': []
+            }
+            record['total_stars'] += own_stars
+            record['transactions'].append(transaction)
+            # Покупатель снова пишет боту - рассылки ему можно отправлять
+            record.pop('blocked', None)
+            return None, record
+        
+        with trace_span("user_data"):
+            atomic_update(self.user_data_store, user_id, add_transaction)
+
+    async def _process_bulk_payment(self, payment_id: str, payment_data: Dict[str, Any],
+                                    paid_at: Optional[float]) -> tuple:
+        """Доставка заказа со списком получателей, не более BULK_CONCURRENCY отправок одновременно"""
+        recipients = payment_data['recipients']
+        previous = payment_data.get('deliveries') or {}
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+        
+        # Итог по получателю сразу пишется в заказ: после сбоя уже получившим звезды они не уходят повторно
+        def mark(username: str, status: str):
+            def update(payment):
+                if payment is None:
+                    return None, None
+                payment.setdefault('deliveries', {})[username] = status
+                return None, payment
+            atomic_update(self.pending_payments, payment_id, update)
+        
+        async def deliver(username: str, quantity: int) -> Optional[str]:
+            if previous.get(username) == "delivered":
+                return None
+            async with semaphore:
+                mark(username, "sending")
+                try:
+                    with request_deadline(None):
+                        result = await self.fragment_client.fragment.run(
+                            self.fragment_client.send_stars, username=username, quantity=quantity
+                        )
+                    error = None if result.get("success") else result.get('error', 'Неизвестная ошибка')
+                except Exception as e:
+                    logger.error(f"Заказ {payment_id}: ошибка отправки @{username}: {str(e)}", exc_info=True)
+                    error = str(e)
+                mark(username, "delivered" if error is None else "failed")
+                return error
+        
+        try:
+            await self._journal("attempted", payment_id)
+            errors = await asyncio.gather(*(deliver(username, quantity) for username, quantity in recipients))
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка: {str(e)}", exc_info=True)
+            if self.journal and self.journal.states.get(payment_id) == "attempted":
+                await self._journal_failure(payment_id, str(e))
+            self.stats.record("failed")
             return False, f"❌ Неожиданная ошибка: {str(e)}"
+        
+        delivered = [(username, quantity) for (username, quantity), error in zip(recipients, errors) if error is None]
+        failed = [(username, quantity, error) for (username, quantity), error in zip(recipients, errors) if error]
+        delivered_stars = sum(quantity for _, quantity in delivered)
+        
+        if failed:
+            logger.error(f"Заказ {payment_id}: не доставлено {len(failed)} из {len(recipients)} получателей")
+            await self._journal(
+                "failed", payment_id,
+                error=f"не доставлено {len(failed)} из {len(recipients)}",
+                delivered=[username for username, _ in delivered]
+            )
+            self.stats.record("failed")
+        else:
+            await self._journal("delivered", payment_id, recipients=len(recipients))
+            self.pending_payments.pop(payment_id, None)
+            if paid_at:
+                PAID_TO_DELIVERED.observe(max(0.0, time.time() - paid_at))
+        
+        # Частично выполненный заказ учитывается и в доставках (по отправленным звездам), и в ошибках
+        if delivered:
+            self.stats.record(
+                "delivered",
+                stars=delivered_stars,
+                revenue_rub=payment_data['amount_rub'],
+                revenue={payment_data['currency']: payment_data['amount_crypto']},
+                promo={payment_data['promo_code']: 1} if payment_data.get('promo_code') else {}
+            )
+            self._add_transaction(payment_data['user_id'], {
+                'stars': delivered_stars,
+                'date': time.strftime("%Y-%m-%d %H:%M"),
+                'promo': self._use_promo(payment_data) or "без скидки",
+                'recipients': len(delivered)
+            }, 0)
+        
+        report = [f"✅ @{username} — {quantity}" for username, quantity in delivered]
+        report += [f"❌ @{username} — {quantity}: {error[:100]}" for username, quantity, error in failed]
+        admin_msg = (
+            f"{'⚠️ Подарок списком доставлен не полностью' if failed else '✅ Подарок списком'}:\n"
+            f"• Покупатель: @{payment_data['sender_username']}\n"
+            f"• Получателей: {len(delivered)} из {len(recipients)}\n"
+            f"• Звезд: {delivered_stars} из {payment_data['stars_amount']}\n"
+            f"• Сумма: {payment_data['amount_crypto']:.6f} {payment_data['currency']} (~{payment_data['amount_rub']:.2f} RUB)\n"
+            f"• Payment ID: {payment_id}"
+        )
+        if failed:
+            admin_msg += "\n" + "\n".join(html.escape(line) for line in report[len(delivered):][:20])
+        self._send_in_background(trace_background(self.notify_admin(admin_msg), "notify_admin"))
+        
+        # Полный отчет отдельным сообщением: в подпись к счету помещается только начало
+        if self.application:
+            self._send_in_background(self._send_report(payment_data['user_id'], f"📋 Отчет по заказу {payment_id}:", report))
+        
+        if failed:
+            user_msg = (
+                f"⚠️ Доставлено {delivered_stars} из {payment_data['stars_amount']} звезд "
+                f"({len(delivered)} из {len(recipients)} получателей).\n\n"
+                + "\n".join(html.escape(line) for line in report[len(delivered):][:5])
+                + "\n\nПоддержка поможет с недоставленными звездами."
+            )
+        else:
+            user_msg = f"✅ {delivered_stars} звезд отправлено {len(recipients)} получателям!"
+        if payment_data.get('discount_percent', 0) > 0:
+            user_msg += f"\n\n🎁 Скидка по промокоду: {payment_data['discount_percent']}%"
+        return not failed, user_msg
+
+    async def _send_report(self, chat_id: int, title: str, lines: List[str]):
+        chunk = title
+        for line in lines:
+            if len(chunk) + len(line) + 1 > ADMIN_MESSAGE_LIMIT:
+                await self.application.bot.send_message(chat_id=chat_id, text=chunk)
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line
+        if chunk:
+            await self.application.bot.send_message(chat_id=chat_id, text=chunk)
 
     async def start_auto_check(self):
         if self.auto_check_task:
@@ -1069,7 +4955,8 @@ class StarBot:
                 for payment_id in payment_ids:
                     if payment_id in self.processing_payments:
                         continue
-                    await self.check_single_payment(payment_id)
+                    with payment_trace(self.tracer, payment_id, "auto_check"):
+                        await self.check_single_payment(payment_id)
             except Exception as e:
                 logger.error(f"Ошибка автопроверки: {str(e)}")
             
@@ -1081,12 +4968,7 @@ class StarBot:
             
         self.processing_payments.add(payment_id)
         try:
-            endpoint = f"https://pay.crypt.bot/api/getInvoices?invoice_ids={payment_id}"
-            headers = {"Crypto-Pay-API-Token": self.fragment_client.cryptobot_token}
-            
-            response = requests.get(endpoint, headers=headers, timeout=60)
-            response.raise_for_status()
-            data = response.json()
+            data = await self.fragment_client.cryptobot.run(self.fragment_client.get_invoices, payment_id)
             
             if not data.get('ok'):
                 return
@@ -1094,28 +4976,94 @@ class StarBot:
             invoice = data['result']['items'][0]
             
             if invoice['status'] == 'paid':
-                await self._process_payment(payment_id)
+                await self.lifecycle.run_inflight(
+                    self._process_payment(payment_id, parse_paid_at(invoice.get('paid_at')))
+                )
             elif invoice['status'] == 'expired':
-                if payment_id in self.pending_payments:
-                    del self.pending_payments[payment_id]
+                if self.pending_payments.pop(payment_id, None) is not None:
+                    self.stats.record("expired")
+                await self._journal("expired", payment_id)
         except Exception as e:
             logger.error(f"Ошибка при автоматической проверке платежа {payment_id}: {str(e)}")
         finally:
             if payment_id in self.processing_payments:
                 self.processing_payments.remove(payment_id)
 
+    async def start_background_tasks(self):
+        await self.start_auto_check()
+        if self.rate_update_task:
+            self.rate_update_task.cancel()
+        self.rate_update_task = asyncio.create_task(self.start_rate_updater())
+        if self.journal and RECONCILE_INTERVAL:
+            if self.reconcile_task:
+                self.reconcile_task.cancel()
+            self.reconcile_task = asyncio.create_task(self.reconciler.run())
+        if self.broadcast_task:
+            self.broadcast_task.cancel()
+        self.broadcast_task = asyncio.create_task(self.broadcaster.run())
+        if self.order_index:
+            # Индекс пополняет только лидер, читают его все
+            if self.order_index_task:
+                self.order_index_task.cancel()
+            paths = [worker_file(ORDER_JOURNAL_FILE, worker_id) for worker_id in range(max(BOT_WORKERS, 1))]
+            self.order_index_task = asyncio.create_task(self.order_index.run(paths))
+
+    def stop_background_tasks(self):
+        for task in (self.auto_check_task, self.rate_update_task, self.reconcile_task, self.broadcast_task,
+                     self.order_index_task):
+            if task and not task.done():
+                task.cancel()
+        self.auto_check_task = None
+        self.rate_update_task = None
+        self.reconcile_task = None
+        self.broadcast_task = None
+        self.order_index_task = None
+
+    def publish_rates(self):
+        if not self.store:
+            return
+        client = self.fragment_client
+        self.store.set("rates", "current", {
+            'rates': client.rates,
+            'version': client.rates_version,
+            'updated': client.last_rate_update
+        })
+
+    def load_shared_rates(self):
+        if not self.store:
+            return
+        rates = self.store.get("rates", "current")
+        if rates and 'rates' in rates:
+            client = self.fragment_client
+            client.rates.update(rates['rates'])
+            client.rates_version = rates['version']
+            client.last_rate_update = rates['updated']
+            if time.time() - client.last_rate_update < 3600:
+                self.readiness['rates'].set()
+
     async def start_rate_updater(self):
+        # Первое обновление выполняет прогрев при запуске
+        await self.readiness['rates'].wait()
         while True:
             try:
-                await self.fragment_client.update_rates()
+                if time.time() - self.fragment_client.last_rate_update >= 600:
+                    if await self.fragment_client.update_rates():
+                        self.publish_rates()
+                        self.readiness['rates'].set()
                 await asyncio.sleep(600)
             except Exception as e:
                 logger.error(f"Ошибка в задаче обновления курса: {str(e)}")
                 await asyncio.sleep(60)
 
+    @timed_handler("handle_message")
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_data = context.user_data
         
+        # Ввод количества звезд ведет к созданию счета
+        kind = 'expensive' if user_data.get('state') in ('ENTERING_AMOUNT', 'ENTERING_BULK_LIST') else 'navigation'
+        if await self._throttled(update, kind):
+            return
+        
         if user_data.get('state') == 'ENTERING_PROMO':
             promo = update.message.text.strip().upper()
             
@@ -1155,46 +5103,53 @@ class StarBot:
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
                 )
                 return
+            
+            if not USERNAME_PATTERN.fullmatch(friend_username):
+                await update.message.reply_text(
+                    "❌ Username может содержать только латинские буквы, цифры и _ (до 32 символов). Попробуйте снова:",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+                )
+                return
+            
+            # Несуществующий получатель отсекается до счета, а не после оплаты
+            if await self.recipients.validate(friend_username) is False:
+                await update.message.reply_text(
+                    f"❌ Пользователь @{friend_username} не найден. Проверьте username и попробуйте снова:",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+                )
+                return
                 
             user_data['friend_username'] = friend_username
             user_data['state'] = 'CHOOSING_CURRENCY'
             
-            currency_text = (
-                "<b>💱 Выберите валюту оплаты</b>\n\n"
-                f"Текущий курс:\n"
-                f"1 TON = {self.fragment_client.get_ton_rate():.2f} RUB\n"
-                f"1 USDT = {self.fragment_client.get_usdt_rate():.2f} RUB\n\n"
-                f"1 звезда = {self.fragment_client.PRICE_PER_STAR} RUB"
-            )
-
-            keyboard = [
-                [InlineKeyboardButton("💎 Оплатить в TON", callback_data="currency_ton")],
-                [InlineKeyboardButton("💵 Оплатить в USDT", callback_data="currency_usdt")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            currency_text, reply_markup = self._currency_choice()
 
-            await update.message.reply_photo(
-                photo=CURRENCY_CHOICE_PHOTO_URL,
+            await self._send_photo(
+                update.message.reply_photo,
+                self.config.photos['currency_choice'],
                 caption=currency_text,
                 reply_markup=reply_markup,
                 parse_mode='HTML'
             )
             return
 
+        if user_data.get('state') == 'ENTERING_BULK_LIST':
+            await self._accept_bulk_list(update.message, user_data, update.message.text)
+            return
+
         if user_data.get('state') == 'ENTERING_AMOUNT':
             user_input = update.message.text
             try:
                 amount = int(user_input)
-                if amount < 50:
+                if amount < self.config.min_stars:
                     await update.message.reply_text(
-                        "❌ Минимальное количество - 50 звезд. Введите другое количество:",
+                        f"❌ Минимальное количество - {self.config.min_stars} звезд. Введите другое количество:",
                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
                     )
                     return
-                elif amount > MAX_STARS:
+                elif amount > self.config.max_stars:
                     await update.message.reply_text(
-                        f"❌ Максимальное количество за одну покупку - {MAX_STARS} звезд. Введите другое количество:",
+                        f"❌ Максимальное количество за одну покупку - {self.config.max_stars} звезд. Введите другое количество:",
                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
                     )
                     return
@@ -1205,7 +5160,7 @@ class StarBot:
                 if 'friend_username' in user_data:
                     recipient = user_data['friend_username']
                 
-                currency = user_data.get('currency', 'TON')
+                currency = user_data.get('currency') or next(iter(self.config.assets))
                 
                 discount_percent = user_data.get('discount_percent', 0)
                 promo_code = user_data.get('promo_code', None)
@@ -1230,33 +5185,430 @@ class StarBot:
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]])
             )
 
-def run_bot():
-    api_key = API_KEY
-    telegram_token = TELEGRAM_TOKEN
-    cryptobot_token = CRYPTOBOT_TOKEN
+    @timed_handler("handle_document")
+    async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Список получателей подарка файлом .txt или .csv"""
+        user_data = context.user_data
+        if user_data.get('state') != 'ENTERING_BULK_LIST':
+            await update.message.reply_text(
+                "Пожалуйста, используйте кнопки меню для взаимодействия с ботом.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]])
+            )
+            return
+        
+        if await self._throttled(update, 'expensive'):
+            return
+        
+        back = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+        document = update.message.document
+        if document.file_size and document.file_size > BULK_FILE_MAX_BYTES:
+            await update.message.reply_text(
+                f"❌ Файл больше {BULK_FILE_MAX_BYTES // 1024} КБ. Отправьте список короче:",
+                reply_markup=back
+            )
+            return
+        
+        try:
+            file = await document.get_file()
+            text = bytes(await file.download_as_bytearray()).decode("utf-8-sig")
+        except UnicodeDecodeError:
+            await update.message.reply_text("❌ Файл должен быть текстом в кодировке UTF-8. Попробуйте снова:", reply_markup=back)
+            return
+        except Exception as e:
+            logger.error(f"Ошибка загрузки списка получателей: {str(e)}")
+            await update.message.reply_text("❌ Не удалось загрузить файл. Отправьте список сообщением:", reply_markup=back)
+            return
+        
+        await self._accept_bulk_list(update.message, user_data, text)
+
+    async def _accept_bulk_list(self, message: Message, user_data: dict, text: str):
+        """Проверяет список подарка и выставляет один счет на всех получателей"""
+        back = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="buy_stars")]])
+        recipients, errors = parse_bulk_recipients(text, self.config.min_stars, self.config.max_stars)
+        if not recipients and not errors:
+            errors.append("список пуст")
+        if len(recipients) > BULK_MAX_RECIPIENTS:
+            errors.append(f"получателей {len(recipients)}, максимум {BULK_MAX_RECIPIENTS}")
+        if errors:
+            shown = "\n".join(errors[:10])
+            if len(errors) > 10:
+                shown += f"\n… и еще {len(errors) - 10}"
+            await message.reply_text(f"❌ Список не принят:\n{shown}\n\nИсправьте и отправьте снова:", reply_markup=back)
+            return
+        
+        # Несуществующие получатели отсекаются до счета, как и при покупке другу
+        found = await self.recipients.validate_many([username for username, _ in recipients])
+        missing = [f"@{username}" for (username, _), exists in zip(recipients, found) if exists is False]
+        if missing:
+            shown = ", ".join(missing[:20]) + (f" и еще {len(missing) - 20}" if len(missing) > 20 else "")
+            await message.reply_text(f"❌ Не найдены: {shown}\n\nИсправьте список и отправьте снова:", reply_markup=back)
+            return
+        
+        del user_data['state']
+        await self.process_buy_stars(
+            message,
+            sum(quantity for _, quantity in recipients),
+            user_data.get('currency') or next(iter(self.config.assets)),
+            None,
+            user_data.get('discount_percent', 0),
+            user_data.get('promo_code'),
+            recipients=recipients
+        )
+
+class UpdateDispatcher:
+    """Параллельная обработка обновлений: порядок сохраняется внутри одного пользователя"""
+    def __init__(self, application: Application, max_concurrency: int = UPDATE_CONCURRENCY):
+        self.application = application
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.user_queues: Dict[int, deque] = {}
+        self.tasks = set()
+
+    @staticmethod
+    def _ordering_key(update: Update) -> int:
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return update.update_id
+
+    def submit(self, update: Update):
+        key = self._ordering_key(update)
+        queue = self.user_queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return
+        
+        self.user_queues[key] = deque([update])
+        task = asyncio.create_task(self._drain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _drain(self, key: int):
+        queue = self.user_queues[key]
+        try:
+            while queue:
+                update = queue[0]
+                async with self.semaphore:
+                    try:
+                        await self.application.process_update(update)
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки обновления {update.update_id}: {str(e)}", exc_info=True)
+                queue.popleft()
+        finally:
+            del self.user_queues[key]
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+class WebhookServer:
+    """Встроенный HTTP сервер для приема обновлений Telegram"""
+    def __init__(self, on_update: Callable[[Dict[str, Any]], None],
+                 listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret: Optional[str] = WEBHOOK_SECRET):
+        self.on_update = on_update
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            self.on_update(data)
+        except Exception as e:
+            logger.error(f"Некорректное обновление от Telegram: {str(e)}")
+            return web.Response(status=400)
+        
+        return web.Response()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+        logger.info(f"Webhook сервер слушает {self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def _join_dispatcher(dispatcher: UpdateDispatcher, timeout: float):
+    try:
+        await asyncio.wait_for(dispatcher.join(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Обработка обновлений не завершилась к сроку остановки")
+
+def _stop_event_on_signals() -> asyncio.Event:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def _set_webhook(tg_bot: Bot):
+    if WEBHOOK_URL:
+        await tg_bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook установлен: {WEBHOOK_URL}")
+
+async def run_webhook(bot: StarBot, application: Application):
+    dispatcher = UpdateDispatcher(application, UPDATE_CONCURRENCY)
     
-    bot = StarBot(api_key, telegram_token, cryptobot_token)
+    def on_update(data: Dict[str, Any]):
+        update = Update.de_json(data, application.bot)
+        if update:
+            dispatcher.submit(update)
     
-    if not bot.fragment_client.authenticate(phone_number=PHONE_NUMBER, mnemonics=MNEMONICS):
-        logger.error("Не удалось аутентифицироваться в Fragment API после нескольких попыток")
+    server = WebhookServer(on_update)
+    
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    await server.start()
+    await _set_webhook(application.bot)
+    
+    await bot.start_background_tasks()
+    
+    stop_event = _stop_event_on_signals()
+    try:
+        await stop_event.wait()
+    finally:
+        bot.lifecycle.begin_shutdown()
+        await server.stop()
+        await _join_dispatcher(dispatcher, bot.lifecycle.remaining())
+        await bot.lifecycle.shutdown()
+        await application.stop()
+        await application.shutdown()
+
+
+class LeaderElector:
+    """Аренда лидера: только один воркер выполняет фоновые задачи"""
+    def __init__(self, store: SqliteStore, bot: StarBot, owner: str,
+                 name: str = "background_tasks", ttl: int = LEADER_LEASE_TTL):
+        self.store = store
+        self.bot = bot
+        self.owner = owner
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    acquired = await asyncio.to_thread(self.store.try_acquire_lease, self.name, self.owner, self.ttl)
+                except Exception as e:
+                    logger.error(f"Ошибка продления аренды лидера: {str(e)}")
+                    acquired = False
+                
+                if acquired and not self.is_leader:
+                    logger.info(f"Воркер {self.owner} стал лидером")
+                    self.is_leader = True
+                    self.bot.load_shared_rates()
+                    await self.bot.start_background_tasks()
+                elif not acquired and self.is_leader:
+                    logger.warning(f"Воркер {self.owner} потерял аренду лидера")
+                    self.is_leader = False
+                    self.bot.stop_background_tasks()
+                
+                if not self.is_leader:
+                    self.bot.load_shared_rates()
+                
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if self.is_leader:
+                self.bot.stop_background_tasks()
+                self.store.release_lease(self.name, self.owner)
+                self.is_leader = False
+
+
+def shard_key(data: Dict[str, Any]) -> int:
+    """Ключ шардирования обновления по user_id (или chat_id) без полного разбора"""
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if user and 'id' in user:
+                return user['id']
+            chat = value.get('chat')
+            if chat and 'id' in chat:
+                return chat['id']
+    return data.get('update_id', 0)
 
-    application = Application.builder().token(telegram_token).build()
+async def gc_conversations(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет состояние диалогов, неактивных дольше CONVERSATION_TTL"""
+    persistence = context.application.persistence
+    if not isinstance(persistence, SqliteUserDataPersistence):
+        return
+    expired = await persistence.expired_user_ids()
+    for user_id in expired:
+        context.application.drop_user_data(user_id)
+        persistence.last_seen.pop(user_id, None)
+    if expired:
+        logger.info(f"Удалено неактивных диалогов: {len(expired)}")
+
+def build_application(bot: StarBot, store: Optional[SqliteStore] = None,
+                      request: Optional[BaseRequest] = None) -> Application:
+    builder = Application.builder().token(bot.telegram_token).base_url(TELEGRAM_API_URL)
+    if store:
+        builder = builder.persistence(SqliteUserDataPersistence(store))
+    if request:
+        builder = builder.request(request)
+    if SEND_GLOBAL_RATE > 0:
+        scheduler = SendScheduler()
+        builder = builder.rate_limiter(scheduler)
+        SEND_QUEUE.set_function(scheduler.depth)
+    application = builder.build()
+    
+    if TRAFFIC_RECORD_FILE:
+        bot.start_recording(worker_file(TRAFFIC_RECORD_FILE, bot.worker_id))
+        # Отдельная группа: запись не мешает основным обработчикам
+        application.add_handler(TypeHandler(Update, bot.recorder.on_update), group=-1)
     
     application.add_handler(CommandHandler("start", bot.start))
+    application.add_handler(CommandHandler("broadcast", bot.broadcast))
+    application.add_handler(CommandHandler("stats", bot.show_stats))
+    application.add_handler(CommandHandler("mem", bot.show_memory))
+    application.add_handler(CommandHandler("trace", bot.show_traces))
     application.add_handler(CallbackQueryHandler(bot.handle_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, bot.handle_document))
+    
+    if store and application.job_queue:
+        application.job_queue.run_repeating(gc_conversations, interval=3600, first=60)
+    return application
+
+async def run_worker(worker_id: int, queue):
+    store = SqliteStore(SHARED_STORE_PATH)
+    bot = StarBot(API_KEY, TELEGRAM_TOKEN, CRYPTOBOT_TOKEN, store=store, shared_state=True)
+    bot.worker_id = worker_id
     
+    application = build_application(bot, store)
+    dispatcher = UpdateDispatcher(application, UPDATE_CONCURRENCY)
+    elector = LeaderElector(store, bot, owner=f"{socket.gethostname()}:{os.getpid()}:{worker_id}")
+    
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    elector_task = asyncio.create_task(elector.run())
+    logger.info(f"Воркер {worker_id} запущен (pid {os.getpid()})")
+    
+    loop = asyncio.get_running_loop()
     try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            update = Update.de_json(data, application.bot)
+            if update:
+                dispatcher.submit(update)
+    finally:
+        bot.lifecycle.begin_shutdown()
+        await _join_dispatcher(dispatcher, bot.lifecycle.remaining())
+        await bot.lifecycle.shutdown()
+        elector_task.cancel()
+        await asyncio.gather(elector_task, return_exceptions=True)
+        await application.stop()
+        await application.shutdown()
+        logger.info(f"Воркер {worker_id} остановлен")
+
+def worker_main(worker_id: int, queue):
+    # Отдельный файл логов на воркер: ротация одного файла из нескольких процессов небезопасна
+    base, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{base}.worker{worker_id}{ext}")
+    # Остановкой воркеров управляет родительский процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(worker_id, queue))
+
+async def run_shard_router(queues: list):
+    """Принимает обновления Telegram и распределяет их по воркерам по user_id"""
+    def route(data: Dict[str, Any]):
+        queues[shard_key(data) % len(queues)].put(data)
+    
+    stop_event = _stop_event_on_signals()
+    
+    async with Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL) as tg_bot:
+        if BOT_MODE == "webhook":
+            server = WebhookServer(route)
+            await server.start()
+            await _set_webhook(tg_bot)
+            try:
+                await stop_event.wait()
+            finally:
+                await server.stop()
+            return
+        
+        await tg_bot.delete_webhook()
+        offset = None
+        while not stop_event.is_set():
+            try:
+                updates = await tg_bot.get_updates(offset=offset, timeout=10, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {str(e)}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                route(update.to_dict())
+
+def run_workers(worker_count: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(worker_count)]
+    processes = [
+        ctx.Process(target=worker_main, args=(i, queues[i]), name=f"bot-worker-{i}")
+        for i in range(worker_count)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"Запущено воркеров: {worker_count}")
+    
+    try:
+        asyncio.run(run_shard_router(queues))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+
+def run_bot():
+    if BOT_WORKERS > 1:
+        run_workers(BOT_WORKERS)
+        return
+    
+    api_key = API_KEY
+    telegram_token = TELEGRAM_TOKEN
+    cryptobot_token = CRYPTOBOT_TOKEN
+    
+    store = SqliteStore(SHARED_STORE_PATH)
+    bot = StarBot(api_key, telegram_token, cryptobot_token, store=store)
+    application = build_application(bot, store)
+    
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(bot, application))
+        return
+    
+    async def post_init(application: Application):
+        bot.lifecycle.install_signal_handlers()
+        await bot.post_init(application)
+        await bot.start_background_tasks()
     
-    if bot.auto_check_task is None:
-        bot.auto_check_task = loop.create_task(bot.start_auto_check())
-    if bot.rate_update_task is None:
-        bot.rate_update_task = loop.create_task(bot.start_rate_updater())
+    async def post_stop(application: Application):
+        await bot.lifecycle.shutdown()
     
+    application.post_init = post_init
+    application.post_stop = post_stop
     application.run_polling()
 
 if __name__ == "__main__":
@@ -0,0 +1,497 @@
+"""Нагрузочный тест StarBot с локальными заглушками Telegram Bot API, Crypto Pay и Fragment.
+
+Бот запускается отдельным процессом в режиме webhook, все его внешние API
+направлены на заглушки с настраиваемой задержкой и долей ошибок. Виртуальные
+пользователи проходят сценарий start -> buy -> invoice -> pay -> check,
+в конце печатается пропускная способность, p50/p99 по шагам и задержка доставки.
+
+Пример:
+    python loadtest.py --users 2000 --concurrency 200 --latency-ms 50 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Callable
+
+from aiohttp import web, ClientSession, ClientTimeout
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "deepseek_python_20250614_73c3e7.py")
+BOT_TOKEN = "123456:LOADTEST"
+ADMIN_CHAT_ID = 1
+STEPS = ["start", "buy", "invoice", "pay", "check"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FakeUpstream:
+    """Базовая заглушка внешнего API с задержкой и внедрением ошибок"""
+    def __init__(self, name: str, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    async def delay_or_fail(self) -> bool:
+        """Имитирует задержку сети; True - ответить ошибкой"""
+        self.requests += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def setup_routes(self, app: web.Application):
+        raise NotImplementedError
+
+    async def start(self, port: int):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        self.setup_routes(app)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+        self.port = port
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+
+class FakeTelegram(FakeUpstream):
+    """Bot API: запоминает исходящие сообщения по чатам, чтобы пользователи могли их дождаться"""
+    def __init__(self, **kwargs):
+        super().__init__("telegram", **kwargs)
+        self.chats: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.message_ids = itertools.count(1000)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post("/bot{token}/{method}", self.handle)
+
+    @staticmethod
+    async def _params(request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if key == "reply_markup" and isinstance(value, str):
+                value = json.loads(value)
+            params[key] = value
+        return params
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if method not in ("getMe", "setWebhook", "deleteWebhook") and await self.delay_or_fail():
+            return web.json_response({"ok": False, "error_code": 500, "description": "Injected error"}, status=500)
+
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        elif method in ("sendPhoto", "sendMessage", "editMessageCaption", "editMessageText"):
+            message_id = int(params.get("message_id") or next(self.message_ids))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}
+            }
+            if method in ("sendPhoto", "editMessageCaption"):
+                result["photo"] = [{"file_id": f"photo-{message_id}", "file_unique_id": f"u{message_id}",
+                                    "width": 1, "height": 1}]
+                result["caption"] = params.get("caption", "")
+            else:
+                result["text"] = params.get("text", "")
+            if params.get("reply_markup"):
+                result["reply_markup"] = params["reply_markup"]
+        else:
+            result = True
+
+        if chat_id is not None:
+            self.chats[int(chat_id)].put_nowait((method, params, time.perf_counter()))
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeCryptoBot(FakeUpstream):
+    """Crypto Pay API (createInvoice, getInvoices) и курс CoinGecko"""
+    def __init__(self, **kwargs):
+        super().__init__("cryptobot", **kwargs)
+        self.invoice_ids = itertools.count(1)
+        self.invoices: Dict[int, Dict[str, Any]] = {}
+        self.paid_at: Dict[int, float] = {}
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post("/api/createInvoice", self.create_invoice)
+        app.router.add_get("/api/getInvoices", self.get_invoices)
+        app.router.add_get("/coingecko/simple/price", self.price)
+
+    async def create_invoice(self, request: web.Request) -> web.Response:
+        if await self.delay_or_fail():
+            return web.json_response({"ok": False, "error": {"code": 500, "name": "INJECTED"}}, status=500)
+        data = await request.json()
+        invoice_id = next(self.invoice_ids)
+        invoice = {
+            "invoice_id": invoice_id,
+            "status": "active",
+            "asset": data["asset"],
+            "amount": data["amount"],
+            "description": data.get("description", ""),
+            "payload": data.get("payload", ""),
+            "pay_url": f"http://127.0.0.1:{self.port}/invoice/{invoice_id}",
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        self.invoices[invoice_id] = invoice
+        return web.json_response({"ok": True, "result": invoice})
+
+    async def get_invoices(self, request: web.Request) -> web.Response:
+        if await self.delay_or_fail():
+            return web.json_response({"ok": False, "error": {"code": 500, "name": "INJECTED"}}, status=500)
+        query = request.query
+        if "invoice_ids" in query:
+            ids = [int(i) for i in query["invoice_ids"].split(",") if i]
+            items = [self.invoices[i] for i in ids if i in self.invoices]
+        else:
+            items = sorted(self.invoices.values(), key=lambda inv: inv["invoice_id"], reverse=True)
+        if "status" in query:
+            items = [inv for inv in items if inv["status"] == query["status"]]
+        offset = int(query.get("offset", 0))
+        count = int(query.get("count", 100))
+        return web.json_response({"ok": True, "result": {"items": items[offset:offset + count]}})
+
+    async def price(self, request: web.Request) -> web.Response:
+        return web.json_response({"the-open-network": {"rub": 200.0}, "tether": {"rub": 90.0}})
+
+    def pay(self, invoice_id: int):
+        invoice = self.invoices[invoice_id]
+        invoice["status"] = "paid"
+        invoice["paid_at"] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        self.paid_at[invoice_id] = time.perf_counter()
+
+
+class FakeFragment(FakeUpstream):
+    """Fragment API: аутентификация, проверка получателя и заказ звезд"""
+    def __init__(self, **kwargs):
+        super().__init__("fragment", **kwargs)
+        self.delivered: Dict[str, float] = {}
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post("/v1/auth/authenticate/", self.authenticate)
+        app.router.add_post("/v1/order/stars/", self.order_stars)
+        app.router.add_get("/v1/misc/user/{username}/", self.user_lookup)
+
+    async def authenticate(self, request: web.Request) -> web.Response:
+        return web.json_response({"token": "loadtest-token"})
+
+    async def user_lookup(self, request: web.Request) -> web.Response:
+        if await self.delay_or_fail():
+            return web.json_response({"detail": "Injected error"}, status=500)
+        return web.json_response({"username": request.match_info["username"]})
+
+    async def order_stars(self, request: web.Request) -> web.Response:
+        if await self.delay_or_fail():
+            return web.json_response({"detail": "Injected error"}, status=500)
+        data = await request.json()
+        self.delivered[data["username"]] = time.perf_counter()
+        return web.json_response({"id": len(self.delivered), "username": data["username"], "quantity": data["quantity"]})
+
+
+class VirtualUser:
+    def __init__(self, test: "LoadTest", user_id: int):
+        self.test = test
+        self.user_id = user_id
+        self.username = f"loaduser{user_id}"
+        self.timings: Dict[str, float] = {}
+        self.message_id = 1
+
+    def _user(self) -> Dict[str, Any]:
+        return {"id": self.user_id, "is_bot": False, "first_name": "Load", "username": self.username}
+
+    def _chat(self) -> Dict[str, Any]:
+        return {"id": self.user_id, "type": "private"}
+
+    async def _post(self, update: Dict[str, Any]):
+        update["update_id"] = next(self.test.update_ids)
+        async with self.test.session.post(self.test.webhook_url, json=update) as response:
+            if response.status != 200:
+                raise RuntimeError(f"webhook ответил {response.status}")
+
+    async def send_text(self, text: str):
+        message = {"message_id": self.message_id, "date": int(time.time()), "chat": self._chat(),
+                   "from": self._user(), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        await self._post({"message": message})
+
+    async def press(self, data: str):
+        await self._post({"callback_query": {
+            "id": str(next(self.test.update_ids)),
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {
+                "message_id": self.message_id, "date": int(time.time()), "chat": self._chat(),
+                "photo": [{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}]
+            }
+        }})
+
+    async def expect(self, methods: tuple, predicate: Callable[[Dict[str, Any]], bool] = lambda p: True) -> Dict[str, Any]:
+        queue = self.test.telegram.chats[self.user_id]
+        deadline = time.perf_counter() + self.test.args.step_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"нет ответа {methods}")
+            method, params, _ = await asyncio.wait_for(queue.get(), remaining)
+            if method in methods and predicate(params):
+                if method in ("sendPhoto", "sendMessage"):
+                    self.message_id += 1
+                return params
+
+    async def step(self, name: str, action):
+        started = time.perf_counter()
+        result = await action()
+        self.timings[name] = time.perf_counter() - started
+        return result
+
+    async def run(self):
+        send = ("sendPhoto", "sendMessage")
+
+        async def start():
+            await self.send_text("/start")
+            await self.expect(send)
+
+        async def buy():
+            for data in ("buy_stars", "buy_self", "currency_ton"):
+                await self.press(data)
+                await self.expect(send)
+
+        async def invoice():
+            await self.send_text(str(self.test.args.stars))
+            params = await self.expect(send)
+            buttons = [b for row in params.get("reply_markup", {}).get("inline_keyboard", []) for b in row]
+            check = next((b["callback_data"] for b in buttons if b.get("callback_data", "").startswith("check_")), None)
+            if not check:
+                raise RuntimeError(f"счет не выставлен: {params.get('caption') or params.get('text')}")
+            return check
+
+        async def pay():
+            self.test.cryptobot.pay(invoice_id)
+
+        await self.step("start", start)
+        await self.step("buy", buy)
+        check_data = await self.step("invoice", invoice)
+        invoice_id = int(check_data.split("_")[1])
+        await self.step("pay", pay)
+
+        async def check():
+            await self.press(check_data)
+            while True:
+                params = await self.expect(("editMessageCaption", "editMessageText"))
+                text = params.get("caption") or params.get("text") or ""
+                if not text.startswith(("🔄", "⌛")):
+                    if not text.startswith("✅"):
+                        raise RuntimeError(f"доставка не удалась: {text[:80]}")
+                    return
+
+        await self.step("check", check)
+        delivered = self.test.fragment.delivered.get(self.username)
+        if delivered:
+            self.test.delivery_lags.append(delivered - self.test.cryptobot.paid_at[invoice_id])
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        upstream = dict(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate)
+        self.telegram = FakeTelegram(**upstream)
+        self.cryptobot = FakeCryptoBot(**upstream)
+        self.fragment = FakeFragment(**upstream)
+        self.update_ids = itertools.count(1)
+        self.webhook_url = f"http://127.0.0.1:{args.base_port + 3}/telegram"
+        self.session: Optional[ClientSession] = None
+        self.bot_process: Optional[subprocess.Popen] = None
+        self.workdir = tempfile.mkdtemp(prefix="starbot-load-")
+        self.step_timings: Dict[str, List[float]] = defaultdict(list)
+        self.delivery_lags: List[float] = []
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.completed = 0
+
+    def bot_env(self) -> Dict[str, str]:
+        base = f"http://127.0.0.1:{self.args.base_port}"
+        env = dict(os.environ)
+        env.update({
+            "API_KEY": "loadtest",
+            "TELEGRAM_TOKEN": BOT_TOKEN,
+            "CRYPTOBOT_TOKEN": "loadtest",
+            "PHONE_NUMBER": "+70000000000",
+            "MNEMONICS": "load test words",
+            "ADMIN_CHAT_ID": str(ADMIN_CHAT_ID),
+            "BOT_MODE": "webhook",
+            "BOT_WORKERS": str(self.args.workers),
+            "TELEGRAM_API_URL": f"{base}/bot",
+            "CRYPTOBOT_API_URL": f"http://127.0.0.1:{self.args.base_port + 1}/api",
+            "COINGECKO_API_URL": f"http://127.0.0.1:{self.args.base_port + 1}/coingecko",
+            "FRAGMENT_API_URL": f"http://127.0.0.1:{self.args.base_port + 2}/v1",
+            "WEBHOOK_LISTEN": "127.0.0.1",
+            "WEBHOOK_PORT": str(self.args.base_port + 3),
+            "WEBHOOK_PATH": "/telegram",
+            "UPDATE_CONCURRENCY": str(self.args.update_concurrency),
+            "MEDIA_WARMUP_CHAT_ID": "",
+            "SHARED_STORE_PATH": os.path.join(self.workdir, "state.db"),
+            "ORDER_JOURNAL_FILE": os.path.join(self.workdir, "orders.journal"),
+            "ORDER_INDEX_PATH": os.path.join(self.workdir, "orders_index.db"),
+            "PAYMENT_TRACE_FILE": os.path.join(self.workdir, "payment_traces.jsonl"),
+            "PAYMENT_PROFILE_DIR": os.path.join(self.workdir, "payment_profiles"),
+            # Общие лимиты троттлинга ограничили бы замеряемую пропускную способность
+            "THROTTLE_NAV_GLOBAL_RATE": "0",
+            "THROTTLE_EXPENSIVE_GLOBAL_RATE": "0",
+            "LOG_FILE": os.path.join(self.workdir, "bot.log"),
+        })
+        env.update(dict(item.split("=", 1) for item in self.args.bot_env))
+        return env
+
+    async def wait_for_webhook(self, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.bot_process.poll() is not None:
+                raise RuntimeError(f"бот завершился с кодом {self.bot_process.returncode}, см. {self.workdir}")
+            try:
+                async with self.session.get(self.webhook_url) as response:
+                    if response.status in (404, 405):
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("webhook бота не поднялся")
+
+    async def run_user(self, user_id: int, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            user = VirtualUser(self, user_id)
+            try:
+                await user.run()
+                self.completed += 1
+            except Exception as e:
+                failed_step = next((step for step in STEPS if step not in user.timings), "check")
+                self.failures[failed_step] += 1
+                if self.args.verbose:
+                    print(f"Пользователь {user_id}: ошибка на шаге {failed_step}: {e!r}")
+            for step, value in user.timings.items():
+                self.step_timings[step].append(value)
+
+    async def run(self) -> Dict[str, Any]:
+        await self.telegram.start(self.args.base_port)
+        await self.cryptobot.start(self.args.base_port + 1)
+        await self.fragment.start(self.args.base_port + 2)
+        self.session = ClientSession(timeout=ClientTimeout(total=self.args.step_timeout))
+        log = open(os.path.join(self.workdir, "bot.stdout"), "w")
+        self.bot_process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=self.bot_env(), stdout=log, stderr=log)
+        try:
+            await self.wait_for_webhook()
+            # Даем прогреву получить курс и токен Fragment
+            await asyncio.sleep(self.args.warmup)
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                self.run_user(100000 + i, semaphore) for i in range(self.args.users)
+            ))
+            elapsed = time.perf_counter() - started
+        finally:
+            self.bot_process.send_signal(signal.SIGTERM)
+            try:
+                # Заглушки должны отвечать, пока бот досылает сообщения при остановке
+                await asyncio.to_thread(self.bot_process.wait, 60)
+            except subprocess.TimeoutExpired:
+                self.bot_process.kill()
+            log.close()
+            await self.session.close()
+            for fake in (self.telegram, self.cryptobot, self.fragment):
+                await fake.stop()
+        return self.summary(elapsed)
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            "users": self.args.users,
+            "completed": self.completed,
+            "failures": dict(self.failures),
+            "elapsed_s": round(elapsed, 3),
+            "throughput_flows_per_s": round(self.completed / elapsed, 2) if elapsed else 0.0,
+            "steps": {
+                step: {
+                    "count": len(self.step_timings[step]),
+                    "p50_ms": round(percentile(self.step_timings[step], 0.5) * 1000, 1),
+                    "p99_ms": round(percentile(self.step_timings[step], 0.99) * 1000, 1)
+                } for step in STEPS
+            },
+            "delivery_lag": {
+                "p50_ms": round(percentile(self.delivery_lags, 0.5) * 1000, 1),
+                "p99_ms": round(percentile(self.delivery_lags, 0.99) * 1000, 1)
+            },
+            "upstream_requests": {fake.name: fake.requests for fake in (self.telegram, self.cryptobot, self.fragment)},
+            "upstream_injected_errors": {fake.name: fake.errors for fake in (self.telegram, self.cryptobot, self.fragment)},
+            "bot_logs": self.workdir
+        }
+
+
+def print_summary(summary: Dict[str, Any]):
+    print(f"Пользователей: {summary['users']}, успешно: {summary['completed']}, ошибки: {summary['failures']}")
+    print(f"Время: {summary['elapsed_s']} с, пропускная способность: {summary['throughput_flows_per_s']} сценариев/с")
+    print(f"{'шаг':<10}{'кол-во':>8}{'p50, мс':>12}{'p99, мс':>12}")
+    for step, stats in summary["steps"].items():
+        print(f"{step:<10}{stats['count']:>8}{stats['p50_ms']:>12}{stats['p99_ms']:>12}")
+    lag = summary["delivery_lag"]
+    print(f"Задержка оплата -> доставка: p50 {lag['p50_ms']} мс, p99 {lag['p99_ms']} мс")
+    print(f"Запросы к заглушкам: {summary['upstream_requests']}, внедренные ошибки: {summary['upstream_injected_errors']}")
+    print(f"Логи бота: {summary['bot_logs']}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500, help="число виртуальных пользователей")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно активных пользователей")
+    parser.add_argument("--stars", type=int, default=100, help="звезд в одной покупке")
+    parser.add_argument("--latency-ms", type=float, default=20, help="задержка ответа заглушек")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="случайная добавка к задержке")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов заглушек с ошибкой")
+    parser.add_argument("--workers", type=int, default=1, help="BOT_WORKERS для процесса бота")
+    parser.add_argument("--update-concurrency", type=int, default=64, help="UPDATE_CONCURRENCY бота")
+    parser.add_argument("--step-timeout", type=float, default=60, help="таймаут одного шага, с")
+    parser.add_argument("--warmup", type=float, default=2, help="пауза на прогрев бота, с")
+    parser.add_argument("--base-port", type=int, default=18600, help="порты: Telegram, CryptoBot, Fragment, webhook")
+    parser.add_argument("--bot-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные переменные окружения бота")
+    parser.add_argument("--json-out", help="сохранить результат в JSON")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    summary = asyncio.run(LoadTest(args).run())
+    print_summary(summary)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
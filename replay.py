@@ -0,0 +1,222 @@
+"""Воспроизведение записанного трафика (TRAFFIC_RECORD_FILE) через StarBot.
+
+Обновления подаются в Application по порядку с максимальной скоростью, время
+бота (time.time, time.strftime, time.sleep) идет по отметкам из записи.
+Ответы CryptoBot и Fragment берутся из той же записи, Bot API отвечает из памяти.
+Подходит для регрессионных замеров производительности и разбора инцидентов.
+
+Пример:
+    TRAFFIC_RECORD_FILE=traffic.jsonl python deepseek_python_20250614_73c3e7.py
+    python replay.py traffic.jsonl --repeat 5 --json-out replay.json
+"""
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import time as _time
+from collections import defaultdict, deque
+from typing import Optional, Dict, Any, List, Tuple
+
+import requests
+from telegram import Update
+
+from bench_handlers import InMemoryRequest, starbot
+
+
+class VirtualTime:
+    """Замена модуля time внутри бота: часы переводятся по записанным событиям"""
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def strftime(self, fmt: str, t=None) -> str:
+        return _time.strftime(fmt, t if t is not None else _time.localtime(self.now))
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+    def __getattr__(self, name: str):
+        return getattr(_time, name)
+
+
+class ReplayResponse:
+    def __init__(self, status_code: int, body: Any):
+        self.status_code = status_code
+        self.body = body
+        self.text = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+
+    def json(self) -> Any:
+        if isinstance(self.body, str):
+            raise ValueError("Ответ не JSON")
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} (записанный ответ)", response=self)
+
+
+class ReplaySession:
+    """Отдает записанные ответы CryptoBot и Fragment по (upstream, ключ) в порядке записи"""
+    def __init__(self, events: List[Dict[str, Any]]):
+        self.headers: Dict[str, str] = {}
+        self.responses: Dict[Tuple[str, Optional[str]], deque] = defaultdict(deque)
+        for event in events:
+            if event["ev"] == "upstream" and event["name"] != "coingecko":
+                self.responses[(event["name"], event.get("key"))].append(event)
+        self.misses: Dict[str, int] = defaultdict(int)
+
+    def _replay(self, name: str, key: Optional[str]) -> ReplayResponse:
+        recorded = self.responses.get((name, key))
+        if not recorded:
+            self.misses[name] += 1
+            raise requests.exceptions.ConnectionError(f"Нет записанного ответа {name} ({key})")
+        event = recorded.popleft()
+        return ReplayResponse(event["status"], event["data"])
+
+    def post(self, url: str, **kwargs) -> ReplayResponse:
+        payload = kwargs.get("json") or {}
+        if url.endswith("/createInvoice"):
+            return self._replay("cryptobot_create_invoice", None)
+        if url.endswith("/order/stars/"):
+            return self._replay("fragment_order_stars", payload.get("username"))
+        if url.endswith("/auth/authenticate/"):
+            return self._replay("fragment_auth", None)
+        # Уведомления администратору
+        return ReplayResponse(200, {"ok": True, "result": True})
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, **kwargs) -> ReplayResponse:
+        if url.endswith("/getInvoices"):
+            return self._replay("cryptobot_get_invoices", str((params or {}).get("invoice_ids")))
+        if "/misc/user/" in url:
+            return self._replay("fragment_user_lookup", url.rstrip("/").rsplit("/", 1)[-1])
+        raise requests.exceptions.ConnectionError(f"Запрос {url} не поддерживается при воспроизведении")
+
+    def close(self):
+        pass
+
+    def unused(self) -> Dict[str, int]:
+        counts: Dict[str, int] = defaultdict(int)
+        for (name, _), recorded in self.responses.items():
+            counts[name] += len(recorded)
+        return {name: count for name, count in counts.items() if count}
+
+
+def load_events(path: str) -> List[Dict[str, Any]]:
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    events.sort(key=lambda event: event["ts"])
+    return events
+
+
+def update_kind(data: Dict[str, Any]) -> str:
+    """Группа для статистики: данные кнопки без id платежа, команда или состояние ввода"""
+    if "callback_query" in data:
+        return "callback:" + re.sub(r"_\d+$", "", data["callback_query"].get("data", ""))
+    text = (data.get("message") or {}).get("text", "")
+    return "command:" + text.split()[0] if text.startswith("/") else "message"
+
+
+async def replay(events: List[Dict[str, Any]], clock: VirtualTime) -> Dict[str, Any]:
+    bot = starbot.StarBot(starbot.API_KEY, starbot.TELEGRAM_TOKEN, starbot.CRYPTOBOT_TOKEN)
+    session = ReplaySession(events)
+    client = bot.fragment_client
+    client.use_session(session)
+    client.auth_token = "replay"
+    client.last_rate_update = clock.now
+
+    async def no_rate_update():
+        return False
+    # Курсы меняются только событиями coingecko из записи
+    client.update_rates = no_rate_update
+    for event in bot.readiness.values():
+        event.set()
+
+    application = starbot.build_application(bot, request=InMemoryRequest())
+    await application.initialize()
+
+    timings: Dict[str, List[float]] = defaultdict(list)
+    errors = 0
+    started = _time.perf_counter()
+    for event in events:
+        clock.now = event["ts"]
+        if event["ev"] == "upstream" and event["name"] == "coingecko" and event["status"] == 200:
+            client.apply_rates(event["data"])
+        elif event["ev"] == "update":
+            update = Update.de_json(event["data"], application.bot)
+            update_started = _time.perf_counter()
+            try:
+                await application.process_update(update)
+            except Exception:
+                errors += 1
+            timings[update_kind(event["data"])].append(_time.perf_counter() - update_started)
+    elapsed = _time.perf_counter() - started
+    await application.shutdown()
+
+    total = sum(len(values) for values in timings.values())
+    return {
+        "updates": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "updates_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+        "kinds": {
+            kind: {
+                "count": len(values),
+                "mean_us": round(statistics.mean(values) * 1e6, 1),
+                "p99_us": round(sorted(values)[min(len(values) - 1, int(0.99 * len(values)))] * 1e6, 1),
+                "max_us": round(max(values) * 1e6, 1)
+            } for kind, values in sorted(timings.items())
+        },
+        "upstream_misses": dict(session.misses),
+        "upstream_unused": session.unused()
+    }
+
+
+def print_summary(summary: Dict[str, Any]):
+    print(f"Обновлений: {summary['updates']}, ошибок: {summary['errors']}, "
+          f"время: {summary['elapsed_s']} с, {summary['updates_per_s']} обн./с")
+    print(f"{'тип':<28}{'кол-во':>8}{'ср., мкс':>12}{'p99, мкс':>12}{'макс., мкс':>12}")
+    for kind, stats in summary["kinds"].items():
+        print(f"{kind:<28}{stats['count']:>8}{stats['mean_us']:>12}{stats['p99_us']:>12}{stats['max_us']:>12}")
+    if summary["upstream_misses"]:
+        print(f"Нет записанных ответов: {summary['upstream_misses']}")
+    if summary["upstream_unused"]:
+        print(f"Неиспользованные ответы: {summary['upstream_unused']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("record", help="файл записи трафика")
+    parser.add_argument("--repeat", type=int, default=1, help="число прогонов, каждый на чистом боте")
+    parser.add_argument("--json-out", help="сохранить результат последнего прогона в JSON")
+    parser.add_argument("--with-logging", action="store_true", help="не отключать INFO-логи бота")
+    args = parser.parse_args()
+
+    if not args.with_logging:
+        starbot.logging.getLogger().setLevel(starbot.logging.WARNING)
+    events = load_events(args.record)
+    if not events:
+        parser.error("запись пуста")
+
+    clock = VirtualTime(events[0]["ts"])
+    starbot.time = clock
+    for run in range(args.repeat):
+        clock.now = events[0]["ts"]
+        starbot.user_data_store.clear()
+        summary = asyncio.run(replay(events, clock))
+        if args.repeat > 1:
+            print(f"Прогон {run + 1}:")
+        print_summary(summary)
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
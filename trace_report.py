@@ -0,0 +1,59 @@
+"""Сводка трасс оплат (PAYMENT_TRACE_FILE): задержка доставки по этапам и внешним API.
+
+Принимает файлы всех воркеров сразу. Можно отобрать трассы по времени и
+посмотреть самые медленные; профили из PAYMENT_PROFILE_DIR открываются
+стандартными средствами: python -m pstats payment_profiles/<файл>.prof
+
+Пример:
+    PAYMENT_TRACE=1 python deepseek_python_20250614_73c3e7.py
+    python trace_report.py payment_traces*.jsonl --since 2025-06-14T12:00 --slowest 5
+"""
+import argparse
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from trace_summary import summarize
+
+
+def load_traces(paths: List[str], since: Optional[float] = None) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or record["ts"] >= since:
+                    records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+def describe(record: Dict[str, Any]) -> str:
+    stages = ", ".join(f"{span['stage']} {span['ms']:.0f}" for span in record["spans"] if span["ms"] >= 1)
+    moment = datetime.fromtimestamp(record["ts"]).isoformat(timespec="seconds")
+    return f"{record['payment_id']} ({record['source']}, {moment}): {record['total_ms']:.0f} мс - {stages}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="файлы трасс")
+    parser.add_argument("--since", help="только трассы не раньше даты ISO 8601")
+    parser.add_argument("--slowest", type=int, default=0, help="показать N самых медленных оплат")
+    args = parser.parse_args()
+
+    since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    records = load_traces(args.files, since)
+    print("\n".join(summarize(records)))
+    if args.slowest and records:
+        print("Самые медленные оплаты:")
+        for record in sorted(records, key=lambda record: record["total_ms"], reverse=True)[:args.slowest]:
+            print(f"  {describe(record)}")
+
+
+if __name__ == "__main__":
+    main()
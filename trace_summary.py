@@ -0,0 +1,46 @@
+"""Сводка трасс оплат: общая для команды /trace бота и trace_report.py, без зависимостей"""
+from typing import Any, Dict, List
+
+# Этапы-обертки: их время уже разложено по вложенным этапам и в сумму не идет
+WRAPPER_STAGES = {"process_payment"}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(records: List[Dict[str, Any]]) -> List[str]:
+    """Разбивка задержки по этапам и по внешним API: суммы на заказ, p50/p95/макс и доля от общего времени"""
+    if not records:
+        return ["Трасс оплаты пока нет."]
+    totals = [record["total_ms"] for record in records]
+    grand_total = sum(totals) or 1.0
+    lines = [
+        f"Трасс: {len(records)}, всего на заказ p50 {percentile(totals, 0.5):.0f} мс, "
+        f"p95 {percentile(totals, 0.95):.0f} мс, макс. {max(totals):.0f} мс"
+    ]
+    for title, key in (("Этапы", "stage"), ("Внешние API", "upstream")):
+        per_order: Dict[str, List[float]] = {}
+        for record in records:
+            sums: Dict[str, float] = {}
+            for span in record["spans"]:
+                if span["stage"] in WRAPPER_STAGES:
+                    continue
+                name = span[key]
+                if name and span.get("background"):
+                    name = f"{name} (фоном)"
+                if name:
+                    sums[name] = sums.get(name, 0.0) + span["ms"]
+            for name, value in sums.items():
+                per_order.setdefault(name, []).append(value)
+        lines.append(f"{title} (мс на заказ):")
+        for name, values in sorted(per_order.items(), key=lambda item: sum(item[1]), reverse=True):
+            lines.append(
+                f"  {name}: {len(values)} заказов, p50 {percentile(values, 0.5):.0f}, "
+                f"p95 {percentile(values, 0.95):.0f}, макс. {max(values):.0f}, "
+                f"{sum(values) / grand_total:.0%} времени"
+            )
+    return lines